@@ -1,6 +1,6 @@
 import streamlit as st
 from dotenv import load_dotenv
-from ui import UI
+from ui import UI, start_metrics_server
 
 load_dotenv()
 
@@ -9,6 +9,7 @@ def main():
     ui = UI()
 
     st.set_page_config(page_title="NLQ Dashboard", layout="wide")
+    start_metrics_server()
 
     ui.initialize_session_state()
     ui.handle_sidebar()
@@ -17,9 +18,13 @@ def main():
     current_page = st.session_state.get("current_page", "")
     if current_page == "Visualizations" and "connection" in st.session_state:
         ui.setup_pygwalker()
+    elif current_page == "Workload" and "connection" in st.session_state:
+        ui.handle_workload_page()
     else:
         ui.handle_query_tab()
 
+    ui.schedule_poll()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,269 @@
+import asyncio
+import functools
+import threading
+import time
+import uuid
+
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+from openai import AsyncOpenAI
+from instrumentation import Span, collect, span
+from connection_pool import AsyncPoolRegistry, ConnectionParams, pool_name
+from openai_query import OpenAIQuery
+from query_executor import ResultPage, statement_timeout_ms
+from query_guard import PlanSummary, QueryGuard
+from result_cache import ResultCache, cached_fetch_page_async
+from result_cursors import ResultCursors
+from rollups import Rewrite, RollupRewriter
+from workload_log import WorkloadLog
+
+FINISHED = ("done", "failed", "cancelled", "blocked", "confirm")
+FINISHED_JOB_TTL = 3600
+# How often idle paging cursors are checked against their TTL
+CURSOR_PRUNE_INTERVAL = 30
+
+
+@dataclass
+class Job:
+    id: str
+    kind: str
+    status: str = "pending"
+    messages: List[Dict[str, str]] = field(default_factory=list)
+    sql: Optional[str] = None
+    page: Optional[ResultPage] = None
+    plan: Optional[PlanSummary] = None
+    rewrite: Optional[Rewrite] = None
+    error: Optional[str] = None
+    submitted_at: float = field(default_factory=time.time)
+    first_output_at: Optional[float] = None
+    results_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    spans: List[Span] = field(default_factory=list)
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    @property
+    def done(self) -> bool:
+        return self.status in FINISHED
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished_at or time.time()) - self.submitted_at
+
+    @property
+    def time_to_first_output(self) -> Optional[float]:
+        if self.first_output_at is None:
+            return None
+        return self.first_output_at - self.submitted_at
+
+    @property
+    def time_to_results(self) -> Optional[float]:
+        if self.results_at is None:
+            return None
+        return self.results_at - self.submitted_at
+
+
+class AsyncEngine:
+    """Runs translation and query jobs on an event loop in a background thread.
+
+    Streamlit scripts submit jobs and poll them by id, so any number of tabs
+    can have work in flight without blocking the page.
+    """
+
+    def __init__(
+        self,
+        timeout_ms: Optional[int] = None,
+        result_cache: Optional[ResultCache] = None,
+        guard: Optional[QueryGuard] = None,
+        workload_log: Optional[WorkloadLog] = None,
+    ):
+        self.timeout_ms = timeout_ms or statement_timeout_ms()
+        self.result_cache = result_cache or ResultCache()
+        self.guard = guard or QueryGuard()
+        self.workload_log = workload_log
+        self.rollups = RollupRewriter()
+        self.cursors = ResultCursors()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="nlq-async-engine", daemon=True
+        )
+        self.thread.start()
+        self.loop.call_soon_threadsafe(self.prune_cursors)
+        self.pools = AsyncPoolRegistry()
+        # One client per API key, so questions reuse its HTTP connections
+        self.openai_clients: Dict[str, AsyncOpenAI] = {}
+        self.jobs: Dict[str, Job] = {}
+
+    def submit(self, kind: str, work: Callable[[Job], Awaitable[None]]) -> Job:
+        self.prune()
+        job = Job(id=uuid.uuid4().hex, kind=kind)
+        self.jobs[job.id] = job
+
+        def start() -> None:
+            job.task = self.loop.create_task(self._run(job, work))
+
+        self.loop.call_soon_threadsafe(start)
+        return job
+
+    async def _run(self, job: Job, work: Callable[[Job], Awaitable[None]]) -> None:
+        try:
+            # The task runs in its own context, so spans recorded anywhere
+            # below land on this job only.
+            with collect(job.spans):
+                await work(job)
+            if not job.done:
+                job.status = "done"
+        except asyncio.CancelledError:
+            # psycopg sends a cancel request to the backend when the task is
+            # cancelled mid-query, so the server stops working on it too.
+            job.status = "cancelled"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+
+    async def execute(
+        self,
+        job: Job,
+        params: ConnectionParams,
+        sql: str,
+        offset: int = 0,
+        force: bool = False,
+        cursor: Optional[str] = None,
+    ) -> None:
+        job.status = "running"
+        review = None
+        with span("db.execute") as execute_span:
+            if cursor is not None:
+                job.page = await self.cursors.next_page(cursor, offset)
+            if job.page is None:
+                pool = await self.pools.get(params)
+                # Checked out by hand: a page with more rows keeps the
+                # connection for its open cursor.
+                conn = await pool.getconn()
+                try:
+                    # Later pages reuse the SQL that was reviewed for the first one
+                    if offset == 0:
+                        # Aggregates a fresh rollup covers are answered from it
+                        job.rewrite = await self.rollups.rewrite_query_async(conn, sql)
+                        if job.rewrite is not None:
+                            sql = job.rewrite.sql
+                        review = await self.guard.review_async(conn, sql, force)
+                        job.sql, job.plan = review.sql, review.plan
+                        if review.verdict != "ok":
+                            job.status = review.verdict
+                            job.error = review.message
+                            return
+                    started = time.perf_counter()
+                    job.page = await cached_fetch_page_async(
+                        self.result_cache,
+                        conn,
+                        pool_name(params),
+                        job.sql,
+                        offset=offset,
+                        fetch=functools.partial(self.cursors.fetch_page, pool),
+                        estimate=False,
+                        timeout_ms=self.timeout_ms,
+                    )
+                finally:
+                    if job.page is None or job.page.cursor is None:
+                        await pool.putconn(conn)
+                if job.plan is not None and job.page.estimated_rows is None:
+                    job.page.estimated_rows = job.plan.estimated_rows
+            execute_span.set(rows=job.page.num_rows, bytes=job.page.table.nbytes)
+        job.results_at = time.time()
+        if review is not None and self.workload_log is not None:
+            await asyncio.to_thread(
+                self.workload_log.record,
+                pool_name(params),
+                job.sql,
+                time.perf_counter() - started,
+                job.page.num_rows,
+                review.raw_plan,
+            )
+
+    def prune_cursors(self) -> None:
+        # On a timer, so idle cursors release their connection and snapshot
+        # even when no job comes in.
+        self.loop.create_task(self.cursors.prune())
+        self.loop.call_later(CURSOR_PRUNE_INTERVAL, self.prune_cursors)
+
+    def openai_client(self, api_key: Optional[str]) -> AsyncOpenAI:
+        # Only called on the loop, which the client's connections are bound to
+        client = self.openai_clients.get(api_key or "")
+        if client is None:
+            client = AsyncOpenAI(api_key=api_key)
+            self.openai_clients[api_key or ""] = client
+        return client
+
+    def submit_question(
+        self,
+        params: ConnectionParams,
+        query: OpenAIQuery,
+        messages: List[Dict[str, str]],
+    ) -> Job:
+        async def work(job: Job) -> None:
+            def on_text(text: str) -> None:
+                if job.first_output_at is None:
+                    job.first_output_at = time.time()
+                job.sql = text
+
+            job.status = "translating"
+            query.async_client = self.openai_client(query.api_key)
+            job.messages = await query.nlq_conversation_async(list(messages), on_text)
+            job.sql = job.messages[-1]["content"]
+            if job.first_output_at is None:
+                job.first_output_at = time.time()
+            await self.execute(job, params, job.sql)
+
+        return self.submit("question", work)
+
+    def submit_query(
+        self,
+        params: ConnectionParams,
+        sql: str,
+        offset: int = 0,
+        force: bool = False,
+        cursor: Optional[str] = None,
+    ) -> Job:
+        """Run sql, or read its page at offset from the open cursor if given."""
+
+        async def work(job: Job) -> None:
+            job.sql = sql
+            await self.execute(job, params, sql, offset, force, cursor)
+
+        return self.submit("query", work)
+
+    def close_cursor(self, cursor: str) -> None:
+        def close() -> None:
+            self.loop.create_task(self.cursors.close(cursor))
+
+        self.loop.call_soon_threadsafe(close)
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    def pop(self, job_id: str) -> Optional[Job]:
+        return self.jobs.pop(job_id, None)
+
+    def cancel(self, job_id: str) -> None:
+        job = self.jobs.get(job_id)
+        if job is None or job.done:
+            return
+
+        # Callbacks run in submission order, so the task exists by now
+        def cancel_task() -> None:
+            if job.task is not None:
+                job.task.cancel()
+
+        self.loop.call_soon_threadsafe(cancel_task)
+
+    def prune(self) -> None:
+        # Drop results nobody collected, e.g. from closed browser sessions
+        cutoff = time.time() - FINISHED_JOB_TTL
+        for job_id, job in list(self.jobs.items()):
+            if job.done and (job.finished_at or 0) < cutoff:
+                self.jobs.pop(job_id, None)
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return self.pools.stats()
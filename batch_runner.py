@@ -0,0 +1,236 @@
+import asyncio
+import json
+import os
+import sys
+import time
+import backoff
+import openai
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from typing import Any, Dict, List, Optional, Set
+from connection_pool import AsyncPoolRegistry, ConnectionParams, pool_name
+from openai_query import OpenAIQuery
+from query_executor import max_result_rows, statement_timeout_ms
+from query_guard import QueryGuard
+from result_cache import ResultCache, cached_fetch_page_async
+from rollups import RollupRewriter
+from schema_service import SchemaSnapshot
+from workload_log import WorkloadLog
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+MAX_TRANSLATION_TRIES = 6
+RESULT_FIELDS = (
+    "id",
+    "question",
+    "sql",
+    "rollup",
+    "rows",
+    "truncated",
+    "columns",
+    "estimated_cost",
+    "translate_seconds",
+    "execute_seconds",
+    "total_seconds",
+    "error",
+    "error_stage",
+)
+
+
+def read_questions(path: str) -> List[Dict[str, Any]]:
+    questions = []
+    with open(path) as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"question": item}
+            item.setdefault("id", str(number))
+            item["id"] = str(item["id"])
+            questions.append(item)
+    return questions
+
+
+def read_results(path: str) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb+") as f:
+        data = f.read()
+        # A crash can leave a partial last line; cut it off so appended
+        # records start on a fresh line.
+        end = data.rfind(b"\n") + 1
+        if end != len(data):
+            f.truncate(end)
+    return [json.loads(line) for line in data[:end].decode().splitlines() if line]
+
+
+class BatchRunner:
+    """Answers a file of questions concurrently and records one result each.
+
+    Results are appended to a JSONL file as each question finishes, so an
+    interrupted run picks up where it stopped when started again with the
+    same output file.
+    """
+
+    def __init__(
+        self,
+        params: ConnectionParams,
+        openai_query: OpenAIQuery,
+        snapshot: SchemaSnapshot,
+        concurrency: int = 4,
+        force: bool = False,
+        result_cache: Optional[ResultCache] = None,
+        guard: Optional[QueryGuard] = None,
+        workload_log: Optional[WorkloadLog] = None,
+    ):
+        self.params = params
+        self.openai_query = openai_query
+        self.system_message = openai_query.create_system_message(snapshot.format())
+        self.concurrency = concurrency
+        self.force = force
+        self.result_cache = result_cache or ResultCache()
+        self.guard = guard or QueryGuard()
+        self.workload_log = workload_log
+        self.rollups = RollupRewriter()
+        self.pools = AsyncPoolRegistry()
+
+    @backoff.on_exception(
+        backoff.expo, RETRYABLE_ERRORS, max_tries=MAX_TRANSLATION_TRIES, max_value=60
+    )
+    async def translate(self, question: str) -> str:
+        query_log = [dict(self.system_message)]
+        self.openai_query.update_system_message(query_log, question)
+        query_log.append({"role": "user", "content": question})
+        query_log = await self.openai_query.nlq_conversation_async(query_log)
+        return query_log[-1]["content"]
+
+    async def execute(self, sql: str, record: Dict[str, Any]) -> None:
+        pool = await self.pools.get(self.params)
+        async with pool.connection() as conn:
+            rewrite = await self.rollups.rewrite_query_async(conn, sql)
+            if rewrite is not None:
+                record["rollup"] = rewrite.rollup
+                sql = rewrite.sql
+            review = await self.guard.review_async(conn, sql, self.force)
+            record["sql"] = review.sql
+            if review.plan is not None:
+                record["estimated_cost"] = review.plan.total_cost
+            if review.verdict != "ok":
+                record["error"] = review.message
+                record["error_stage"] = "guard"
+                return
+            started = time.perf_counter()
+            page = await cached_fetch_page_async(
+                self.result_cache,
+                conn,
+                pool_name(self.params),
+                review.sql,
+                limit=max_result_rows(),
+                estimate=False,
+                timeout_ms=statement_timeout_ms(),
+            )
+        record["rows"] = page.num_rows
+        record["truncated"] = page.has_more
+        record["columns"] = page.column_names
+        if self.workload_log is not None:
+            await asyncio.to_thread(
+                self.workload_log.record,
+                pool_name(self.params),
+                review.sql,
+                time.perf_counter() - started,
+                page.num_rows,
+                review.raw_plan,
+            )
+
+    async def answer(
+        self,
+        item: Dict[str, Any],
+        llm_slots: asyncio.Semaphore,
+        db_slots: asyncio.Semaphore,
+    ) -> Dict[str, Any]:
+        record = dict.fromkeys(RESULT_FIELDS)
+        record.update(id=item["id"], question=item["question"])
+        start = time.perf_counter()
+        stage = "translate"
+        try:
+            async with llm_slots:
+                sql = await self.translate(item["question"])
+            record["sql"] = sql
+            record["translate_seconds"] = round(time.perf_counter() - start, 3)
+            stage = "execute"
+            executed = time.perf_counter()
+            async with db_slots:
+                await self.execute(sql, record)
+            record["execute_seconds"] = round(time.perf_counter() - executed, 3)
+        except Exception as e:
+            # Recorded per question: an exception escaping here would end
+            # the run and cancel every question still in flight.
+            record["error"] = str(e) or type(e).__name__
+            record["error_stage"] = stage
+        record["total_seconds"] = round(time.perf_counter() - start, 3)
+        return record
+
+    async def run(
+        self,
+        questions_path: str,
+        output_path: str,
+        parquet_path: Optional[str] = None,
+        retry_failed: bool = False,
+    ) -> None:
+        questions = read_questions(questions_path)
+        previous = read_results(output_path)
+        done: Set[str] = {
+            record["id"]
+            for record in previous
+            if not (retry_failed and record.get("error"))
+        }
+        pending = [item for item in questions if item["id"] not in done]
+        print(
+            f"{len(questions)} questions, {len(questions) - len(pending)} already "
+            f"answered, {len(pending)} to go.",
+            file=sys.stderr,
+        )
+
+        # Waiting here rather than in the pool keeps queued queries from
+        # running into the pool timeout.
+        llm_slots = asyncio.Semaphore(self.concurrency)
+        db_slots = asyncio.Semaphore(self.pools.max_size)
+        tasks = [
+            asyncio.create_task(self.answer(item, llm_slots, db_slots))
+            for item in pending
+        ]
+        try:
+            with open(output_path, "a") as output:
+                for finished, task in enumerate(asyncio.as_completed(tasks), start=1):
+                    record = await task
+                    output.write(json.dumps(record) + "\n")
+                    output.flush()
+                    status = (
+                        f"{record['error_stage']} error"
+                        if record["error"]
+                        else f"{record['rows']} rows"
+                    )
+                    print(
+                        f"[{finished}/{len(pending)}] {record['id']}: {status} "
+                        f"in {record['total_seconds']:.2f}s",
+                        file=sys.stderr,
+                    )
+        finally:
+            for task in tasks:
+                task.cancel()
+            await self.pools.close_all()
+
+        if parquet_path is not None:
+            self.write_parquet(output_path, parquet_path)
+
+    @staticmethod
+    def write_parquet(output_path: str, parquet_path: str) -> None:
+        # Later records for the same id (retries) replace earlier ones
+        records = {record["id"]: record for record in read_results(output_path)}
+        pq.write_table(pa.Table.from_pylist(list(records.values())), parquet_path)
@@ -0,0 +1,121 @@
+"""Compare the row-based and Arrow result formatters on wide numeric results.
+
+Run with ``python -m benchmarks.formatters``. With ``--db`` the same
+comparison is made end to end against the database configured in ``.env``:
+``fetchall`` plus the row formatters versus the streaming Arrow fetch.
+"""
+
+import argparse
+import os
+import random
+import time
+import tracemalloc
+import psycopg
+import pyarrow as pa
+
+from typing import Any, Callable, Dict, List
+from dotenv import load_dotenv
+from query_executor import FETCH_BATCH_SIZE, fetch_page
+from utils import (
+    arrow_to_dataframe,
+    arrow_to_dicts,
+    format_as_arrow,
+    format_as_dataframe,
+    format_as_dict,
+)
+
+
+def make_rows(rows: int, columns: int) -> List[tuple]:
+    rng = random.Random(0)
+    return [tuple(rng.random() for _ in range(columns)) for _ in range(rows)]
+
+
+def to_arrow(rows: List[tuple], column_names: List[str]) -> pa.Table:
+    schema = pa.schema([(name, pa.float64()) for name in column_names])
+    batches = [
+        format_as_arrow(rows[i : i + FETCH_BATCH_SIZE], column_names, schema)
+        for i in range(0, len(rows), FETCH_BATCH_SIZE)
+    ]
+    return pa.Table.from_batches(batches, schema=schema)
+
+
+def measure(fn: Callable[[], Any]) -> Dict[str, float]:
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+
+    # Memory is measured on a second run because tracemalloc slows down
+    # allocation-heavy code. Arrow buffers are not seen by tracemalloc, so
+    # add what the Arrow memory pool still holds for the result.
+    arrow_before = pa.total_allocated_bytes()
+    tracemalloc.start()
+    result = fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    arrow_bytes = pa.total_allocated_bytes() - arrow_before
+    del result
+    return {
+        "seconds": round(elapsed, 4),
+        "peak_mb": round((peak + max(arrow_bytes, 0)) / 2**20, 1),
+    }
+
+
+def run(rows: int, columns: int) -> Dict[str, Dict[str, float]]:
+    data = make_rows(rows, columns)
+    names = [f"c{i}" for i in range(columns)]
+    table = to_arrow(data, names)
+    return {
+        "rows_to_dataframe": measure(lambda: format_as_dataframe(data, names)),
+        "rows_to_arrow": measure(lambda: to_arrow(data, names)),
+        "arrow_to_dataframe": measure(lambda: arrow_to_dataframe(table)),
+        "rows_to_dicts": measure(lambda: format_as_dict(data, names)),
+        "arrow_to_dicts": measure(lambda: arrow_to_dicts(table)),
+    }
+
+
+def run_db(rows: int, columns: int) -> Dict[str, Dict[str, float]]:
+    load_dotenv()
+    select_list = ", ".join(f"g * {i + 1}::float8 AS c{i}" for i in range(columns))
+    query = f"SELECT {select_list} FROM generate_series(1, {rows}) AS g"
+    conn = psycopg.connect(
+        host=os.getenv("DB_HOST"),
+        port=os.getenv("DB_PORT"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        dbname=os.getenv("DB_NAME"),
+    )
+
+    def fetchall_dataframe():
+        with conn.transaction():
+            cursor = conn.execute(query)
+            names = [desc[0] for desc in cursor.description]
+            return format_as_dataframe(cursor.fetchall(), names)
+
+    def arrow_dataframe():
+        page = fetch_page(conn, query, limit=rows, estimate=False)
+        return arrow_to_dataframe(page.table)
+
+    try:
+        return {
+            "db_fetchall_dataframe": measure(fetchall_dataframe),
+            "db_arrow_dataframe": measure(arrow_dataframe),
+        }
+    finally:
+        conn.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--columns", type=int, default=50)
+    parser.add_argument("--db", action="store_true")
+    args = parser.parse_args()
+    results = run(args.rows, args.columns)
+    if args.db:
+        results.update(run_db(args.rows, args.columns))
+    for name, result in results.items():
+        print(f"{name:>22}: {result['seconds']:.3f}s, peak {result['peak_mb']} MB")
+
+
+if __name__ == "__main__":
+    main()
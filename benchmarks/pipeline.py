@@ -0,0 +1,425 @@
+"""Benchmark the NLQ pipeline offline and write the results as JSON.
+
+Runs against the database configured in ``.env`` and a local stub of the
+OpenAI API (see ``benchmarks/stub_openai.py``), so no API key is needed.
+Measures generator and seeding throughput, schema introspection, prompt
+size, query execution plus formatting across result sizes, and question
+latency with several sessions asking at once:
+
+    python -m benchmarks.pipeline -o report.json
+    python -m benchmarks.pipeline -o new.json --baseline report.json
+
+Benchmark tables are named ``bench_*`` and dropped afterwards unless
+``--keep`` is given.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+from dotenv import load_dotenv
+from psycopg import sql
+from benchmarks.formatters import measure
+from benchmarks.stub_openai import TOKEN_MODEL, StubOpenAI
+
+GENERATOR_NAMES = ("oil_data", "mining_data", "production_data")
+OIL_TABLE = "bench_oil_data"
+PRODUCTION_TABLE = "bench_production"
+RESULT_SIZES = (1_000, 10_000, 100_000)
+SESSION_COUNTS = (1, 4, 16)
+
+# Questions the stub answers, in the shapes analysts ask most
+QUESTIONS = {
+    "total gas production by region": (
+        f"SELECT region, SUM(gas_production_mcf) AS total_gas FROM {OIL_TABLE} "
+        "GROUP BY region ORDER BY total_gas DESC;"
+    ),
+    "how many active wells does each company have": (
+        f"SELECT company, COUNT(*) AS wells FROM {OIL_TABLE} "
+        "WHERE status = 'Active' GROUP BY company ORDER BY wells DESC LIMIT 20;"
+    ),
+    "top 10 wells by oil production": (
+        f"SELECT well_name, oil_production_bbl FROM {OIL_TABLE} "
+        "ORDER BY oil_production_bbl DESC LIMIT 10;"
+    ),
+    "average oil production of inactive wells per region": (
+        f"SELECT region, AVG(oil_production_bbl) AS avg_oil FROM {OIL_TABLE} "
+        "WHERE status = 'Inactive' GROUP BY region;"
+    ),
+    "wells owned by people in texas": (
+        f"SELECT well_name, owner FROM {OIL_TABLE} WHERE region = 'Texas' LIMIT 100;"
+    ),
+}
+
+
+def timed(fn: Callable[[], Any], repeat: int = 1) -> Dict[str, float]:
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {
+        "seconds": round(statistics.median(runs), 4),
+        "min_seconds": round(min(runs), 4),
+    }
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def quietly(fn: Callable[[], Any]) -> Any:
+    # Seeder and CLI progress output would drown the benchmark's own
+    with contextlib.redirect_stdout(io.StringIO()):
+        return fn()
+
+
+def build_generator(name: str, workers: Optional[int]) -> Any:
+    if name == "oil_data":
+        from db.generators.oil_data import OilDataGenerator
+
+        return OilDataGenerator(seed=42, workers=workers)
+    if name == "mining_data":
+        from db.generators.mining_data import MiningDataGenerator
+
+        return MiningDataGenerator(seed=42, workers=workers)
+    from db.generators.production_data import ProductionDataGenerator
+
+    return ProductionDataGenerator(seed=42, wells=1_000, workers=workers)
+
+
+def bench_generators(rows: int, workers: Optional[int]) -> List[Dict[str, Any]]:
+    results = []
+    for name in GENERATOR_NAMES:
+        generator = build_generator(name, workers)
+        result = timed(lambda: sum(len(chunk) for chunk in generator.iter_csv(rows)))
+        result.update(
+            generator=name,
+            rows=rows,
+            rows_per_sec=round(rows / result["seconds"]),
+        )
+        results.append(result)
+    return results
+
+
+def bench_seeding(rows: int, workers: Optional[int]) -> List[Dict[str, Any]]:
+    from db.seed import Seeder
+
+    results = []
+    for table, name, table_rows in (
+        (OIL_TABLE, "oil_data", rows),
+        (PRODUCTION_TABLE, "production_data", rows * 2),
+    ):
+        seeder = Seeder(build_generator(name, workers), load_workers=workers)
+        result = timed(lambda: quietly(lambda: seeder.seed(table, table_rows)))
+        result.update(
+            table=table,
+            generator=name,
+            rows=table_rows,
+            rows_per_sec=round(table_rows / result["seconds"]),
+        )
+        results.append(result)
+    return results
+
+
+def bench_schema(app: Any, repeat: int) -> Dict[str, Any]:
+    from schema_service import SchemaService
+
+    with app.pool.connection() as conn:
+        result = timed(lambda: SchemaService.introspect(conn), repeat)
+    snapshot = app.snapshot
+    result.update(
+        tables=len(snapshot.tables),
+        columns=sum(len(columns) for columns in snapshot.tables.values()),
+    )
+    return result
+
+
+def bench_prompt(app: Any) -> Dict[str, Any]:
+    from conversation_history import ConversationHistory
+
+    history = ConversationHistory(TOKEN_MODEL)
+    query = app.openai_query
+    full = query.create_system_message(app.snapshot.format())
+
+    def build(question: str) -> Dict[str, str]:
+        log = [dict(full)]
+        query.update_system_message(log, question)
+        return log[0]
+
+    pruned = [build(question) for question in QUESTIONS]
+    result = timed(lambda: [build(question) for question in QUESTIONS], 5)
+    result["seconds"] = round(result["seconds"] / len(QUESTIONS), 6)
+    del result["min_seconds"]
+    result.update(
+        full_chars=len(full["content"]),
+        full_tokens=history.count(full["content"]),
+        pruned_chars=round(statistics.mean(len(m["content"]) for m in pruned)),
+        pruned_tokens=round(
+            statistics.mean(history.count(m["content"]) for m in pruned)
+        ),
+    )
+    return result
+
+
+def bench_execute(app: Any, sizes: List[int]) -> List[Dict[str, Any]]:
+    from query_executor import max_result_rows
+    from result_cache import ResultCache
+    from utils import arrow_to_dataframe, arrow_to_dicts
+
+    # Every run goes to the database; a cache hit would time the cache
+    app.result_cache = ResultCache(ttl=0)
+    # The CLI stops at NLQ_MAX_RESULT_ROWS, which would cap the larger sizes
+    os.environ["NLQ_MAX_RESULT_ROWS"] = str(max(sizes + [max_result_rows()]))
+    formatters = {
+        "arrow": None,
+        "dataframe": arrow_to_dataframe,
+        "dicts": arrow_to_dicts,
+    }
+
+    def fail(message: str) -> None:
+        raise RuntimeError(message)
+
+    results = []
+    for rows in sizes:
+        query = f"SELECT * FROM {OIL_TABLE} LIMIT {rows};"
+        for name, formatter in formatters.items():
+            returned: List[int] = []
+
+            def execute() -> Any:
+                output = app.execute_query_and_fetch_results(query, formatter, fail)
+                returned.append(len(output))
+                return output
+
+            result = quietly(lambda: measure(execute))
+            # The rows actually fetched, which the guard's LIMIT may lower
+            result.update(requested_rows=rows, rows=returned[-1], formatter=name)
+            results.append(result)
+    return results
+
+
+def bench_sessions(
+    app: Any, sessions: List[int], questions_per_session: int
+) -> List[Dict[str, Any]]:
+    from async_engine import AsyncEngine
+    from openai_query import OpenAIQuery
+    from result_cache import ResultCache
+    from sql_validator import SQLValidator
+
+    engine = AsyncEngine(result_cache=ResultCache(ttl=0))
+    params = app.connection_params()
+    index = app.snapshot.build_index()
+    validator = SQLValidator(app.snapshot.tables)
+    questions = list(QUESTIONS)
+
+    def ask(session: int) -> List[Dict[str, Optional[float]]]:
+        # Each session is one tab asking its questions one after another
+        query = OpenAIQuery(
+            "stub-key",
+            schema_fingerprint=app.snapshot.fingerprint,
+            schema_index=index,
+            validator=validator,
+        )
+        timings = []
+        for number in range(questions_per_session):
+            question = questions[(session + number) % len(questions)]
+            messages = [query.create_system_message(app.snapshot.format())]
+            query.update_system_message(messages, question)
+            messages.append({"role": "user", "content": question})
+            job = engine.submit_question(params, query, messages)
+            while not job.done:
+                time.sleep(0.005)
+            timings.append(
+                {
+                    "status": job.status,
+                    "seconds": job.elapsed,
+                    "first_output": job.time_to_first_output,
+                    "results": job.time_to_results,
+                }
+            )
+        return timings
+
+    results = []
+    for count in sessions:
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            timings = [t for ts in executor.map(ask, range(count)) for t in ts]
+        wall = time.perf_counter() - start
+        done = [t for t in timings if t["status"] == "done"]
+        latencies = [t["seconds"] for t in done] or [float("nan")]
+        results.append(
+            {
+                "sessions": count,
+                "questions": len(timings),
+                "failed": len(timings) - len(done),
+                "p50_seconds": round(percentile(latencies, 0.5), 4),
+                "p95_seconds": round(percentile(latencies, 0.95), 4),
+                "mean_first_output_seconds": round(
+                    statistics.mean(t["first_output"] or 0 for t in done or timings),
+                    4,
+                ),
+                "questions_per_sec": round(len(done) / wall, 2),
+            }
+        )
+    asyncio.run_coroutine_threadsafe(engine.pools.close_all(), engine.loop).result()
+    engine.loop.call_soon_threadsafe(engine.loop.stop)
+    return results
+
+
+def environment(app: Any) -> Dict[str, Any]:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    with app.pool.connection() as conn:
+        server = conn.execute("SHOW server_version").fetchone()[0]
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "postgres": server,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def drop_tables(app: Any) -> None:
+    from rollups import RollupManager
+
+    with app.pool.connection() as conn:
+        for table in (OIL_TABLE, PRODUCTION_TABLE):
+            RollupManager().drop(conn, table)
+            conn.execute(
+                sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table))
+            )
+
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Changes in the timing and throughput figures of two reports."""
+
+    def flatten(value: Any, path: str) -> Dict[str, float]:
+        if isinstance(value, dict):
+            # Entries of a list are named by their non-numeric fields
+            return {
+                k: v
+                for key, item in value.items()
+                for k, v in flatten(item, f"{path}.{key}").items()
+            }
+        if isinstance(value, list):
+            flat = {}
+            for item in value:
+                label = ",".join(
+                    f"{k}={v}"
+                    for k, v in item.items()
+                    if isinstance(v, str) or k in ("rows", "sessions")
+                )
+                flat.update(flatten(item, f"{path}[{label}]"))
+            return flat
+        if isinstance(value, (int, float)) and path.endswith(
+            ("seconds", "per_sec", "peak_mb")
+        ):
+            return {path: value}
+        return {}
+
+    new = flatten(report["results"], "")
+    old = flatten(baseline["results"], "")
+    lines = []
+    for key in sorted(new.keys() & old.keys()):
+        if old[key] and new[key] == new[key]:
+            change = new[key] / old[key] - 1
+            lines.append(f"{key[1:]}: {old[key]} → {new[key]} ({change:+.0%})")
+    return lines
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("-o", "--output", default="bench_report.json")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    parser.add_argument("--rows", type=int, default=200_000)
+    parser.add_argument("--workers", type=int, help="generator and loader processes")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--result-sizes", type=int, nargs="+", default=list(RESULT_SIZES)
+    )
+    parser.add_argument("--sessions", type=int, nargs="+", default=list(SESSION_COUNTS))
+    parser.add_argument("--questions-per-session", type=int, default=5)
+    parser.add_argument("--first-token-latency", type=float, default=0.2)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--completion-tokens", type=int)
+    parser.add_argument("--keep", action="store_true", help="keep the bench_* tables")
+    args = parser.parse_args()
+
+    load_dotenv()
+    # Translations, workload and result spills of the run stay out of the
+    # app's data directory, and the translation cache starts empty.
+    os.environ["NLQ_DATA_DIR"] = tempfile.mkdtemp(prefix="nlq-bench-")
+    stub = StubOpenAI(
+        QUESTIONS,
+        first_token_latency=args.first_token_latency,
+        token_latency=args.token_latency,
+        completion_tokens=args.completion_tokens,
+    ).start()
+    os.environ["OPENAI_BASE_URL"] = stub.base_url
+    os.environ.setdefault("OPENAI_API_KEY", "stub-key")
+
+    from database_query import DatabaseQuery
+
+    report: Dict[str, Any] = {"config": vars(args), "results": {}}
+    results = report["results"]
+    app = DatabaseQuery()
+    app.connect_to_database()
+    try:
+        report["environment"] = environment(app)
+        print("Generators…")
+        results["generators"] = bench_generators(args.rows, args.workers)
+        print("Seeding…")
+        results["seeding"] = bench_seeding(args.rows, args.workers)
+        app.schema_service.invalidate(app.pool)
+        app.fetch_schema()
+        print("Schema introspection…")
+        results["schema"] = bench_schema(app, args.repeat)
+        print("Prompt…")
+        results["prompt"] = bench_prompt(app)
+        print("Execute and format…")
+        results["execute"] = bench_execute(app, args.result_sizes)
+        print("Concurrent sessions…")
+        results["sessions"] = bench_sessions(
+            app, args.sessions, args.questions_per_session
+        )
+        report["stub_requests"] = stub.requests
+    finally:
+        if not args.keep:
+            drop_tables(app)
+        app.pools.close_all()
+        stub.stop()
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(results, indent=2))
+    print(f"Report written to {args.output}")
+    if args.baseline:
+        with open(args.baseline) as f:
+            print("\n".join(compare(report, json.load(f))))
+
+
+if __name__ == "__main__":
+    main()
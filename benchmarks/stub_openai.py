@@ -0,0 +1,216 @@
+"""A local stand-in for the OpenAI chat completions API.
+
+Answers each question with canned SQL after a configurable delay, streamed
+or not, and reports configurable token counts, so the NLQ pipeline can be
+benchmarked without an API key. Point the OpenAI client at it with
+``OPENAI_BASE_URL=http://127.0.0.1:<port>/v1``.
+
+Run on its own with ``python -m benchmarks.stub_openai --port 8765``.
+"""
+
+import argparse
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional
+from conversation_history import ConversationHistory
+
+DEFAULT_SQL = "SELECT 1;"
+# Tokenizer used to count prompt tokens when prompt_tokens is not set
+TOKEN_MODEL = "gpt-3.5-turbo"
+
+
+class StubOpenAI:
+    """Chat completions server answering from a question → SQL mapping.
+
+    The first token arrives after first_token_latency seconds and each
+    further one token_latency seconds later. The SQL is split into
+    completion_tokens chunks when that is set, otherwise into words;
+    prompt_tokens defaults to a local count of the request messages.
+    """
+
+    def __init__(
+        self,
+        responses: Optional[Dict[str, str]] = None,
+        default_sql: str = DEFAULT_SQL,
+        first_token_latency: float = 0.2,
+        token_latency: float = 0.01,
+        prompt_tokens: Optional[int] = None,
+        completion_tokens: Optional[int] = None,
+        port: int = 0,
+    ):
+        self.responses = {
+            self.normalize(question): sql for question, sql in (responses or {}).items()
+        }
+        self.default_sql = default_sql
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.history = ConversationHistory(TOKEN_MODEL)
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), self.handler())
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}/v1"
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        return " ".join(question.lower().split())
+
+    def answer(self, messages: List[Dict[str, str]]) -> str:
+        questions = [m["content"] for m in messages if m["role"] == "user"]
+        if not questions:
+            return self.default_sql
+        return self.responses.get(self.normalize(questions[-1]), self.default_sql)
+
+    def chunks(self, text: str) -> List[str]:
+        if not self.completion_tokens:
+            words = text.split(" ")
+            return [words[0]] + [" " + word for word in words[1:]]
+        size = -(-len(text) // self.completion_tokens)
+        return [text[i : i + size] for i in range(0, len(text), size)]
+
+    def usage(
+        self, messages: List[Dict[str, str]], chunks: List[str]
+    ) -> Dict[str, int]:
+        prompt = self.prompt_tokens or self.history.count_messages(messages)
+        return {
+            "prompt_tokens": prompt,
+            "completion_tokens": len(chunks),
+            "total_tokens": prompt + len(chunks),
+        }
+
+    def handler(self) -> type:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                stub.requests += 1
+                messages = request.get("messages", [])
+                chunks = stub.chunks(stub.answer(messages))
+                time.sleep(stub.first_token_latency)
+                if request.get("stream"):
+                    self.stream(request, chunks)
+                else:
+                    time.sleep(stub.token_latency * (len(chunks) - 1))
+                    self.send_json(
+                        {
+                            "id": "chatcmpl-stub",
+                            "object": "chat.completion",
+                            "created": int(time.time()),
+                            "model": request.get("model", "stub"),
+                            "choices": [
+                                {
+                                    "index": 0,
+                                    "message": {
+                                        "role": "assistant",
+                                        "content": "".join(chunks),
+                                    },
+                                    "finish_reason": "stop",
+                                }
+                            ],
+                            "usage": stub.usage(messages, chunks),
+                        }
+                    )
+
+            def stream(self, request: Dict[str, Any], chunks: List[str]) -> None:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for index, chunk in enumerate(chunks):
+                        if index:
+                            time.sleep(stub.token_latency)
+                        self.send_event(
+                            {
+                                "id": "chatcmpl-stub",
+                                "object": "chat.completion.chunk",
+                                "created": int(time.time()),
+                                "model": request.get("model", "stub"),
+                                "choices": [
+                                    {
+                                        "index": 0,
+                                        "delta": {"content": chunk},
+                                        "finish_reason": None,
+                                    }
+                                ],
+                            }
+                        )
+                    self.send_event("[DONE]")
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stops reading once it has a whole statement
+                    pass
+
+            def send_event(self, data: Any) -> None:
+                text = data if isinstance(data, str) else json.dumps(data)
+                event = f"data: {text}\n\n".encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(event), event))
+                self.wfile.flush()
+
+            def send_json(self, data: Dict[str, Any]) -> None:
+                body = json.dumps(data).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        return Handler
+
+    def start(self) -> "StubOpenAI":
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, name="stub-openai", daemon=True
+        )
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--responses", help='JSON file mapping questions to SQL, {"question": "SQL"}'
+    )
+    parser.add_argument("--default-sql", default=DEFAULT_SQL)
+    parser.add_argument("--first-token-latency", type=float, default=0.2)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--prompt-tokens", type=int)
+    parser.add_argument("--completion-tokens", type=int)
+    args = parser.parse_args()
+    responses = None
+    if args.responses:
+        with open(args.responses) as f:
+            responses = json.load(f)
+    stub = StubOpenAI(
+        responses,
+        args.default_sql,
+        args.first_token_latency,
+        args.token_latency,
+        args.prompt_tokens,
+        args.completion_tokens,
+        args.port,
+    )
+    print(f"Serving chat completions at {stub.base_url}")
+    stub.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
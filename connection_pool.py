@@ -0,0 +1,134 @@
+import asyncio
+import os
+import threading
+import psycopg
+
+from typing import Any, Dict, Optional, Tuple
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
+
+ConnectionParams = Dict[str, Any]
+
+
+def pool_key(params: ConnectionParams) -> Tuple:
+    return tuple(sorted((key, str(value)) for key, value in params.items()))
+
+
+def pool_name(params: ConnectionParams) -> str:
+    return (
+        f"{params.get('user')}@{params.get('host')}:"
+        f"{params.get('port')}/{params.get('dbname')}"
+    )
+
+
+class PoolRegistry:
+    def __init__(
+        self,
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ):
+        self.min_size = (
+            min_size if min_size is not None else int(os.getenv("DB_POOL_MIN_SIZE", 1))
+        )
+        self.max_size = (
+            max_size if max_size is not None else int(os.getenv("DB_POOL_MAX_SIZE", 10))
+        )
+        self.timeout = (
+            timeout if timeout is not None else float(os.getenv("DB_POOL_TIMEOUT", 30))
+        )
+        self._pools: Dict[Tuple, ConnectionPool] = {}
+        self._lock = threading.Lock()
+
+    def get(self, params: ConnectionParams) -> ConnectionPool:
+        key = pool_key(params)
+        with self._lock:
+            pool = self._pools.get(key)
+        if pool is not None:
+            return pool
+
+        # Connect once up front so bad credentials surface as a psycopg.Error
+        # instead of a pool timeout. Outside the lock, so an unreachable host
+        # does not hold up every other session.
+        psycopg.connect(**params, connect_timeout=int(self.timeout)).close()
+        pool = ConnectionPool(
+            kwargs=dict(params),
+            min_size=self.min_size,
+            max_size=max(self.max_size, self.min_size),
+            timeout=self.timeout,
+            check=ConnectionPool.check_connection,
+            name=pool_name(params),
+            open=True,
+        )
+        with self._lock:
+            existing = self._pools.setdefault(key, pool)
+        if existing is not pool:
+            # Another session created the same pool meanwhile
+            pool.close()
+        return existing
+
+    def close(self, params: ConnectionParams) -> None:
+        with self._lock:
+            pool = self._pools.pop(pool_key(params), None)
+        if pool is not None:
+            pool.close()
+
+    def close_all(self) -> None:
+        with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            pool.close()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {pool.name: pool.get_stats() for pool in self._pools.values()}
+
+
+class AsyncPoolRegistry:
+    # Pools are bound to the event loop they were opened on, so a registry
+    # must only be used from a single loop.
+    def __init__(
+        self,
+        min_size: Optional[int] = None,
+        max_size: Optional[int] = None,
+        timeout: Optional[float] = None,
+    ):
+        self.min_size = (
+            min_size if min_size is not None else int(os.getenv("DB_POOL_MIN_SIZE", 1))
+        )
+        self.max_size = (
+            max_size if max_size is not None else int(os.getenv("DB_POOL_MAX_SIZE", 10))
+        )
+        self.timeout = (
+            timeout if timeout is not None else float(os.getenv("DB_POOL_TIMEOUT", 30))
+        )
+        self._pools: Dict[Tuple, AsyncConnectionPool] = {}
+        self._lock = asyncio.Lock()
+
+    async def get(self, params: ConnectionParams) -> AsyncConnectionPool:
+        key = pool_key(params)
+        async with self._lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = AsyncConnectionPool(
+                    kwargs=dict(params),
+                    min_size=self.min_size,
+                    max_size=max(self.max_size, self.min_size),
+                    timeout=self.timeout,
+                    check=AsyncConnectionPool.check_connection,
+                    name=f"{pool_name(params)} (async)",
+                    open=False,
+                )
+                await pool.open()
+                self._pools[key] = pool
+            return pool
+
+    async def close_all(self) -> None:
+        async with self._lock:
+            pools = list(self._pools.values())
+            self._pools.clear()
+        for pool in pools:
+            await pool.close()
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {pool.name: pool.get_stats() for pool in list(self._pools.values())}
@@ -0,0 +1,121 @@
+import os
+import sqlglot
+
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional
+from sqlglot import exp
+
+Message = Dict[str, str]
+
+# Per-message framing overhead of the chat format, and the tokens that prime
+# the assistant's reply.
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+SUMMARY_MAX_ITEMS = 5
+SUMMARY_ITEM_CHARS = 80
+SUMMARY_TOKEN_RESERVE = 200
+SUMMARY_SCAN_TURNS = 20
+# Texts whose token counts are remembered per model
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=8)
+def get_token_counter(model_id: str) -> Callable[[str], int]:
+    # Memoized per process, not per history: the app builds a new history
+    # for every question, and earlier turns are recounted each time.
+    try:
+        import tiktoken
+
+        encoding = tiktoken.encoding_for_model(model_id)
+        count = lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception:
+        # tiktoken is missing, or cannot download its encoding offline; about
+        # four characters per token is close enough for budgeting.
+        count = lambda text: (len(text) + 3) // 4
+    return lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)(count)
+
+
+def summarize_turns(turns: List[Message]) -> Optional[str]:
+    """Describe the tables and filters that earlier SQL answers settled on."""
+    questions, tables, filters = [], [], []
+    for message in turns:
+        if message["role"] == "user":
+            questions.append(" ".join(message["content"].split()))
+            continue
+        try:
+            tree = sqlglot.parse_one(message["content"].strip(), read="postgres")
+        except sqlglot.errors.ParseError:
+            continue
+        if tree is None:
+            continue
+        ctes = {cte.alias_or_name for cte in tree.find_all(exp.CTE)}
+        for table in tree.find_all(exp.Table):
+            if table.name and table.name not in ctes:
+                tables.append(table.name)
+        for where in tree.find_all(exp.Where):
+            filters.append(where.this.sql("postgres"))
+
+    def recent(items: List[str]) -> List[str]:
+        # Most recent first, without duplicates
+        items = [item[:SUMMARY_ITEM_CHARS] for item in reversed(items)]
+        return list(dict.fromkeys(items))[:SUMMARY_MAX_ITEMS]
+
+    parts = []
+    if questions:
+        parts.append("earlier questions: " + "; ".join(recent(questions)))
+    if tables:
+        parts.append("tables used: " + ", ".join(recent(tables)))
+    if filters:
+        parts.append("filters used: " + "; ".join(recent(filters)))
+    if not parts:
+        return None
+    return "Summary of the earlier conversation, " + ". ".join(parts) + "."
+
+
+class ConversationHistory:
+    """Fits a query log into a token budget before it is sent to the model.
+
+    The system message and the newest question are always sent. Earlier
+    turns are added newest first while they fit; the rest are replaced by a
+    one-message summary, so prompt size stays flat however long a tab runs.
+    """
+
+    def __init__(self, model_id: str, token_budget: Optional[int] = None):
+        self.count = get_token_counter(model_id)
+        self.token_budget = token_budget or int(
+            os.getenv("NLQ_HISTORY_TOKEN_BUDGET", 2000)
+        )
+
+    def count_message(self, message: Message) -> int:
+        return MESSAGE_OVERHEAD + self.count(message["content"])
+
+    def count_messages(self, messages: List[Message]) -> int:
+        return REPLY_OVERHEAD + sum(self.count_message(m) for m in messages)
+
+    def fit(self, query_log: List[Message]) -> List[Message]:
+        if len(query_log) <= 2 or self.count_messages(query_log) <= self.token_budget:
+            return query_log
+
+        head = query_log[:1] if query_log[0]["role"] == "system" else []
+        turns = query_log[len(head) : -1]
+        latest = query_log[-1:]
+        used = self.count_messages(head + latest)
+
+        # Keep whole question/answer pairs, newest first, reserving room for
+        # the summary of whatever is dropped.
+        kept = len(turns)
+        while kept > 0:
+            start = kept - 2 if kept >= 2 else kept - 1
+            cost = sum(self.count_message(m) for m in turns[start:kept])
+            if used + cost + SUMMARY_TOKEN_RESERVE > self.token_budget:
+                break
+            used += cost
+            kept = start
+
+        messages = list(head)
+        summary = summarize_turns(turns[:kept][-SUMMARY_SCAN_TURNS:])
+        if summary is not None:
+            summary_message = {"role": "system", "content": summary}
+            if used + self.count_message(summary_message) <= self.token_budget:
+                messages.append(summary_message)
+        return messages + turns[kept:] + latest
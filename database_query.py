@@ -1,76 +1,114 @@
+import argparse
+import asyncio
+import time
 import psycopg
-import json
 import os
+import pyarrow as pa
 
+from batch_runner import BatchRunner
+from index_advisor import IndexAdvisor
+from connection_pool import ConnectionParams, PoolRegistry
 from openai_query import OpenAIQuery
-from utils import format_as_dict
-from typing import Callable, List, Any, Optional
+from query_executor import max_result_rows
+from query_guard import QueryGuard
+from result_cache import ResultCache, cached_fetch_page
+from rollups import RollupManager, RollupRewriter
+from schema_service import SchemaService
+from sql_validator import SQLValidationError, SQLValidator
+from translation_cache import TranslationCache
+from utils import arrow_to_dicts
+from workload_log import WorkloadLog
+from typing import Callable, Any, Optional
 from dotenv import load_dotenv
-
-load_dotenv()
+from instrumentation import serve_metrics, span
 
 
 class DatabaseQuery:
     def __init__(self):
-        self.conn = None
-        self.cursor = None
+        self.pools = PoolRegistry()
+        self.pool = None
         self.schema = None
-        self.openai_query = OpenAIQuery(os.getenv("OPENAI_API_KEY"))
+        self.snapshot = None
+        self.schema_service = SchemaService()
+        self.result_cache = ResultCache()
+        self.guard = QueryGuard()
+        self.rollups = RollupRewriter()
+        self.workload_log = WorkloadLog()
+        self.openai_query = OpenAIQuery(
+            os.getenv("OPENAI_API_KEY"), cache=TranslationCache()
+        )
         self.host = os.getenv("DB_HOST")
         self.port = os.getenv("DB_PORT")
         self.user = os.getenv("DB_USER")
         self.password = os.getenv("DB_PASSWORD")
         self.dbname = os.getenv("DB_NAME")
 
+    def connection_params(self) -> ConnectionParams:
+        return {
+            "host": self.host,
+            "port": self.port,
+            "user": self.user,
+            "password": self.password,
+            "dbname": self.dbname,
+        }
+
     def connect_to_database(self) -> None:
         try:
-            self.conn = psycopg.connect(
-                host=self.host,
-                port=self.port,
-                user=self.user,
-                password=self.password,
-                dbname=self.dbname,
-            )
-            self.cursor = self.conn.cursor()
+            self.pool = self.pools.get(self.connection_params())
         except psycopg.Error as e:
             print(f"Error connecting to database: {e}")
             raise
 
     def fetch_schema(self) -> None:
-        query = """
-        SELECT 
-            table_name, 
-            column_name, 
-            data_type 
-        FROM 
-            information_schema.columns 
-        WHERE 
-            table_schema = 'public';
-        """
-
-        self.cursor.execute(query)
-        schema_data = self.cursor.fetchall()
-        self.schema = {}
-
-        for table, column, datatype in schema_data:
-            if table not in self.schema:
-                self.schema[table] = {}
-            self.schema[table][column] = datatype
+        self.snapshot = self.schema_service.get(self.pool)
+        self.schema = self.snapshot.tables
+        self.openai_query.schema_fingerprint = self.snapshot.fingerprint
+        self.openai_query.schema_index = self.snapshot.build_index()
+        self.openai_query.validator = SQLValidator(self.schema)
 
     def execute_query_and_fetch_results(
         self,
         query: str,
-        formatter: Optional[Callable[[List[List[Any]], List[str]], Any]] = None,
+        formatter: Optional[Callable[[pa.Table], Any]] = None,
         error_handler: Callable[[str], None] = print,
     ) -> Optional[Any]:
         try:
-            self.cursor.execute(query)
-            column_names = [desc[0] for desc in self.cursor.description]
-            rows = self.cursor.fetchall()
+            with self.pool.connection() as conn, span("db.execute") as execute_span:
+                rewrite = self.rollups.rewrite_query(conn, query)
+                if rewrite is not None:
+                    print(f"Answered from rollup {rewrite.rollup}: {rewrite.sql}")
+                    query = rewrite.sql
+                review = self.guard.review(conn, query)
+                if review.plan is not None:
+                    print(f"Plan: {review.plan.describe()}")
+                if review.verdict == "blocked":
+                    error_handler(review.message)
+                    return None
+                if review.verdict == "confirm":
+                    if input(f"{review.message} [y/N] ").strip().lower() != "y":
+                        return None
+                started = time.perf_counter()
+                page = cached_fetch_page(
+                    self.result_cache,
+                    conn,
+                    self.pool.name,
+                    review.sql,
+                    limit=max_result_rows(),
+                )
+                execute_span.set(rows=page.num_rows, bytes=page.table.nbytes)
+            self.workload_log.record(
+                self.pool.name,
+                review.sql,
+                time.perf_counter() - started,
+                page.num_rows,
+                review.raw_plan,
+            )
+            if page.has_more:
+                print(f"Showing the first {page.num_rows} rows.")
             if formatter is not None:
-                return formatter(rows, column_names)
+                return formatter(page.table)
             else:
-                return rows
+                return page.table
         except psycopg.Error as e:
             error_message = f"An error occurred while executing the SQL query: {e}"
             error_handler(error_message)
@@ -80,31 +118,145 @@ class DatabaseQuery:
         try:
             self.connect_to_database()
             self.fetch_schema()
-            self.openai_query.setup_openai_client()
             self.interact()
         finally:
-            if self.cursor:
-                self.cursor.close()
-            if self.conn:
-                self.conn.close()
+            self.pools.close_all()
+
+    def run_batch(self, args: argparse.Namespace) -> None:
+        try:
+            self.connect_to_database()
+            self.fetch_schema()
+            runner = BatchRunner(
+                self.connection_params(),
+                self.openai_query,
+                self.snapshot,
+                concurrency=args.concurrency,
+                force=args.force,
+                result_cache=self.result_cache,
+                guard=self.guard,
+                workload_log=self.workload_log,
+            )
+            asyncio.run(
+                runner.run(args.questions, args.output, args.parquet, args.retry_failed)
+            )
+        finally:
+            self.pools.close_all()
+
+    def run_advisor(self, args: argparse.Namespace) -> None:
+        try:
+            self.connect_to_database()
+            self.fetch_schema()
+            # Run by whoever operates the database, like --apply
+            advisor = IndexAdvisor(
+                self.schema,
+                self.snapshot.row_estimates,
+                self.snapshot.partitions,
+                allow_trial=True,
+            )
+            entries = self.workload_log.entries(self.pool.name)
+            print(f"{len(entries)} logged queries.")
+            for column in advisor.hot_columns(entries)[:10]:
+                print(
+                    f"  {column.table}.{column.column} ({column.kind}): "
+                    f"{column.queries} queries, {column.seq_scan_queries} seq scans"
+                )
+            with self.pool.connection() as conn:
+                recommendations = advisor.advise(conn, entries)
+                for recommendation in recommendations:
+                    if not recommendation.recommended:
+                        continue
+                    print(f"{recommendation.describe()}\n  {recommendation.ddl};")
+                    if args.apply:
+                        IndexAdvisor.apply(conn, recommendation)
+                        print("  applied")
+            if not any(r.recommended for r in recommendations):
+                print("No index recommendations.")
+        finally:
+            self.pools.close_all()
+
+    def run_rollups(self, args: argparse.Namespace) -> None:
+        try:
+            self.connect_to_database()
+            self.fetch_schema()
+            manager = RollupManager()
+            with self.pool.connection() as conn:
+                RollupManager.setup(conn)
+                for table in args.tables or list(self.schema):
+                    if args.refresh:
+                        refreshed = manager.refresh(conn, table)
+                        print(f"{table}: refreshed {refreshed} rollups")
+                        continue
+                    with conn.transaction():
+                        rollups = manager.create(conn, table)
+                    print(f"{table}: {len(rollups)} rollups")
+                    for rollup in rollups:
+                        print(f"  {rollup.name} ({rollup.row_count:,} rows)")
+        finally:
+            self.pools.close_all()
 
     def interact(self) -> None:
-        formatted_schema = json.dumps(self.schema, indent=4)
+        formatted_schema = self.snapshot.format()
         system_message = self.openai_query.create_system_message(formatted_schema)
         self.openai_query.query.append(system_message)
-        self.openai_query.query = self.openai_query.nlq_conversation(
-            self.openai_query.query
-        )
 
         while True:
-            model_query = self.openai_query.handle_user_input()
+            try:
+                model_query = self.openai_query.handle_user_input()
+            except SQLValidationError as e:
+                print(e)
+                self.openai_query.query.pop()
+                continue
             results = self.execute_query_and_fetch_results(
-                model_query, formatter=format_as_dict
+                model_query, formatter=arrow_to_dicts
             )
             if results is not None:
                 print(results)
                 break
 
 
-app = DatabaseQuery()
-app.run()
+def main() -> None:
+    load_dotenv()
+    parser = argparse.ArgumentParser(
+        description="Ask questions about the database in natural language."
+    )
+    subparsers = parser.add_subparsers(dest="command")
+    batch = subparsers.add_parser(
+        "batch", help="answer the questions in a JSONL file without prompting"
+    )
+    batch.add_argument("questions", help='JSONL file of {"id": ..., "question": ...}')
+    batch.add_argument("-o", "--output", required=True, help="JSONL results file")
+    batch.add_argument("--parquet", help="also write the results as Parquet")
+    batch.add_argument("--concurrency", type=int, default=4)
+    batch.add_argument("--retry-failed", action="store_true")
+    batch.add_argument(
+        "--force", action="store_true", help="run queries that need confirmation"
+    )
+    advise = subparsers.add_parser(
+        "advise", help="recommend indexes for the logged query workload"
+    )
+    advise.add_argument(
+        "--apply", action="store_true", help="create the recommended indexes"
+    )
+    rollups = subparsers.add_parser(
+        "rollups", help="build the rollup tables aggregates are answered from"
+    )
+    rollups.add_argument("tables", nargs="*", help="fact tables (default: all)")
+    rollups.add_argument(
+        "--refresh", action="store_true", help="refresh existing rollups instead"
+    )
+    args = parser.parse_args()
+
+    serve_metrics()
+    app = DatabaseQuery()
+    if args.command == "batch":
+        app.run_batch(args)
+    elif args.command == "advise":
+        app.run_advisor(args)
+    elif args.command == "rollups":
+        app.run_rollups(args)
+    else:
+        app.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import csv
+import io
+import re
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+# A column type is either a SQL type name or the labels of an enum type
+ColumnType = Union[str, Tuple[str, ...]]
+ColumnTypes = Dict[str, ColumnType]
+
+INT_RE = re.compile(r"-?\d+")
+FLOAT_RE = re.compile(r"-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?")
+DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+TIMESTAMP_RE = re.compile(
+    r"\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?([+-]\d{2}(:?\d{2})?|Z)?"
+)
+# Codes such as zip codes or well IDs lose their leading zeros as numbers
+LEADING_ZERO_RE = re.compile(r"-?0\d")
+# Context of a COPY error on a value, e.g. 'COPY t, line 3, column n: "1.5"'
+COPY_VALUE_RE = re.compile(r'column (.+?): "(.*)"', re.S)
+BOOLEANS = {"true", "false", "t", "f", "yes", "no"}
+INT32_MAX = 2**31 - 1
+
+
+def infer_column_type(values: Iterable[str]) -> str:
+    """Narrowest SQL type every non-empty value of a CSV column parses as."""
+    values = [value for value in values if value != ""]
+    if not values:
+        return "text"
+    codes = any(LEADING_ZERO_RE.match(value) for value in values)
+    if not codes and all(INT_RE.fullmatch(value) for value in values):
+        if all(abs(int(value)) <= INT32_MAX for value in values):
+            return "integer"
+        return "bigint"
+    if not codes and all(FLOAT_RE.fullmatch(value) for value in values):
+        return "double precision"
+    if all(value.lower() in BOOLEANS for value in values):
+        return "boolean"
+    if all(DATE_RE.fullmatch(value) for value in values):
+        return "date"
+    if all(TIMESTAMP_RE.fullmatch(value) for value in values):
+        return "timestamp"
+    return "text"
+
+
+def widen_column_type(
+    context: Optional[str],
+    column_types: ColumnTypes,
+    columns: Sequence[str],
+    rows: List[List[str]],
+) -> Optional[Tuple[str, str]]:
+    """Column and wider type for a value a COPY rejected, given the COPY
+    error's context, or None if the error is not about an inferred type."""
+    match = COPY_VALUE_RE.search(context or "")
+    if match is None or match.group(1) not in columns:
+        return None
+    column, value = match.groups()
+    current = column_types.get(column)
+    if not isinstance(current, str) or current == "text":
+        return None
+    index = list(columns).index(column)
+    values = [row[index] for row in rows if len(row) > index]
+    wider = infer_column_type(values + [value])
+    return column, "text" if wider == current else wider
+
+
+def sample_rows(chunk: str) -> List[List[str]]:
+    # A chunk may end in the middle of a line; only whole lines are used
+    return list(csv.reader(io.StringIO(chunk[: chunk.rfind("\n") + 1])))
+
+
+def infer_column_types(columns: Sequence[str], rows: List[List[str]]) -> ColumnTypes:
+    return {
+        column: infer_column_type(row[index] for row in rows if len(row) > index)
+        for index, column in enumerate(columns)
+    }
+
+
+def declared_column_types(generator: object) -> ColumnTypes:
+    """Types a generator declares in `column_types`, keyed by lower-case name.
+
+    Sequences of labels become enums; labels are only known for sure when
+    the generator declares them, so enums are never inferred from a sample.
+    """
+    declared = getattr(generator, "column_types", {}) or {}
+    return {
+        column.lower(): (
+            column_type
+            if isinstance(column_type, str)
+            else tuple(str(label) for label in column_type)
+        )
+        for column, column_type in declared.items()
+    }
+
+
+def index_candidates(
+    generator: object, column_types: ColumnTypes, rows: List[List[str]]
+) -> List[str]:
+    """Columns worth indexing: the generator's `index_columns`, otherwise
+    enums and text columns with few distinct values in the sample."""
+    declared: Optional[List[str]] = getattr(generator, "index_columns", None)
+    if declared is not None:
+        return [column.lower() for column in declared]
+    candidates = []
+    for index, (column, column_type) in enumerate(column_types.items()):
+        if not isinstance(column_type, str):
+            candidates.append(column)
+        elif column_type == "text" and rows:
+            distinct = {row[index] for row in rows if len(row) > index}
+            if len(distinct) <= max(len(rows) // 10, 1):
+                candidates.append(column)
+    return candidates
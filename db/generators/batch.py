@@ -0,0 +1,105 @@
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import date
+from typing import Callable, Dict, Iterator, List, Optional
+import numpy as np
+import pandas as pd
+from faker import Faker
+
+SHARD_ROWS = 100_000
+VOCAB_SIZE = 5_000
+
+Vocab = Dict[str, np.ndarray]
+BatchFunction = Callable[[np.random.Generator, Vocab, int], Dict[str, np.ndarray]]
+
+_worker_vocab: Vocab = {}
+
+
+@dataclass
+class Partition:
+    """One range partition of a generated table: rows whose partition
+    column falls in [lower, upper)."""
+
+    name: str
+    lower: date
+    upper: date
+    rows: int
+
+
+def resolve_seed(seed: Optional[int]) -> int:
+    if seed is None:
+        return int(np.random.SeedSequence().generate_state(1)[0])
+    return seed
+
+
+def build_vocab(seed: int, providers: List[str], size: int = VOCAB_SIZE) -> Vocab:
+    fake = Faker()
+    fake.seed_instance(seed)
+    return {
+        provider: np.array([getattr(fake, provider)() for _ in range(size)])
+        for provider in providers
+    }
+
+
+def pick(rng: np.random.Generator, pool: np.ndarray, rows: int) -> np.ndarray:
+    return pool[rng.integers(0, len(pool), rows)]
+
+
+def join(*parts: np.ndarray, sep: str = " ") -> np.ndarray:
+    result = parts[0].astype(object)
+    for part in parts[1:]:
+        result = result + sep + part.astype(object)
+    return result
+
+
+def _init_worker(vocab: Vocab) -> None:
+    global _worker_vocab
+    _worker_vocab = vocab
+
+
+def _render_shard(
+    batch_fn: BatchFunction, fieldnames: List[str], seed: int, shard: int, rows: int
+) -> str:
+    rng = np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(shard,)))
+    columns = batch_fn(rng, _worker_vocab, rows)
+    return pd.DataFrame(columns, columns=fieldnames).to_csv(
+        index=False, header=False, float_format="%.2f", lineterminator="\n"
+    )
+
+
+def iter_csv_shards(
+    batch_fn: BatchFunction,
+    fieldnames: List[str],
+    vocab: Vocab,
+    rows: int,
+    seed: int,
+    workers: Optional[int] = None,
+    shard_rows: int = SHARD_ROWS,
+) -> Iterator[str]:
+    # Shard boundaries and seeds depend only on (seed, rows, shard_rows), so the
+    # output is identical whatever the number of workers.
+    sizes = [shard_rows] * (rows // shard_rows)
+    if rows % shard_rows:
+        sizes.append(rows % shard_rows)
+
+    workers = min(workers or os.cpu_count() or 1, len(sizes))
+    if workers <= 1:
+        _init_worker(vocab)
+        for shard, size in enumerate(sizes):
+            yield _render_shard(batch_fn, fieldnames, seed, shard, size)
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(vocab,)
+    ) as executor:
+        pending = deque()
+        for shard, size in enumerate(sizes):
+            if len(pending) >= workers * 2:
+                yield pending.popleft().result()
+            pending.append(
+                executor.submit(_render_shard, batch_fn, fieldnames, seed, shard, size)
+            )
+        while pending:
+            yield pending.popleft().result()
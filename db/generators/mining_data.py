@@ -1,32 +1,70 @@
-import csv
-from typing import List
+from typing import Dict, Iterator, List, Optional
 from faker import Faker
+import numpy as np
 import random
 
+from db.generators.batch import (
+    Vocab,
+    build_vocab,
+    iter_csv_shards,
+    join,
+    pick,
+    resolve_seed,
+)
+
+STATUSES = np.array(["Active", "Inactive"])
+
 
 class MiningDataGenerator:
-    def __init__(self):
+    fieldnames = [
+        "company",
+        "mine_name",
+        "gold_production_oz",
+        "silver_production_oz",
+        "region",
+        "status",
+        "owner",
+    ]
+    column_types = {
+        "gold_production_oz": "numeric(10, 2)",
+        "silver_production_oz": "numeric(10, 2)",
+        "status": STATUSES,
+    }
+    index_columns = ["region", "status", "company"]
+
+    def __init__(self, seed: Optional[int] = None, workers: Optional[int] = None):
         self.fake = Faker()
+        self.seed = seed
+        self.workers = workers
 
     def generate_csv(self, file_name: str, rows: int = 100) -> None:
         with open(file_name, "w", newline="") as csvfile:
-            fieldnames = [
-                "company",
-                "mine_name",
-                "gold_production_oz",
-                "silver_production_oz",
-                "region",
-                "status",
-                "owner",
-            ]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
-
-            for _ in range(rows):
-                data = self.generate_row()
-                writer.writerow(
-                    {fieldnames[i]: data[i] for i in range(len(fieldnames))}
-                )
+            csvfile.write(",".join(self.fieldnames) + "\n")
+            for chunk in self.iter_csv(rows):
+                csvfile.write(chunk)
+
+    def iter_csv(self, rows: int) -> Iterator[str]:
+        seed = resolve_seed(self.seed)
+        vocab = build_vocab(seed, ["company", "word", "state", "name"])
+        return iter_csv_shards(
+            self.generate_batch, self.fieldnames, vocab, rows, seed, self.workers
+        )
+
+    @staticmethod
+    def generate_batch(
+        rng: np.random.Generator, vocab: Vocab, rows: int
+    ) -> Dict[str, np.ndarray]:
+        return {
+            "company": pick(rng, vocab["company"], rows),
+            "mine_name": join(
+                pick(rng, vocab["word"], rows), pick(rng, vocab["word"], rows)
+            ),
+            "gold_production_oz": np.round(rng.uniform(10, 100, rows), 2),
+            "silver_production_oz": np.round(rng.uniform(50, 500, rows), 2),
+            "region": pick(rng, vocab["state"], rows),
+            "status": pick(rng, STATUSES, rows),
+            "owner": pick(rng, vocab["name"], rows),
+        }
 
     def generate_row(self) -> List:
         company = self.fake.company()
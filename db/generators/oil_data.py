@@ -1,94 +1,137 @@
-import csv
-from typing import List
+from typing import Dict, Iterator, List, Optional
 from faker import Faker
+import numpy as np
 import random
 
+from db.generators.batch import (
+    Vocab,
+    build_vocab,
+    iter_csv_shards,
+    join,
+    pick,
+    resolve_seed,
+)
+
+GEOLOGICAL_TERMS = [
+    "Creek",
+    "Hill",
+    "Field",
+    "Ridge",
+    "Valley",
+    "Mountain",
+    "Lake",
+    "River",
+    "Ocean",
+    "Forest",
+    "Desert",
+    "Swamp",
+    "Canyon",
+    "Bay",
+    "Spring",
+    "Cliff",
+    "Plateau",
+    "Dune",
+    "Volcano",
+    "Glacier",
+    "Cave",
+    "Island",
+    "Marsh",
+    "Prairie",
+    "Reef",
+    "Jungle",
+    "Gulf",
+    "Peninsula",
+    "Falls",
+    "Peak",
+    "Pond",
+    "Lagoon",
+    "Meadow",
+    "Delta",
+    "Geyser",
+    "Oasis",
+    "Savannah",
+    "Fjord",
+    "Grove",
+    "Tundra",
+    "Basin",
+    "Reservoir",
+    "Archipelago",
+    "Coral",
+    "Isthmus",
+    "Butte",
+    "Mesa",
+    "Cirque",
+    "Saddle",
+    "Seamount",
+    "Strait",
+    "Thicket",
+    "Trench",
+    "Vale",
+    "Wetland",
+]
+
+STATUSES = np.array(["Active", "Inactive"])
+
 
 class OilDataGenerator:
-    def __init__(self):
+    fieldnames = [
+        "company",
+        "well_Name",
+        "oil_production_bbl",
+        "gas_production_mcf",
+        "region",
+        "status",
+        "owner",
+    ]
+    column_types = {
+        "oil_production_bbl": "numeric(10, 2)",
+        "gas_production_mcf": "numeric(10, 2)",
+        "status": STATUSES,
+    }
+    index_columns = ["region", "status", "company"]
+
+    def __init__(self, seed: Optional[int] = None, workers: Optional[int] = None):
         self.fake = Faker()
+        self.seed = seed
+        self.workers = workers
 
     def generate_csv(self, file_name: str, rows: int = 100) -> None:
         with open(file_name, "w", newline="") as csvfile:
-            fieldnames = [
-                "company",
-                "well_Name",
-                "oil_production_bbl",
-                "gas_production_mcf",
-                "region",
-                "status",
-                "owner",
-            ]
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            writer.writeheader()
+            csvfile.write(",".join(self.fieldnames) + "\n")
+            for chunk in self.iter_csv(rows):
+                csvfile.write(chunk)
+
+    def iter_csv(self, rows: int) -> Iterator[str]:
+        seed = resolve_seed(self.seed)
+        vocab = build_vocab(seed, ["company", "city", "state", "name"])
+        vocab["term"] = np.array(GEOLOGICAL_TERMS)
+        return iter_csv_shards(
+            self.generate_batch, self.fieldnames, vocab, rows, seed, self.workers
+        )
 
-            for _ in range(rows):
-                data = self.generate_row()
-                writer.writerow(
-                    {fieldnames[i]: data[i] for i in range(len(fieldnames))}
-                )
+    @staticmethod
+    def generate_batch(
+        rng: np.random.Generator, vocab: Vocab, rows: int
+    ) -> Dict[str, np.ndarray]:
+        identifier = rng.integers(100, 1000, rows).astype(str)
+        return {
+            "company": pick(rng, vocab["company"], rows),
+            "well_Name": join(
+                pick(rng, vocab["city"], rows),
+                pick(rng, vocab["term"], rows),
+                identifier,
+            ),
+            "oil_production_bbl": np.round(rng.uniform(50, 500, rows), 2),
+            "gas_production_mcf": np.round(rng.uniform(100, 1000, rows), 2),
+            "region": pick(rng, vocab["state"], rows),
+            "status": pick(rng, STATUSES, rows),
+            "owner": pick(rng, vocab["name"], rows),
+        }
 
     def generate_row(self) -> List:
-        geological_terms = [
-            "Creek",
-            "Hill",
-            "Field",
-            "Ridge",
-            "Valley",
-            "Mountain",
-            "Lake",
-            "River",
-            "Ocean",
-            "Forest",
-            "Desert",
-            "Swamp",
-            "Canyon",
-            "Bay",
-            "Spring",
-            "Cliff",
-            "Plateau",
-            "Dune",
-            "Volcano",
-            "Glacier",
-            "Cave",
-            "Island",
-            "Marsh",
-            "Prairie",
-            "Reef",
-            "Jungle",
-            "Gulf",
-            "Peninsula",
-            "Falls",
-            "Peak",
-            "Pond",
-            "Lagoon",
-            "Meadow",
-            "Delta",
-            "Geyser",
-            "Oasis",
-            "Savannah",
-            "Fjord",
-            "Grove",
-            "Tundra",
-            "Basin",
-            "Reservoir",
-            "Archipelago",
-            "Coral",
-            "Isthmus",
-            "Butte",
-            "Mesa",
-            "Cirque",
-            "Saddle",
-            "Seamount",
-            "Strait",
-            "Thicket",
-            "Trench",
-            "Vale",
-            "Wetland",
-        ]
         location = self.fake.city()
         identifier = str(random.randint(100, 999))
-        well_name = location + " " + random.choice(geological_terms) + " " + identifier
+        well_name = location + " " + random.choice(GEOLOGICAL_TERMS) + " " + identifier
 
         company = self.fake.company()
         oil_production = round(random.uniform(50, 500), 2)
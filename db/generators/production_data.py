@@ -0,0 +1,182 @@
+import csv
+import io
+from datetime import date, timedelta
+from typing import Dict, Iterator, List, Optional, Union
+import numpy as np
+import pandas as pd
+
+from db.generators.batch import SHARD_ROWS, Partition, resolve_seed
+from db.generators.oil_data import OilDataGenerator
+
+DAYS_PER_YEAR = 365.25
+# Wells have been producing for up to this long when the history starts
+MAX_WELL_AGE_DAYS = 3650
+
+
+def month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def next_month(day: date) -> date:
+    return (day.replace(day=1) + timedelta(days=32)).replace(day=1)
+
+
+class ProductionDataGenerator:
+    """Daily production readings for every well of an oil_data table.
+
+    Well names are those OilDataGenerator produces for the same seed, so
+    seeding ``OilDataGenerator(seed=s)`` with ``rows=wells`` and this
+    generator with ``ProductionDataGenerator(seed=s, wells=wells)`` gives
+    tables that join on ``well_name``. Each well follows an Arps hyperbolic
+    decline from its own initial rate, with daily noise, downtime and a
+    gas/oil ratio that rises as the well depletes. ``rows`` readings cover
+    ``rows / wells`` days from ``start_date``, one partition per month.
+    """
+
+    fieldnames = [
+        "well_name",
+        "production_date",
+        "oil_production_bbl",
+        "gas_production_mcf",
+        "hours_on",
+    ]
+    column_types = {
+        "production_date": "date",
+        "oil_production_bbl": "numeric(10, 2)",
+        "gas_production_mcf": "numeric(12, 2)",
+        "hours_on": "smallint",
+    }
+    index_columns: List[str] = []
+    partition_column = "production_date"
+    brin_columns = ["production_date"]
+
+    def __init__(
+        self,
+        seed: Optional[int] = None,
+        wells: int = 100,
+        start_date: Union[date, str] = date(2014, 1, 1),
+        workers: Optional[int] = None,
+    ):
+        self.seed = resolve_seed(seed)
+        self.wells = wells
+        self.start_date = (
+            date.fromisoformat(start_date)
+            if isinstance(start_date, str)
+            else start_date
+        )
+        self.workers = workers
+        self._well_names: Optional[np.ndarray] = None
+        self._well_params: Optional[Dict[str, np.ndarray]] = None
+
+    def well_names(self) -> np.ndarray:
+        if self._well_names is None:
+            oil = OilDataGenerator(seed=self.seed, workers=self.workers)
+            column = oil.fieldnames.index("well_Name")
+            self._well_names = np.array(
+                [
+                    row[column]
+                    for chunk in oil.iter_csv(self.wells)
+                    for row in csv.reader(io.StringIO(chunk))
+                ]
+            )
+        return self._well_names
+
+    def well_params(self) -> Dict[str, np.ndarray]:
+        if self._well_params is None:
+            rng = np.random.default_rng(np.random.SeedSequence(self.seed))
+            wells = self.wells
+            self._well_params = {
+                "age_days": rng.integers(0, MAX_WELL_AGE_DAYS, wells),
+                "initial_rate": rng.lognormal(np.log(300), 0.6, wells),
+                "b_factor": rng.uniform(0.3, 1.2, wells),
+                "decline": rng.uniform(0.4, 1.2, wells),
+                "gas_oil_ratio": rng.lognormal(np.log(1.5), 0.5, wells),
+                "downtime": rng.uniform(0.01, 0.08, wells),
+            }
+        return self._well_params
+
+    def partitions(self, rows: int) -> List[Partition]:
+        # Resolved here so processes loading partitions in parallel get the
+        # wells along with the generator instead of each rebuilding them.
+        self.well_names()
+        self.well_params()
+        days = -(-rows // self.wells)
+        end = self.start_date + timedelta(days=days)
+        partitions = []
+        lower = month_start(self.start_date)
+        remaining = rows
+        while lower < end and remaining > 0:
+            upper = next_month(lower)
+            first = max(lower, self.start_date)
+            count = min((min(upper, end) - first).days * self.wells, remaining)
+            partitions.append(Partition(f"{lower:%Y_%m}", lower, upper, count))
+            remaining -= count
+            lower = upper
+        return partitions
+
+    def iter_partition(self, partition: Partition) -> Iterator[str]:
+        # Rows are written in date order, which keeps BRIN ranges on the
+        # date column tight.
+        names = self.well_names()
+        params = self.well_params()
+        first = max(partition.lower, self.start_date)
+        offset = (first - self.start_date).days
+        days_per_chunk = max(SHARD_ROWS // self.wells, 1)
+        remaining = partition.rows
+        chunk = 0
+        while remaining > 0:
+            days = min(days_per_chunk, -(-remaining // self.wells))
+            rng = np.random.default_rng(
+                np.random.SeedSequence(self.seed, spawn_key=(offset, chunk))
+            )
+            columns = self.generate_batch(rng, names, params, first, offset, days)
+            frame = pd.DataFrame(columns, columns=self.fieldnames)
+            frame = frame.iloc[:remaining]
+            yield frame.to_csv(
+                index=False, header=False, float_format="%.2f", lineterminator="\n"
+            )
+            remaining -= len(frame)
+            first += timedelta(days=days)
+            offset += days
+            chunk += 1
+
+    def iter_csv(self, rows: int) -> Iterator[str]:
+        for partition in self.partitions(rows):
+            yield from self.iter_partition(partition)
+
+    def generate_csv(self, file_name: str, rows: int = 100) -> None:
+        with open(file_name, "w", newline="") as csvfile:
+            csvfile.write(",".join(self.fieldnames) + "\n")
+            for chunk in self.iter_csv(rows):
+                csvfile.write(chunk)
+
+    @staticmethod
+    def generate_batch(
+        rng: np.random.Generator,
+        names: np.ndarray,
+        params: Dict[str, np.ndarray],
+        first: date,
+        offset: int,
+        days: int,
+    ) -> Dict[str, np.ndarray]:
+        wells = len(names)
+        shape = (days, wells)
+        day = np.arange(offset, offset + days)[:, None]
+        years = (params["age_days"] + day) / DAYS_PER_YEAR
+        b = params["b_factor"]
+        rate = params["initial_rate"] / (1 + b * params["decline"] * years) ** (1 / b)
+        hours_on = np.where(
+            rng.random(shape) < params["downtime"],
+            rng.integers(0, 24, shape),
+            24,
+        )
+        oil = rate * np.exp(rng.normal(0, 0.08, shape)) * hours_on / 24
+        gas = oil * params["gas_oil_ratio"] * (1 + 0.15 * years)
+        dates = np.datetime64(first) + np.arange(days).astype("timedelta64[D]")
+        return {
+            "well_name": np.tile(names, days),
+            "production_date": np.repeat(dates, wells),
+            "oil_production_bbl": np.round(oil.ravel(), 2),
+            "gas_production_mcf": np.round(gas.ravel(), 2),
+            "hours_on": hours_on.ravel(),
+        }
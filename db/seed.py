@@ -1,15 +1,72 @@
+import csv
+import itertools
 import os
-from typing import Any
-import pandas as pd
+import time
+from concurrent.futures import ProcessPoolExecutor
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import psycopg
+from psycopg import sql
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
+from db.column_types import (
+    ColumnTypes,
+    declared_column_types,
+    index_candidates,
+    infer_column_types,
+    sample_rows,
+    widen_column_type,
+)
+from db.generators.batch import Partition
+from rollups import RollupManager
 
 load_dotenv()
 
+COPY_CHUNK_SIZE = 1 << 20
+
+_DONE = object()
+
+
+def _load_partition(
+    params: Dict[str, Any],
+    generator: Any,
+    table_name: str,
+    columns: List[str],
+    partition: Partition,
+    brin_columns: List[str],
+) -> int:
+    # Runs in a worker process, which renders the partition's rows itself
+    # and copies them straight into the partition over its own connection.
+    name = f"{table_name}_{partition.name}"
+    with psycopg.connect(**params) as conn:
+        with conn.transaction(), conn.cursor() as cursor:
+            rows = Seeder.copy_batches(
+                cursor, generator.iter_partition(partition), name, columns
+            )
+            Seeder.create_indexes(cursor, name, brin_columns, method="brin")
+    return rows
+
 
 class Seeder:
-    def __init__(self, generator: Any):
+    def __init__(
+        self,
+        generator: Any,
+        chunk_size: int = COPY_CHUNK_SIZE,
+        queue_size: int = 1,
+        column_types: Optional[ColumnTypes] = None,
+        index_columns: Optional[List[str]] = None,
+        rollups: bool = True,
+        load_workers: Optional[int] = None,
+        verbose: bool = True,
+    ):
         self.generator = generator
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.column_types = column_types or {}
+        self.index_columns = index_columns
+        self.rollups = rollups
+        self.load_workers = load_workers or os.cpu_count() or 1
+        self.verbose = verbose
         self.params = {
             "host": os.getenv("DB_HOST"),
             "port": os.getenv("DB_PORT"),
@@ -17,32 +74,411 @@ class Seeder:
             "password": os.getenv("DB_PASSWORD"),
             "dbname": os.getenv("DB_NAME"),
         }
-        self.engine = create_engine(
-            f"postgresql+psycopg://{self.params['user']}:{self.params['password']}@{self.params['host']}:{self.params['port']}/{self.params['dbname']}"
+
+    def connect(self) -> psycopg.Connection:
+        return psycopg.connect(**self.params)
+
+    @staticmethod
+    def normalize_columns(columns: Iterable[str]) -> List[str]:
+        # Unquoted identifiers fold to lower case, keep the same column names
+        return [col.lower() for col in columns]
+
+    def declared_columns(self) -> Set[str]:
+        """Columns whose types are given rather than inferred."""
+        return set(declared_column_types(self.generator)) | {
+            col.lower() for col in self.column_types
+        }
+
+    def column_types_for(
+        self, columns: List[str], sample: List[List[str]]
+    ) -> ColumnTypes:
+        # Declared types win over inferred ones, explicit ones over both
+        column_types = infer_column_types(columns, sample)
+        column_types.update(declared_column_types(self.generator))
+        column_types.update({col.lower(): t for col, t in self.column_types.items()})
+        return {col: column_types.get(col, "text") for col in columns}
+
+    def widen(
+        self,
+        error: psycopg.Error,
+        column_types: ColumnTypes,
+        columns: List[str],
+        sample: List[List[str]],
+    ) -> bool:
+        """Widen the inferred column type a COPY error is about, if any."""
+        declared = self.declared_columns()
+        widened = widen_column_type(
+            error.diag.context,
+            {col: t for col, t in column_types.items() if col not in declared},
+            columns,
+            sample,
+        )
+        if widened is None:
+            return False
+        column, column_type = widened
+        if self.verbose:
+            print(f"Widening {column} from {column_types[column]} to {column_type}")
+        column_types[column] = column_type
+        return True
+
+    def create_table(
+        self,
+        cursor: psycopg.Cursor,
+        table_name: str,
+        columns: List[str],
+        column_types: Optional[ColumnTypes] = None,
+        partition_by: Optional[str] = None,
+    ) -> None:
+        column_types = column_types or {}
+        cursor.execute(
+            sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table_name))
+        )
+        column_defs = []
+        for col in columns:
+            column_type = column_types.get(col, "text")
+            if isinstance(column_type, str):
+                type_name = sql.SQL(column_type)
+            else:
+                type_name = sql.Identifier(f"{table_name}_{col}")
+                cursor.execute(sql.SQL("DROP TYPE IF EXISTS {}").format(type_name))
+                cursor.execute(
+                    sql.SQL("CREATE TYPE {} AS ENUM ({})").format(
+                        type_name, sql.SQL(", ").join(map(sql.Literal, column_type))
+                    )
+                )
+            column_defs.append(sql.SQL("{} {}").format(sql.Identifier(col), type_name))
+        statement = sql.SQL("CREATE TABLE {} ({})").format(
+            sql.Identifier(table_name), sql.SQL(", ").join(column_defs)
         )
+        if partition_by is not None:
+            statement = sql.SQL("{} PARTITION BY RANGE ({})").format(
+                statement, sql.Identifier(partition_by)
+            )
+        cursor.execute(statement)
+
+    @staticmethod
+    def create_partitions(
+        cursor: psycopg.Cursor, table_name: str, partitions: List[Partition]
+    ) -> None:
+        for partition in partitions:
+            cursor.execute(
+                sql.SQL(
+                    "CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})"
+                ).format(
+                    sql.Identifier(f"{table_name}_{partition.name}"),
+                    sql.Identifier(table_name),
+                    sql.Literal(partition.lower),
+                    sql.Literal(partition.upper),
+                )
+            )
 
-    def create_table(self, table_name: str, file_name: str) -> None:
-        df = pd.read_csv(file_name)
-        columns = ", ".join([f"{col} TEXT" for col in df.columns])
+    @staticmethod
+    def create_indexes(
+        cursor: psycopg.Cursor,
+        table_name: str,
+        columns: List[str],
+        method: str = "btree",
+    ) -> None:
+        # Built after COPY, which is much faster than maintaining them per row
+        suffix = "idx" if method == "btree" else method
+        for col in columns:
+            cursor.execute(
+                sql.SQL("CREATE INDEX {} ON {} USING {} ({})").format(
+                    sql.Identifier(f"{table_name}_{col}_{suffix}"),
+                    sql.Identifier(table_name),
+                    sql.SQL(method),
+                    sql.Identifier(col),
+                )
+            )
 
-        with self.engine.connect() as connection:
-            connection.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
-            connection.execute(text(f"CREATE TABLE {table_name} ({columns})"))
+    @staticmethod
+    def copy_batches(
+        cursor: psycopg.Cursor,
+        batches: Iterable[str],
+        table_name: str,
+        columns: List[str],
+    ) -> int:
+        statement = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+            sql.Identifier(table_name),
+            sql.SQL(", ").join(sql.Identifier(col) for col in columns),
+        )
+        with cursor.copy(statement) as copy:
+            for batch in batches:
+                copy.write(batch)
+        return cursor.rowcount
 
-    def upload_csv_to_postgres(self, file_name: str, table_name: str) -> None:
-        df = pd.read_csv(file_name)
-        df.to_sql(table_name, self.engine, if_exists="append", index=False)
+    def load(
+        self,
+        table_name: str,
+        columns: List[str],
+        batches: Callable[[], Iterator[str]],
+    ) -> int:
+        """Create and fill a table from CSV batches.
 
-    def drop_table(self, table_name: str) -> None:
-        with self.engine.connect() as connection:
-            connection.execute(text(f"DROP TABLE IF EXISTS {table_name}"))
+        Column types are inferred from the first batch, which is then loaded
+        along with the rest. If a later value does not fit an inferred type,
+        the table is recreated with that column widened and batches() is
+        called again to start over.
+        """
+        start = time.perf_counter()
+        attempt = batches()
+        first = next(attempt, "")
+        sample = sample_rows(first)
+        column_types = self.column_types_for(columns, sample)
+        index_columns = (
+            [col.lower() for col in self.index_columns]
+            if self.index_columns is not None
+            else index_candidates(self.generator, column_types, sample)
+        )
+        with self.connect() as conn:
+            if self.rollups:
+                RollupManager.setup(conn)
+            with conn.transaction(), conn.cursor() as cursor:
+                # Rollup materialized views depend on the table being replaced
+                RollupManager().drop(conn, table_name)
+                pending = itertools.chain([first], attempt)
+                while True:
+                    try:
+                        with conn.transaction():
+                            self.create_table(cursor, table_name, columns, column_types)
+                            rows = self.copy_batches(
+                                cursor, pending, table_name, columns
+                            )
+                        break
+                    except psycopg.DataError as e:
+                        if not self.widen(e, column_types, columns, sample):
+                            raise
+                        close = getattr(attempt, "close", None)
+                        if close is not None:
+                            close()
+                        attempt = pending = batches()
+                self.create_indexes(cursor, table_name, index_columns)
+                cursor.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table_name)))
+                rollups = (
+                    RollupManager().create(conn, table_name) if self.rollups else []
+                )
+        elapsed = time.perf_counter() - start
+        self.report(table_name, rows, elapsed, column_types, index_columns, rollups)
+        return rows
+
+    def load_partitioned(self, table_name: str, rows: int) -> int:
+        """Load a generator that splits its rows into range partitions.
+
+        The partitioned table is created first; worker processes then each
+        generate and COPY whole partitions in parallel and build their BRIN
+        indexes, which the parent's indexes attach afterwards.
+        """
+        start = time.perf_counter()
+        partitions = self.create_partitioned(table_name, rows)
+        workers = min(self.load_workers, len(partitions))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    _load_partition, *self.partition_args(table_name, partition)
+                )
+                for partition in partitions
+            ]
+            loaded = sum(future.result() for future in futures)
+        self.finish_partitioned(table_name, loaded, time.perf_counter() - start)
+        if self.verbose:
+            print(
+                f"{len(partitions)} partitions loaded by {workers} workers; "
+                f"BRIN: {', '.join(self.brin_columns())}"
+            )
+        return loaded
+
+    def brin_columns(self) -> List[str]:
+        return [col.lower() for col in getattr(self.generator, "brin_columns", [])]
+
+    def partitioned_index_columns(self) -> List[str]:
+        columns = (
+            self.index_columns
+            if self.index_columns is not None
+            else getattr(self.generator, "index_columns", [])
+        )
+        return [col.lower() for col in columns]
 
-    def seed(self, file_name: str, table_name: str, rows: int = 100) -> None:
+    def partitioned_column_types(self) -> ColumnTypes:
+        columns = self.normalize_columns(self.generator.fieldnames)
+        return self.column_types_for(columns, [])
+
+    def create_partitioned(self, table_name: str, rows: int) -> List[Partition]:
+        partitions = self.generator.partitions(rows)
+        columns = self.normalize_columns(self.generator.fieldnames)
+        with self.connect() as conn:
+            with conn.transaction(), conn.cursor() as cursor:
+                # Rollup materialized views depend on the table being replaced
+                RollupManager().drop(conn, table_name)
+                self.create_table(
+                    cursor,
+                    table_name,
+                    columns,
+                    self.partitioned_column_types(),
+                    self.generator.partition_column.lower(),
+                )
+                self.create_partitions(cursor, table_name, partitions)
+        return partitions
+
+    def partition_args(self, table_name: str, partition: Partition) -> Tuple:
+        """Arguments of _load_partition for one partition."""
+        return (
+            self.params,
+            self.generator,
+            table_name,
+            self.normalize_columns(self.generator.fieldnames),
+            partition,
+            self.brin_columns(),
+        )
+
+    def finish_partitioned(self, table_name: str, rows: int, elapsed: float) -> None:
+        index_columns = self.partitioned_index_columns()
+        with self.connect() as conn:
+            if self.rollups:
+                RollupManager.setup(conn)
+            with conn.transaction(), conn.cursor() as cursor:
+                self.create_indexes(
+                    cursor, table_name, self.brin_columns(), method="brin"
+                )
+                self.create_indexes(cursor, table_name, index_columns)
+                cursor.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(table_name)))
+                rollups = (
+                    RollupManager().create(conn, table_name) if self.rollups else []
+                )
+        self.report(
+            table_name,
+            rows,
+            elapsed,
+            self.partitioned_column_types(),
+            index_columns,
+            rollups,
+        )
+
+    def report(
+        self,
+        table_name: str,
+        rows: int,
+        elapsed: float,
+        column_types: ColumnTypes,
+        index_columns: List[str],
+        rollups: List[Any],
+    ) -> None:
+        if not self.verbose:
+            return
+        print(
+            f"Loaded {rows} rows into {table_name} in {elapsed:.2f}s "
+            f"({rows / max(elapsed, 1e-9):,.0f} rows/sec)"
+        )
+        print(
+            "Columns: "
+            + ", ".join(
+                f"{col} {t if isinstance(t, str) else 'enum'}"
+                for col, t in column_types.items()
+            )
+        )
+        if index_columns:
+            print(f"Indexed: {', '.join(index_columns)}")
+        if rollups:
+            print(f"Rollups: {', '.join(rollup.name for rollup in rollups)}")
+
+    def upload_csv_to_postgres(self, file_name: str, table_name: str) -> int:
+        with open(file_name, newline="") as csvfile:
+            columns = self.normalize_columns(next(csv.reader([csvfile.readline()])))
+            body = csvfile.tell()
+
+            def chunks() -> Iterator[str]:
+                csvfile.seek(body)
+                return iter(lambda: csvfile.read(self.chunk_size), "")
+
+            return self.load(table_name, columns, chunks)
+
+    def pipeline(self, batches: Iterator[str]) -> Iterator[str]:
+        # Generate on a producer thread so the next batch is being built while
+        # the current one is written to COPY; the bounded queue caps memory.
+        queue: Queue = Queue(maxsize=self.queue_size)
+        stop = Event()
+
+        def put(item: Any) -> None:
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Full:
+                    continue
+
+        def produce() -> None:
+            try:
+                for batch in batches:
+                    if stop.is_set():
+                        break
+                    put(batch)
+                put(_DONE)
+            except BaseException as e:
+                put(e)
+            finally:
+                close = getattr(batches, "close", None)
+                if close is not None:
+                    close()
+
+        producer = Thread(target=produce, daemon=True)
+        producer.start()
         try:
-            self.generator.generate_csv(file_name, rows)
-            self.create_table(table_name, file_name)
-            self.upload_csv_to_postgres(file_name, table_name)
+            while True:
+                try:
+                    item = queue.get(timeout=0.1)
+                except Empty:
+                    if producer.is_alive():
+                        continue
+                    # It may have queued its last item just before exiting
+                    try:
+                        item = queue.get_nowait()
+                    except Empty:
+                        raise RuntimeError("Batch producer exited unexpectedly")
+                if item is _DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            producer.join()
+
+    @staticmethod
+    def tee(
+        batches: Iterable[str], file_name: str, columns: List[str]
+    ) -> Iterator[str]:
+        with open(file_name, "w", newline="") as csvfile:
+            csvfile.write(",".join(columns) + "\n")
+            for batch in batches:
+                csvfile.write(batch)
+                yield batch
+
+    def seed(
+        self, table_name: str, rows: int = 100, export_file: Optional[str] = None
+    ) -> int:
+        try:
+            if getattr(self.generator, "partition_column", None) is not None:
+                if export_file is not None:
+                    raise ValueError(
+                        "export_file is not supported for partitioned generators; "
+                        "use generate_csv instead"
+                    )
+                return self.load_partitioned(table_name, rows)
+
+            def batches() -> Iterator[str]:
+                # Generators are seeded, so a retry regenerates the same rows
+                generated = self.pipeline(self.generator.iter_csv(rows))
+                if export_file is None:
+                    return generated
+                return self.tee(generated, export_file, self.generator.fieldnames)
+
+            columns = self.normalize_columns(self.generator.fieldnames)
+            return self.load(table_name, columns, batches)
         except Exception as e:
             print(f"An error occurred: {e}")
-            self.drop_table(table_name)
             raise e
+
+    def drop_table(self, table_name: str) -> None:
+        with self.connect() as conn:
+            conn.execute(
+                sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table_name))
+            )
@@ -0,0 +1,255 @@
+import hashlib
+import importlib
+import json
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from dataclasses import asdict, dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import psycopg
+import toml
+from psycopg import sql
+from db.seed import Seeder, _load_partition
+from rollups import ROLLUP_SCHEMA, RollupManager
+
+GENERATORS = {
+    "oil_data": "db.generators.oil_data:OilDataGenerator",
+    "mining_data": "db.generators.mining_data:MiningDataGenerator",
+    "production_data": "db.generators.production_data:ProductionDataGenerator",
+}
+
+STATE_TABLE = sql.Identifier(ROLLUP_SCHEMA, "seeded_tables")
+STATE_SETUP = [
+    sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(ROLLUP_SCHEMA)),
+    sql.SQL(
+        "CREATE TABLE IF NOT EXISTS {} (table_name text PRIMARY KEY, "
+        "fingerprint text NOT NULL, rows bigint NOT NULL, seeded_at timestamptz)"
+    ).format(STATE_TABLE),
+]
+
+
+@dataclass
+class SeedEntry:
+    """One table of a seed plan.
+
+    ``generator`` is a name from GENERATORS or a ``module:Class`` path;
+    ``options`` are passed to the generator and ``seeder`` to the Seeder.
+    """
+
+    table: str
+    generator: str
+    rows: int
+    seed: Optional[int] = None
+    options: Dict[str, Any] = field(default_factory=dict)
+    seeder: Dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def fingerprint(self) -> str:
+        text = json.dumps(asdict(self), sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def build_generator(self) -> Any:
+        module, _, name = GENERATORS.get(self.generator, self.generator).partition(":")
+        generator_class = getattr(importlib.import_module(module), name)
+        # The plan's process pool already runs one table per worker
+        options = {"workers": 1, **self.options}
+        if self.seed is not None:
+            options["seed"] = self.seed
+        return generator_class(**options)
+
+    def build_seeder(self) -> Seeder:
+        return Seeder(self.build_generator(), verbose=False, **self.seeder)
+
+
+@dataclass
+class TableProgress:
+    entry: SeedEntry
+    tasks: int
+    done: int = 0
+    rows: int = 0
+    started: float = float("inf")
+    finished: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def seconds(self) -> float:
+        return max(self.finished - self.started, 1e-9)
+
+
+def _timed(function: Callable[..., int], *args: Any) -> Tuple[int, float, float]:
+    started = time.time()
+    rows = function(*args)
+    return rows, started, time.time()
+
+
+def _seed_table(entry: SeedEntry) -> int:
+    return entry.build_seeder().seed(entry.table, entry.rows)
+
+
+class SeedPlan:
+    """Seeds the tables listed in a TOML or JSON plan on a process pool.
+
+    Each table is loaded by one worker, except those of partitioned
+    generators, which get one task per partition; every task opens its own
+    connection. A fingerprint of each entry is stored in the database after
+    it loads, and entries whose fingerprint and table are unchanged are
+    skipped on the next run.
+    """
+
+    def __init__(self, entries: List[SeedEntry], workers: Optional[int] = None):
+        self.entries = entries
+        self.workers = workers or os.cpu_count() or 1
+
+    @classmethod
+    def load(cls, path: str) -> "SeedPlan":
+        with open(path) as f:
+            if path.endswith(".json"):
+                plan = json.load(f)
+            else:
+                plan = toml.load(f)
+        entries = [SeedEntry(**table) for table in plan.get("tables", [])]
+        names = [entry.table for entry in entries]
+        duplicates = {name for name in names if names.count(name) > 1}
+        if duplicates:
+            raise ValueError(f"Tables listed twice in {path}: {', '.join(duplicates)}")
+        return cls(entries, plan.get("workers"))
+
+    @staticmethod
+    def seeded(conn: psycopg.Connection) -> Dict[str, str]:
+        """Fingerprints of the plan entries whose tables still exist."""
+        for statement in STATE_SETUP:
+            conn.execute(statement)
+        rows = conn.execute(
+            sql.SQL(
+                "SELECT table_name, fingerprint FROM {} "
+                "WHERE to_regclass(quote_ident(table_name)) IS NOT NULL"
+            ).format(STATE_TABLE)
+        ).fetchall()
+        return dict(rows)
+
+    @staticmethod
+    def record(conn: psycopg.Connection, entry: SeedEntry, rows: int) -> None:
+        conn.execute(
+            sql.SQL(
+                "INSERT INTO {} (table_name, fingerprint, rows, seeded_at) "
+                "VALUES (%s, %s, %s, now()) ON CONFLICT (table_name) DO UPDATE "
+                "SET fingerprint = excluded.fingerprint, rows = excluded.rows, "
+                "seeded_at = excluded.seeded_at"
+            ).format(STATE_TABLE),
+            [entry.table, entry.fingerprint, rows],
+        )
+
+    def changed(
+        self,
+        conn: psycopg.Connection,
+        tables: Optional[List[str]] = None,
+        force: bool = False,
+    ) -> List[SeedEntry]:
+        seeded = {} if force else self.seeded(conn)
+        return [
+            entry
+            for entry in self.entries
+            if (not tables or entry.table in tables)
+            and seeded.get(entry.table) != entry.fingerprint
+        ]
+
+    def run(self, tables: Optional[List[str]] = None, force: bool = False) -> bool:
+        """Seed the changed tables; returns whether all of them loaded."""
+        start = time.perf_counter()
+        with psycopg.connect(**Seeder(None).params, autocommit=True) as conn:
+            # Once up front, so the workers find the rollup catalog in place
+            RollupManager.setup(conn)
+            pending = self.changed(conn, tables, force)
+            skipped = [
+                entry.table
+                for entry in self.entries
+                if entry not in pending and (not tables or entry.table in tables)
+            ]
+            if skipped:
+                print(f"Unchanged, skipping: {', '.join(skipped)}")
+            if not pending:
+                print("Nothing to seed.")
+                return True
+            # Largest tasks first, so a big table does not start last and
+            # hold up the end of the run on its own.
+            progress: Dict[str, TableProgress] = {}
+            seeders: Dict[str, Seeder] = {}
+            tasks: List[Tuple[int, str, Callable[..., int], Tuple]] = []
+            for entry in pending:
+                seeder = entry.build_seeder()
+                if getattr(seeder.generator, "partition_column", None) is None:
+                    progress[entry.table] = TableProgress(entry, 1)
+                    tasks.append((entry.rows, entry.table, _seed_table, (entry,)))
+                    continue
+                partitions = seeder.create_partitioned(entry.table, entry.rows)
+                seeders[entry.table] = seeder
+                progress[entry.table] = TableProgress(entry, len(partitions))
+                for partition in partitions:
+                    tasks.append(
+                        (
+                            partition.rows,
+                            entry.table,
+                            _load_partition,
+                            seeder.partition_args(entry.table, partition),
+                        )
+                    )
+            tasks.sort(key=lambda task: -task[0])
+            workers = min(self.workers, len(tasks))
+            print(
+                f"Seeding {len(pending)} tables ({len(tasks)} tasks) "
+                f"with {workers} workers"
+            )
+
+            finished = 0
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures: Dict[Future, str] = {
+                    executor.submit(_timed, function, *args): table
+                    for _, table, function, args in tasks
+                }
+                for future in as_completed(futures):
+                    table = progress[futures[future]]
+                    if table.error is not None:
+                        continue
+                    try:
+                        rows, started, ended = future.result()
+                    except Exception as e:
+                        table.error = str(e)
+                        finished += 1
+                        print(
+                            f"[{finished}/{len(pending)}] {table.entry.table} "
+                            f"failed: {e}"
+                        )
+                        continue
+                    table.done += 1
+                    table.rows += rows
+                    table.started = min(table.started, started)
+                    table.finished = max(table.finished, ended)
+                    if table.done < table.tasks:
+                        print(
+                            f"  {table.entry.table}: {table.done}/{table.tasks} "
+                            f"partitions, {table.rows:,} rows"
+                        )
+                        continue
+                    if table.entry.table in seeders:
+                        seeders[table.entry.table].finish_partitioned(
+                            table.entry.table, table.rows, table.seconds
+                        )
+                        table.finished = time.time()
+                    self.record(conn, table.entry, table.rows)
+                    finished += 1
+                    print(
+                        f"[{finished}/{len(pending)}] {table.entry.table}: "
+                        f"{table.rows:,} rows in {table.seconds:.1f}s "
+                        f"({table.rows / table.seconds:,.0f} rows/sec)"
+                    )
+
+        elapsed = time.perf_counter() - start
+        total = sum(table.rows for table in progress.values() if table.error is None)
+        failed = [table.entry.table for table in progress.values() if table.error]
+        print(
+            f"Seeded {len(progress) - len(failed)} tables, {total:,} rows in "
+            f"{elapsed:.1f}s ({total / max(elapsed, 1e-9):,.0f} rows/sec)"
+        )
+        if failed:
+            print(f"Failed: {', '.join(failed)}")
+        return not failed
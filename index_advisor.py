@@ -0,0 +1,363 @@
+import os
+import psycopg
+import sqlglot
+
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple
+from psycopg import sql
+from sqlglot import exp
+from query_executor import explain_plan, strip_statement
+from schema_index import Schema
+from sql_validator import identifier_name
+from workload_log import WorkloadEntry
+
+MAX_CANDIDATES = 10
+MAX_QUERIES_PER_CANDIDATE = 50
+MIN_IMPROVEMENT = 0.2
+FILTER_EXPRESSIONS = (
+    exp.EQ,
+    exp.GT,
+    exp.GTE,
+    exp.LT,
+    exp.LTE,
+    exp.In,
+    exp.Between,
+    exp.Like,
+)
+
+EXISTING_INDEXES_QUERY = """
+SELECT array_agg(a.attname ORDER BY k.ord)
+FROM pg_index i
+CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, ord)
+JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = k.attnum
+WHERE i.indrelid = to_regclass(%s)
+GROUP BY i.indexrelid;
+"""
+
+
+def advisor_trial_rows() -> int:
+    return int(os.getenv("NLQ_ADVISOR_TRIAL_ROWS", 1_000_000))
+
+
+@dataclass
+class ColumnUse:
+    table: str
+    column: str
+    kind: str
+
+
+@dataclass
+class HotColumn:
+    table: str
+    column: str
+    kind: str
+    queries: int = 0
+    seq_scan_queries: int = 0
+    seconds: float = 0.0
+
+
+@dataclass
+class Recommendation:
+    table: str
+    columns: Tuple[str, ...]
+    queries: int
+    cost_before: float
+    cost_after: Optional[float] = None
+    method: str = "none"
+    ddl: str = ""
+
+    @property
+    def improvement(self) -> Optional[float]:
+        if self.cost_after is None or not self.cost_before:
+            return None
+        return 1 - self.cost_after / self.cost_before
+
+    @property
+    def recommended(self) -> bool:
+        return self.improvement is not None and self.improvement >= MIN_IMPROVEMENT
+
+    def describe(self) -> str:
+        text = f"{self.table} ({', '.join(self.columns)}): {self.queries} queries"
+        if self.improvement is not None:
+            text += (
+                f", cost {self.cost_before:,.0f} → {self.cost_after:,.0f} "
+                f"({self.improvement:.0%} less, {self.method})"
+            )
+        return text
+
+
+def seq_scanned_tables(
+    plan: Optional[Dict[str, Any]], partitions: Optional[Dict[str, str]] = None
+) -> Set[str]:
+    """Tables the plan reads with a sequential scan, partitions as their parent."""
+    partitions = partitions or {}
+    tables = set()
+    nodes = [plan] if plan else []
+    while nodes:
+        node = nodes.pop()
+        if node["Node Type"] == "Seq Scan" and node.get("Relation Name"):
+            name = node["Relation Name"]
+            tables.add(partitions.get(name, name))
+        nodes.extend(node.get("Plans", []))
+    return tables
+
+
+def column_uses(query: str, schema: Schema) -> List[ColumnUse]:
+    """Columns a query filters, joins or groups on, resolved to their tables."""
+    try:
+        tree = sqlglot.parse_one(strip_statement(query), read="postgres")
+    except sqlglot.errors.ParseError:
+        return []
+    if tree is None:
+        return []
+
+    ctes = {identifier_name(cte.args["alias"].this) for cte in tree.find_all(exp.CTE)}
+    tables: Dict[str, str] = {}
+    for table in tree.find_all(exp.Table):
+        name = identifier_name(table.this) if table.name else ""
+        if not name or name in ctes or name not in schema:
+            continue
+        tables[
+            identifier_name(table.args["alias"].this) if table.alias else name
+        ] = name
+
+    def resolve(column: exp.Column) -> Optional[Tuple[str, str]]:
+        name = identifier_name(column.this)
+        qualifier = column.args.get("table")
+        if qualifier is not None:
+            table = tables.get(identifier_name(qualifier))
+            return (table, name) if table and name in schema[table] else None
+        owners = {table for table in tables.values() if name in schema[table]}
+        return (owners.pop(), name) if len(owners) == 1 else None
+
+    uses = []
+
+    def add(column: exp.Expression, kind: str) -> None:
+        if isinstance(column, exp.Column):
+            resolved = resolve(column)
+            if resolved is not None:
+                uses.append(ColumnUse(*resolved, kind))
+
+    for predicate in tree.find_all(*FILTER_EXPRESSIONS):
+        left, right = predicate.this, predicate.expression
+        if isinstance(left, exp.Column) and isinstance(right, exp.Column):
+            add(left, "join")
+            add(right, "join")
+        elif isinstance(predicate, (exp.In, exp.Between)):
+            add(left, "filter")
+        else:
+            add(left, "filter")
+            add(right, "filter")
+    for group in tree.find_all(exp.Group):
+        for expression in group.expressions:
+            add(expression, "group")
+    return uses
+
+
+class IndexAdvisor:
+    """Suggests indexes from the workload log.
+
+    Columns that queries filter, join or group on are counted, and those on
+    tables the stored plans read with a sequential scan become candidate
+    indexes. Each candidate is judged by EXPLAINing the logged queries with
+    the index present: as a hypothetical index when the hypopg extension is
+    installed. Otherwise, and only with allow_trial, it is built inside a
+    transaction that is rolled back, on tables up to NLQ_ADVISOR_TRIAL_ROWS
+    rows; the build blocks writes to the table while it runs.
+    """
+
+    def __init__(
+        self,
+        schema: Schema,
+        row_estimates: Optional[Dict[str, int]] = None,
+        partitions: Optional[Dict[str, str]] = None,
+        allow_trial: bool = False,
+    ):
+        self.schema = schema
+        self.row_estimates = row_estimates or {}
+        self.partitions = partitions or {}
+        self.allow_trial = allow_trial
+
+    def hot_columns(self, entries: List[WorkloadEntry]) -> List[HotColumn]:
+        hot: Dict[Tuple[str, str, str], HotColumn] = {}
+        for entry in entries:
+            scanned = seq_scanned_tables(entry.plan, self.partitions)
+            seen = set()
+            for use in column_uses(entry.sql, self.schema):
+                key = (use.table, use.column, use.kind)
+                if key in seen:
+                    continue
+                seen.add(key)
+                column = hot.setdefault(key, HotColumn(*key))
+                column.queries += 1
+                column.seconds += entry.seconds
+                if use.table in scanned:
+                    column.seq_scan_queries += 1
+        return sorted(hot.values(), key=lambda c: (-c.seq_scan_queries, -c.queries))
+
+    def candidates(
+        self, entries: List[WorkloadEntry]
+    ) -> Dict[Tuple[str, Tuple[str, ...]], Counter]:
+        # Candidate index -> how often each logged query would use it
+        candidates: Dict[Tuple[str, Tuple[str, ...]], Counter] = defaultdict(Counter)
+        frequency = Counter(
+            (use.table, use.column)
+            for entry in entries
+            for use in column_uses(entry.sql, self.schema)
+        )
+        for entry in entries:
+            scanned = seq_scanned_tables(entry.plan, self.partitions)
+            filters: Dict[str, List[str]] = defaultdict(list)
+            for use in column_uses(entry.sql, self.schema):
+                if use.table not in scanned:
+                    continue
+                candidates[(use.table, (use.column,))][entry.sql] += 1
+                if use.kind == "filter" and use.column not in filters[use.table]:
+                    filters[use.table].append(use.column)
+            for table, columns in filters.items():
+                if len(columns) > 1:
+                    # The most selective order is unknown; lead with the
+                    # column used most often so the index serves more queries.
+                    columns = sorted(columns, key=lambda c: -frequency[(table, c)])
+                    candidates[(table, tuple(columns[:2]))][entry.sql] += 1
+        return candidates
+
+    @staticmethod
+    def has_hypopg(conn: psycopg.Connection) -> bool:
+        query = "SELECT 1 FROM pg_extension WHERE extname = 'hypopg'"
+        return conn.execute(query).fetchone() is not None
+
+    @staticmethod
+    def existing_indexes(conn: psycopg.Connection, table: str) -> List[List[str]]:
+        return [row[0] for row in conn.execute(EXISTING_INDEXES_QUERY, [table])]
+
+    @staticmethod
+    def query_costs(conn: psycopg.Connection, queries: List[str]) -> List[float]:
+        costs = []
+        for query in queries:
+            plan = explain_plan(conn, strip_statement(query))
+            costs.append(float("nan") if plan is None else plan["Total Cost"])
+        return costs
+
+    def costs_with_index(
+        self,
+        conn: psycopg.Connection,
+        table: str,
+        columns: Tuple[str, ...],
+        queries: List[str],
+        hypopg: bool,
+    ) -> Tuple[Optional[List[float]], str]:
+        statement = sql.SQL("CREATE INDEX ON {} ({})").format(
+            sql.Identifier(table), sql.SQL(", ").join(map(sql.Identifier, columns))
+        )
+        if hypopg:
+            with conn.transaction():
+                conn.execute(
+                    "SELECT * FROM hypopg_create_index(%s)",
+                    [statement.as_string(conn)],
+                )
+                try:
+                    return self.query_costs(conn, queries), "hypopg"
+                finally:
+                    conn.execute("SELECT hypopg_reset()")
+        if (
+            not self.allow_trial
+            or self.row_estimates.get(table, 0) > advisor_trial_rows()
+        ):
+            return None, "none"
+        costs = None
+        with conn.transaction():
+            conn.execute(statement)
+            costs = self.query_costs(conn, queries)
+            raise psycopg.Rollback()
+        return costs, "trial"
+
+    @staticmethod
+    def index_ddl(
+        conn: psycopg.Connection, table: str, columns: Tuple[str, ...]
+    ) -> str:
+        return (
+            sql.SQL("CREATE INDEX CONCURRENTLY IF NOT EXISTS {} ON {} ({})")
+            .format(
+                sql.Identifier(f"{table}_{'_'.join(columns)}_idx"),
+                sql.Identifier(table),
+                sql.SQL(", ").join(map(sql.Identifier, columns)),
+            )
+            .as_string(conn)
+        )
+
+    def advise(
+        self, conn: psycopg.Connection, entries: List[WorkloadEntry]
+    ) -> List[Recommendation]:
+        # Trial indexes are built in savepoints of this transaction
+        with conn.transaction():
+            return self.evaluate(conn, entries)
+
+    def evaluate(
+        self, conn: psycopg.Connection, entries: List[WorkloadEntry]
+    ) -> List[Recommendation]:
+        hypopg = self.has_hypopg(conn)
+        candidates = sorted(
+            self.candidates(entries).items(), key=lambda item: -sum(item[1].values())
+        )
+        results = []
+        existing: Dict[str, List[List[str]]] = {}
+        for (table, columns), uses in candidates:
+            if table not in existing:
+                existing[table] = self.existing_indexes(conn, table)
+            if any(index[: len(columns)] == list(columns) for index in existing[table]):
+                continue
+            if len(results) == MAX_CANDIDATES:
+                break
+            queries = [
+                query for query, _ in uses.most_common(MAX_QUERIES_PER_CANDIDATE)
+            ]
+            weights = [uses[query] for query in queries]
+            before = self.query_costs(conn, queries)
+            after, method = self.costs_with_index(conn, table, columns, queries, hypopg)
+            recommendation = Recommendation(
+                table,
+                columns,
+                sum(weights),
+                sum(w * c for w, c in zip(weights, before) if c == c),
+                method=method,
+                ddl=self.index_ddl(conn, table, columns),
+            )
+            if after is not None:
+                recommendation.cost_after = sum(
+                    w * (a if a == a else b)
+                    for w, a, b in zip(weights, after, before)
+                    if b == b
+                )
+            results.append(recommendation)
+
+        # A recommended composite index also serves the queries on its
+        # leading columns, so those are not recommended separately.
+        results.sort(
+            key=lambda r: (
+                -len(r.columns),
+                -(r.cost_before - (r.cost_after or r.cost_before)),
+            )
+        )
+        chosen: List[Recommendation] = []
+        for result in results:
+            if any(
+                other.recommended
+                and other.table == result.table
+                and other.columns[: len(result.columns)] == result.columns
+                for other in chosen
+            ):
+                continue
+            chosen.append(result)
+        return sorted(chosen, key=lambda r: not r.recommended)
+
+    @staticmethod
+    def apply(conn: psycopg.Connection, recommendation: Recommendation) -> None:
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction block
+        autocommit = conn.autocommit
+        conn.autocommit = True
+        try:
+            conn.execute(recommendation.ddl)
+        finally:
+            conn.autocommit = autocommit
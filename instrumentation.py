@@ -0,0 +1,172 @@
+import functools
+import json
+import os
+import resource
+import threading
+import time
+import psutil
+
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+# Attributes that are summed per stage for the Prometheus endpoint
+COUNTED_ATTRIBUTES = ("rows", "bytes", "prompt_tokens", "completion_tokens")
+
+_collector: ContextVar[Optional[List["Span"]]] = ContextVar(
+    "nlq_span_collector", default=None
+)
+
+
+@dataclass
+class Span:
+    name: str
+    started_at: float
+    seconds: float = 0.0
+    attributes: Dict[str, Any] = field(default_factory=dict)
+
+    def set(self, **attributes: Any) -> None:
+        self.attributes.update(attributes)
+
+
+class Tracer:
+    """Times pipeline stages and exports them as JSONL and Prometheus text.
+
+    Spans are also handed to the innermost collect() block of the current
+    context, which is how a tab gets the spans of its own query.
+    """
+
+    def __init__(self, trace_file: Optional[str] = None):
+        self.trace_file = trace_file or os.getenv("NLQ_TRACE_FILE")
+        self.totals: Dict[str, Dict[str, float]] = defaultdict(
+            lambda: defaultdict(float)
+        )
+        self.process = psutil.Process()
+        self.server: Optional[ThreadingHTTPServer] = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Span]:
+        span = Span(name, time.time(), attributes=attributes)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.set(error=type(e).__name__)
+            raise
+        finally:
+            span.seconds = time.perf_counter() - start
+            # ru_maxrss is the high-water mark of the whole process so far,
+            # not of this span; it is in kilobytes on Linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+            span.set(
+                rss_bytes=self.process.memory_info().rss,
+                process_peak_rss_bytes=peak,
+            )
+            self.record(span)
+
+    def record(self, span: Span) -> None:
+        spans = _collector.get()
+        if spans is not None:
+            spans.append(span)
+        with self._lock:
+            totals = self.totals[span.name]
+            totals["count"] += 1
+            totals["seconds"] += span.seconds
+            for attribute in COUNTED_ATTRIBUTES:
+                value = span.attributes.get(attribute)
+                if isinstance(value, (int, float)):
+                    totals[attribute] += value
+            if self.trace_file:
+                with open(self.trace_file, "a") as f:
+                    f.write(json.dumps(asdict(span), default=str) + "\n")
+
+    def prometheus(self) -> str:
+        lines = [
+            "# HELP nlq_stage_seconds Time spent in each NLQ pipeline stage.",
+            "# TYPE nlq_stage_seconds summary",
+        ]
+        with self._lock:
+            totals = {name: dict(values) for name, values in self.totals.items()}
+        for name, values in sorted(totals.items()):
+            lines.append(
+                f'nlq_stage_seconds_count{{stage="{name}"}} {values["count"]:g}'
+            )
+            lines.append(f'nlq_stage_seconds_sum{{stage="{name}"}} {values["seconds"]}')
+        for attribute in COUNTED_ATTRIBUTES:
+            lines.append(f"# TYPE nlq_stage_{attribute}_total counter")
+            for name, values in sorted(totals.items()):
+                if attribute in values:
+                    lines.append(
+                        f'nlq_stage_{attribute}_total{{stage="{name}"}} '
+                        f"{values[attribute]:g}"
+                    )
+        lines.append("# TYPE nlq_process_resident_memory_bytes gauge")
+        lines.append(
+            f"nlq_process_resident_memory_bytes {self.process.memory_info().rss}"
+        )
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> None:
+        """Serve /metrics in Prometheus text format from a daemon thread."""
+        if self.server is not None:
+            return
+        tracer = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = tracer.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(
+            target=self.server.serve_forever, name="nlq-metrics", daemon=True
+        ).start()
+
+
+tracer = Tracer()
+
+
+def span(name: str, **attributes: Any):
+    return tracer.span(name, **attributes)
+
+
+def traced(name: str) -> Callable:
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with tracer.span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def collect(spans: Optional[List[Span]] = None) -> Iterator[List[Span]]:
+    spans = spans if spans is not None else []
+    token = _collector.set(spans)
+    try:
+        yield spans
+    finally:
+        _collector.reset(token)
+
+
+def serve_metrics() -> None:
+    port = os.getenv("NLQ_METRICS_PORT")
+    if port:
+        tracer.serve(int(port), os.getenv("NLQ_METRICS_HOST", "127.0.0.1"))
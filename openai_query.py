@@ -1,12 +1,40 @@
-from openai import OpenAI
-from typing import List, Dict
+import asyncio
+import time
+
+from openai import AsyncOpenAI, OpenAI
+from typing import Callable, List, Dict, Optional, Tuple
+from conversation_history import ConversationHistory
+from instrumentation import Span, span
+from schema_index import SchemaIndex
+from sql_validator import (
+    SQLValidationError,
+    SQLValidator,
+    ValidationResult,
+    complete_statement,
+)
+from translation_cache import TranslationCache
 
 
 class OpenAIQuery:
-    def __init__(self, api_key: str, model_id: str = "gpt-3.5-turbo"):
+    def __init__(
+        self,
+        api_key: str,
+        model_id: str = "gpt-3.5-turbo",
+        cache: Optional[TranslationCache] = None,
+        schema_fingerprint: str = "",
+        schema_index: Optional[SchemaIndex] = None,
+        history: Optional[ConversationHistory] = None,
+        validator: Optional[SQLValidator] = None,
+    ):
         self._client = None
+        self._async_client = None
         self.model_id = model_id
         self.api_key = api_key
+        self.cache = cache
+        self.schema_fingerprint = schema_fingerprint
+        self.schema_index = schema_index
+        self.history = history or ConversationHistory(model_id)
+        self.validator = validator or SQLValidator()
         self.query: List[Dict[str, str]] = []
 
     @property
@@ -15,6 +43,17 @@ class OpenAIQuery:
             self._client = OpenAI(api_key=self.api_key)
         return self._client
 
+    @property
+    def async_client(self):
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(api_key=self.api_key)
+        return self._async_client
+
+    @async_client.setter
+    def async_client(self, client: AsyncOpenAI) -> None:
+        # Lets callers share one client, and its connection pool, across queries
+        self._async_client = client
+
     def create_system_message(self, formatted_schema: str) -> Dict[str, str]:
         return {
             "role": "system",
@@ -30,22 +69,174 @@ class OpenAIQuery:
             ),
         }
 
+    def update_system_message(
+        self, query_log: List[Dict[str, str]], question: str
+    ) -> None:
+        # Swap in only the tables relevant to this question; keep the previous
+        # selection when nothing matches so follow-up questions stay grounded.
+        if self.schema_index is None or not query_log:
+            return
+        pruned_schema = self.schema_index.prompt_schema(question)
+        if pruned_schema is not None and query_log[0]["role"] == "system":
+            query_log[0] = self.create_system_message(pruned_schema)
+
     def handle_user_input(self) -> str:
         prompt = input("Enter your query: ")
+        self.update_system_message(self.query, prompt)
         self.query.append({"role": "user", "content": prompt})
         self.query = self.nlq_conversation(self.query)
         model_query = self.query[-1]["content"]
         print(model_query)
         return model_query
 
-    def nlq_conversation(self, query_log: List[Dict[str, str]]) -> List[Dict[str, str]]:
-        response = self.client.chat.completions.create(
-            model=self.model_id, messages=query_log
+    def lookup_cache(
+        self, query_log: List[Dict[str, str]]
+    ) -> Tuple[Optional[str], Optional[str]]:
+        if self.cache is None or not query_log or query_log[-1]["role"] != "user":
+            return None, None
+        cache_key = self.cache.make_key(
+            query_log[-1]["content"],
+            self.schema_fingerprint,
+            self.model_id,
+            query_log[:-1],
         )
-        query_log.append(
+        content = self.cache.get(cache_key)
+        if content is None:
+            return cache_key, None
+        # Entries may predate the validator or a stricter schema
+        result = self.validator.validate(content)
+        if not result.valid:
+            self.cache.delete(cache_key)
+            return cache_key, None
+        return cache_key, result.sql
+
+    @staticmethod
+    def repair_messages(
+        messages: List[Dict[str, str]], result: ValidationResult
+    ) -> List[Dict[str, str]]:
+        return messages + [
+            {"role": "assistant", "content": result.sql},
             {
-                "role": response.choices[0].message.role,
-                "content": response.choices[0].message.content.strip(),
-            }
-        )
+                "role": "user",
+                "content": (
+                    f"That query is invalid: {'; '.join(result.errors)}. "
+                    f"Reply with only the corrected SQL query ending in ';'."
+                ),
+            },
+        ]
+
+    @staticmethod
+    def checked_sql(result: ValidationResult) -> str:
+        if not result.valid:
+            raise SQLValidationError(
+                f"Generated SQL is invalid: {'; '.join(result.errors)}"
+            )
+        return result.sql
+
+    def record_usage(
+        self, completion_span: Span, messages: List[Dict[str, str]], text: str, usage
+    ) -> None:
+        # Streamed responses carry no usage, so count those tokens locally
+        if usage is not None:
+            completion_span.set(
+                prompt_tokens=usage.prompt_tokens,
+                completion_tokens=usage.completion_tokens,
+            )
+        else:
+            completion_span.set(
+                prompt_tokens=self.history.count_messages(messages),
+                completion_tokens=self.history.count(text),
+            )
+
+    def complete(self, messages: List[Dict[str, str]]) -> str:
+        with span("llm.completion", model=self.model_id) as completion_span:
+            response = self.client.chat.completions.create(
+                model=self.model_id, messages=messages
+            )
+            text = response.choices[0].message.content.strip()
+            self.record_usage(completion_span, messages, text, response.usage)
+        return text
+
+    def nlq_conversation(self, query_log: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        with span("llm.translate") as translate_span:
+            cache_key, content = self.lookup_cache(query_log)
+            translate_span.set(cache_hit=content is not None)
+            if content is None:
+                # Invalid SQL gets one repair round trip to the model and never
+                # reaches the database.
+                messages = self.history.fit(query_log)
+                result = self.validator.validate(self.complete(messages))
+                if not result.valid:
+                    repaired = self.complete(self.repair_messages(messages, result))
+                    result = self.validator.validate(repaired)
+                content = self.checked_sql(result)
+                if cache_key is not None:
+                    self.cache.set(cache_key, content)
+
+        query_log.append({"role": "assistant", "content": content})
+        return query_log
+
+    async def complete_async(
+        self,
+        messages: List[Dict[str, str]],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> str:
+        with span(
+            "llm.completion", model=self.model_id, streamed=on_text is not None
+        ) as completion_span:
+            if on_text is None:
+                response = await self.async_client.chat.completions.create(
+                    model=self.model_id, messages=messages
+                )
+                text = response.choices[0].message.content.strip()
+                self.record_usage(completion_span, messages, text, response.usage)
+                return text
+
+            stream = await self.async_client.chat.completions.create(
+                model=self.model_id, messages=messages, stream=True
+            )
+            text = ""
+            try:
+                async for chunk in stream:
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    if not text:
+                        completion_span.set(
+                            first_token_seconds=time.time() - completion_span.started_at
+                        )
+                    text += chunk.choices[0].delta.content
+                    on_text(text)
+                    # Stop reading once a whole statement has arrived so it can
+                    # run without waiting for any trailing tokens.
+                    if complete_statement(text):
+                        break
+            finally:
+                await stream.close()
+            self.record_usage(completion_span, messages, text, None)
+        return text.strip()
+
+    async def nlq_conversation_async(
+        self,
+        query_log: List[Dict[str, str]],
+        on_text: Optional[Callable[[str], None]] = None,
+    ) -> List[Dict[str, str]]:
+        with span("llm.translate") as translate_span:
+            # The cache is backed by SQLite, which must not block the event loop
+            cache_key, content = await asyncio.to_thread(self.lookup_cache, query_log)
+            translate_span.set(cache_hit=content is not None)
+            if content is None:
+                messages = self.history.fit(query_log)
+                result = self.validator.validate(
+                    await self.complete_async(messages, on_text)
+                )
+                if not result.valid:
+                    repaired = await self.complete_async(
+                        self.repair_messages(messages, result), on_text
+                    )
+                    result = self.validator.validate(repaired)
+                content = self.checked_sql(result)
+                if cache_key is not None:
+                    await asyncio.to_thread(self.cache.set, cache_key, content)
+
+        query_log.append({"role": "assistant", "content": content})
         return query_log
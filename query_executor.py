@@ -0,0 +1,325 @@
+import os
+import re
+import uuid
+import psycopg
+import pyarrow as pa
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+from psycopg.types.numeric import NumericBinaryLoader
+from psycopg.types.string import TextBinaryLoader
+from instrumentation import span
+from utils import NUMERIC, arrow_schema, format_as_arrow, numeric_text_to_decimal
+
+FETCH_BATCH_SIZE = 2_000
+
+
+def page_size() -> int:
+    return int(os.getenv("NLQ_PAGE_SIZE", 10_000))
+
+
+def max_result_rows() -> int:
+    return int(os.getenv("NLQ_MAX_RESULT_ROWS", 100_000))
+
+
+def statement_timeout_ms() -> int:
+    return int(os.getenv("NLQ_STATEMENT_TIMEOUT_MS", 60_000))
+
+
+# For sampling data to plot, where float64 precision is plenty; query results
+# keep numeric values exact.
+class NumericAsFloatBinaryLoader(NumericBinaryLoader):
+    def load(self, data):
+        value = super().load(data)
+        return None if value is None else float(value)
+
+
+# Enums have no binary loader, so binary cursors would return their labels
+# as bytes; the binary form of an enum value is the label's text.
+ENUM_TYPES = "SELECT array_agg(oid) FROM pg_type WHERE typtype = 'e'"
+
+
+def enum_types(conn: psycopg.Connection) -> List[int]:
+    return conn.execute(ENUM_TYPES).fetchone()[0] or []
+
+
+async def enum_types_async(conn: psycopg.AsyncConnection) -> List[int]:
+    cursor = await conn.execute(ENUM_TYPES)
+    return (await cursor.fetchone())[0] or []
+
+
+def register_loaders(
+    cursor: Any, enums: List[int], numeric_as_float: bool = False
+) -> None:
+    """Loaders of a binary cursor for types the defaults do not cover."""
+    if numeric_as_float:
+        cursor.adapters.register_loader("numeric", NumericAsFloatBinaryLoader)
+    for oid in enums:
+        cursor.adapters.register_loader(oid, TextBinaryLoader)
+
+
+@dataclass
+class ResultPage:
+    table: pa.Table = field(default_factory=lambda: pa.table({}))
+    offset: int = 0
+    has_more: bool = False
+    estimated_rows: Optional[int] = None
+    # Id of the server-side cursor left open on the rest of the result
+    cursor: Optional[str] = None
+
+    @property
+    def column_names(self) -> List[str]:
+        return self.table.column_names
+
+    @property
+    def num_rows(self) -> int:
+        return self.table.num_rows
+
+
+def strip_statement(query: str) -> str:
+    return query.strip().rstrip(";").strip()
+
+
+QUOTED_RE = re.compile(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"")
+# Statements a WITH query may end in or nest in its CTEs; cursors cannot run
+# them, and their rows must only be read once anyway.
+WRITE_RE = re.compile(
+    r"\b(insert\s+into|update\b.*?\bset|delete\s+from|merge\s+into)\b", re.I | re.S
+)
+
+
+def is_row_query(query: str) -> bool:
+    match = re.match(r"^\(*\s*(select|with|values|table)\b", query, re.I)
+    if match is None:
+        return False
+    if match.group(1).lower() != "with":
+        return True
+    return WRITE_RE.search(QUOTED_RE.sub("''", query)) is None
+
+
+SET_STATEMENT_TIMEOUT = "SELECT set_config('statement_timeout', %s, true)"
+# A later page that cannot continue an open cursor re-runs the query. Without
+# synchronized scans an unchanged table is read from its first block every
+# time, so an unordered result comes back in the same order in practice.
+DISABLE_SYNC_SCANS = "SELECT set_config('synchronize_seqscans', 'off', true)"
+
+
+def page_settings(
+    timeout_ms: Optional[int] = None, offset: int = 0
+) -> List[Tuple[str, List[str]]]:
+    """Transaction-local settings to apply before reading a page."""
+    statements = []
+    if timeout_ms:
+        statements.append((SET_STATEMENT_TIMEOUT, [f"{timeout_ms}ms"]))
+    if offset:
+        statements.append((DISABLE_SYNC_SCANS, []))
+    return statements
+
+
+def explain_statement(query: str) -> str:
+    return f"EXPLAIN (FORMAT JSON) {query}"
+
+
+def plan_root(row: Tuple[Any, ...]) -> Dict[str, Any]:
+    return row[0][0]["Plan"]
+
+
+def explain_plan(conn: psycopg.Connection, query: str) -> Optional[Dict[str, Any]]:
+    try:
+        with span("db.explain"), conn.transaction():
+            row = conn.execute(explain_statement(query)).fetchone()
+        return plan_root(row)
+    except psycopg.Error:
+        return None
+
+
+async def explain_plan_async(
+    conn: psycopg.AsyncConnection, query: str
+) -> Optional[Dict[str, Any]]:
+    try:
+        with span("db.explain"):
+            async with conn.transaction():
+                cursor = await conn.execute(explain_statement(query))
+                row = await cursor.fetchone()
+        return plan_root(row)
+    except psycopg.Error:
+        return None
+
+
+def estimate_rows(conn: psycopg.Connection, query: str) -> Optional[int]:
+    plan = explain_plan(conn, query)
+    return None if plan is None else int(plan["Plan Rows"])
+
+
+async def estimate_rows_async(
+    conn: psycopg.AsyncConnection, query: str
+) -> Optional[int]:
+    plan = await explain_plan_async(conn, query)
+    return None if plan is None else int(plan["Plan Rows"])
+
+
+def description_schema(
+    cursor: psycopg.Cursor, numeric_as_float: bool = False
+) -> pa.Schema:
+    description = cursor.description
+    if numeric_as_float:
+        return arrow_schema(
+            [desc.name for desc in description],
+            [
+                701 if desc.type_code == NUMERIC else desc.type_code
+                for desc in description
+            ],
+        )
+    return arrow_schema(
+        [desc.name for desc in description],
+        [desc.type_code for desc in description],
+        [(desc.precision, desc.scale) for desc in description],
+    )
+
+
+def cursor_name() -> str:
+    return f"nlq_{uuid.uuid4().hex}"
+
+
+# Each binary-format batch goes straight into an Arrow record batch
+def fetch_table(
+    cursor: psycopg.ServerCursor, schema: pa.Schema, rows: int, batch_size: int
+) -> pa.Table:
+    batches = []
+    fetched = 0
+    while fetched < rows:
+        batch = cursor.fetchmany(min(batch_size, rows - fetched))
+        if not batch:
+            break
+        fetched += len(batch)
+        batches.append(format_as_arrow(batch, schema.names, schema))
+    return pa.Table.from_batches(batches, schema=schema)
+
+
+async def fetch_table_async(
+    cursor: psycopg.AsyncServerCursor, schema: pa.Schema, rows: int, batch_size: int
+) -> pa.Table:
+    batches = []
+    fetched = 0
+    while fetched < rows:
+        batch = await cursor.fetchmany(min(batch_size, rows - fetched))
+        if not batch:
+            break
+        fetched += len(batch)
+        batches.append(format_as_arrow(batch, schema.names, schema))
+    return pa.Table.from_batches(batches, schema=schema)
+
+
+def statement_page(cursor: Any, rows: List[Tuple[Any, ...]], offset: int) -> ResultPage:
+    """Page of the rows a statement other than a row query returned."""
+    if cursor.description is None:
+        return ResultPage(offset=offset)
+    schema = description_schema(cursor)
+    batch = format_as_arrow(rows, schema.names, schema)
+    table = pa.Table.from_batches([batch])
+    return ResultPage(numeric_text_to_decimal(table), offset)
+
+
+def fill_page(page: ResultPage, table: pa.Table, limit: int) -> ResultPage:
+    """Fill page with the first limit rows of table; one more means more remain."""
+    page.has_more = table.num_rows > limit
+    page.table = numeric_text_to_decimal(table.slice(0, limit))
+    return page
+
+
+def read_page(
+    conn: psycopg.Connection,
+    query: str,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    batch_size: int = FETCH_BATCH_SIZE,
+    estimate: bool = True,
+    timeout_ms: Optional[int] = None,
+) -> ResultPage:
+    query = strip_statement(query)
+    limit = limit or page_size()
+
+    if not is_row_query(query):
+        with conn.transaction():
+            for statement, args in page_settings(timeout_ms):
+                conn.execute(statement, args)
+            cursor = conn.execute(query)
+            rows = cursor.fetchmany(limit) if cursor.description else []
+            return statement_page(cursor, rows, offset)
+
+    page = ResultPage(offset=offset)
+    if estimate:
+        page.estimated_rows = estimate_rows(conn, query)
+
+    # Named cursors stream rows from the server in batches, so only the
+    # requested page (plus one look-ahead row) is ever held in memory.
+    with conn.transaction():
+        for statement, args in page_settings(timeout_ms, offset):
+            conn.execute(statement, args)
+        enums = enum_types(conn)
+        with conn.cursor(name=cursor_name(), binary=True) as cursor:
+            register_loaders(cursor, enums)
+            cursor.execute(query)
+            if offset:
+                cursor.scroll(offset)
+            schema = description_schema(cursor)
+            table = fetch_table(cursor, schema, limit + 1, batch_size)
+
+    return fill_page(page, table, limit)
+
+
+async def read_page_async(
+    conn: psycopg.AsyncConnection,
+    query: str,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    batch_size: int = FETCH_BATCH_SIZE,
+    estimate: bool = True,
+    timeout_ms: Optional[int] = None,
+) -> ResultPage:
+    query = strip_statement(query)
+    limit = limit or page_size()
+
+    if not is_row_query(query):
+        async with conn.transaction():
+            for statement, args in page_settings(timeout_ms):
+                await conn.execute(statement, args)
+            cursor = await conn.execute(query)
+            rows = await cursor.fetchmany(limit) if cursor.description else []
+            return statement_page(cursor, rows, offset)
+
+    page = ResultPage(offset=offset)
+    if estimate:
+        page.estimated_rows = await estimate_rows_async(conn, query)
+
+    async with conn.transaction():
+        for statement, args in page_settings(timeout_ms, offset):
+            await conn.execute(statement, args)
+        enums = await enum_types_async(conn)
+        async with conn.cursor(name=cursor_name(), binary=True) as cursor:
+            register_loaders(cursor, enums)
+            await cursor.execute(query)
+            if offset:
+                await cursor.scroll(offset)
+            schema = description_schema(cursor)
+            table = await fetch_table_async(cursor, schema, limit + 1, batch_size)
+
+    return fill_page(page, table, limit)
+
+
+def fetch_page(
+    conn: psycopg.Connection, query: str, offset: int = 0, **kwargs
+) -> ResultPage:
+    with span("db.fetch", offset=offset) as fetch_span:
+        page = read_page(conn, query, offset, **kwargs)
+        fetch_span.set(rows=page.num_rows, bytes=page.table.nbytes)
+    return page
+
+
+async def fetch_page_async(
+    conn: psycopg.AsyncConnection, query: str, offset: int = 0, **kwargs
+) -> ResultPage:
+    with span("db.fetch", offset=offset) as fetch_span:
+        page = await read_page_async(conn, query, offset, **kwargs)
+        fetch_span.set(rows=page.num_rows, bytes=page.table.nbytes)
+    return page
@@ -0,0 +1,151 @@
+import os
+import psycopg
+import sqlglot
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+from query_executor import explain_plan, explain_plan_async, strip_statement
+
+PLAN_NODE_TYPES_SHOWN = 4
+
+
+@dataclass
+class PlanSummary:
+    total_cost: float
+    estimated_rows: int
+    node_types: List[str] = field(default_factory=list)
+    seq_scans: List[str] = field(default_factory=list)
+
+    @property
+    def uses_seq_scan(self) -> bool:
+        return bool(self.seq_scans)
+
+    def describe(self) -> str:
+        text = (
+            f"~{self.estimated_rows:,} rows, cost {self.total_cost:,.0f}: "
+            + " → ".join(self.node_types)
+        )
+        if self.seq_scans:
+            text += f" (seq scan on {', '.join(self.seq_scans)})"
+        return text
+
+
+def summarize_plan(plan: Dict[str, Any]) -> PlanSummary:
+    summary = PlanSummary(plan["Total Cost"], int(plan["Plan Rows"]))
+    nodes = [plan]
+    while nodes:
+        node = nodes.pop(0)
+        if node["Node Type"] not in summary.node_types:
+            summary.node_types.append(node["Node Type"])
+        if node["Node Type"] == "Seq Scan" and node.get("Relation Name"):
+            if node["Relation Name"] not in summary.seq_scans:
+                summary.seq_scans.append(node["Relation Name"])
+        nodes.extend(node.get("Plans", []))
+    summary.node_types = summary.node_types[:PLAN_NODE_TYPES_SHOWN]
+    return summary
+
+
+def has_row_limit(query: str) -> bool:
+    try:
+        tree = sqlglot.parse_one(query, read="postgres")
+    except sqlglot.errors.ParseError:
+        return True
+    return tree is None or any(tree.args.get(arg) for arg in ("limit", "fetch"))
+
+
+def add_limit(query: str, rows: int) -> str:
+    # Appended as text so the query runs exactly as written otherwise; the
+    # newline keeps a trailing line comment from swallowing the clause.
+    return f"{strip_statement(query)}\nLIMIT {rows};"
+
+
+@dataclass
+class GuardedQuery:
+    sql: str
+    plan: Optional[PlanSummary] = None
+    verdict: str = "ok"
+    message: str = ""
+    limit_added: Optional[int] = None
+    raw_plan: Optional[Dict[str, Any]] = None
+
+
+def query_confirm_cost() -> float:
+    return float(os.getenv("NLQ_CONFIRM_QUERY_COST", 1_000_000))
+
+
+def query_max_cost() -> float:
+    return float(os.getenv("NLQ_MAX_QUERY_COST", 100_000_000))
+
+
+def auto_limit_rows() -> int:
+    return int(os.getenv("NLQ_AUTO_LIMIT_ROWS", 100_000))
+
+
+class QueryGuard:
+    """Reviews a query's EXPLAIN plan before it runs.
+
+    Queries estimated to return more than auto_limit_rows get a LIMIT.
+    Above confirm_cost the user has to confirm, above max_cost the query is
+    refused. A query that cannot be explained is passed through unchanged
+    so that executing it reports the actual error.
+    """
+
+    def __init__(
+        self,
+        confirm_cost: Optional[float] = None,
+        max_cost: Optional[float] = None,
+        limit_rows: Optional[int] = None,
+    ):
+        self.confirm_cost = confirm_cost or query_confirm_cost()
+        self.max_cost = max_cost or query_max_cost()
+        self.limit_rows = limit_rows or auto_limit_rows()
+
+    def needs_limit(self, query: str, plan: Dict[str, Any]) -> bool:
+        return plan["Plan Rows"] > self.limit_rows and not has_row_limit(query)
+
+    def judge(self, result: GuardedQuery, force: bool) -> None:
+        cost = result.plan.total_cost
+        if cost > self.max_cost:
+            result.verdict = "blocked"
+            result.message = (
+                f"Query blocked: estimated cost {cost:,.0f} is above the limit "
+                f"of {self.max_cost:,.0f}."
+            )
+        elif cost > self.confirm_cost and not force:
+            result.verdict = "confirm"
+            result.message = (
+                f"This query is expensive (estimated cost {cost:,.0f}, "
+                f"~{result.plan.estimated_rows:,} rows). Run it anyway?"
+            )
+
+    def review(
+        self, conn: psycopg.Connection, query: str, force: bool = False
+    ) -> GuardedQuery:
+        plan = explain_plan(conn, query)
+        if plan is None:
+            return GuardedQuery(query)
+        result = GuardedQuery(query)
+        if self.needs_limit(query, plan):
+            result.sql = add_limit(query, self.limit_rows)
+            result.limit_added = self.limit_rows
+            plan = explain_plan(conn, result.sql) or plan
+        result.plan = summarize_plan(plan)
+        result.raw_plan = plan
+        self.judge(result, force)
+        return result
+
+    async def review_async(
+        self, conn: psycopg.AsyncConnection, query: str, force: bool = False
+    ) -> GuardedQuery:
+        plan = await explain_plan_async(conn, query)
+        if plan is None:
+            return GuardedQuery(query)
+        result = GuardedQuery(query)
+        if self.needs_limit(query, plan):
+            result.sql = add_limit(query, self.limit_rows)
+            result.limit_added = self.limit_rows
+            plan = await explain_plan_async(conn, result.sql) or plan
+        result.plan = summarize_plan(plan)
+        result.raw_plan = plan
+        self.judge(result, force)
+        return result
@@ -0,0 +1,263 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import psycopg
+import sqlglot
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
+from sqlglot import exp
+from query_executor import (
+    ResultPage,
+    fetch_page,
+    fetch_page_async,
+    page_size,
+    strip_statement,
+)
+
+Versions = Dict[str, str]
+
+# One version token per referenced table. Partitioned tables also cover their
+# partitions via pg_partition_tree. The relfilenode changes on TRUNCATE
+# and rewrites, which the tuple counters do not track. Relations without
+# statistics (views, foreign tables) match no row here, so queries over them
+# are never cached.
+TABLE_VERSIONS_QUERY = """
+SELECT
+    t.name,
+    count(s.relid),
+    md5(coalesce(string_agg(
+        s.relid::text || ':' || pg_relation_filenode(s.relid)::text || ':'
+        || s.n_tup_ins::text || ':' || s.n_tup_upd::text || ':' || s.n_tup_del::text,
+        ',' ORDER BY s.relid
+    ), ''))
+FROM unnest(%s::text[]) AS t(name)
+LEFT JOIN LATERAL (
+    SELECT to_regclass(t.name) AS relid
+    UNION
+    SELECT relid FROM pg_partition_tree(to_regclass(t.name))
+) p ON true
+LEFT JOIN pg_stat_user_tables s ON s.relid = p.relid
+GROUP BY t.name;
+"""
+
+VOLATILE_EXPRESSIONS = (
+    exp.Rand,
+    exp.CurrentDate,
+    exp.CurrentDatetime,
+    exp.CurrentTime,
+    exp.CurrentTimestamp,
+    exp.TableSample,
+)
+# Volatile functions sqlglot has no expression type for, parsed as Anonymous
+VOLATILE_FUNCTIONS = {
+    "clock_timestamp",
+    "statement_timestamp",
+    "timeofday",
+    "nextval",
+    "setval",
+    "currval",
+    "gen_random_uuid",
+    "pg_sleep",
+    "txid_current",
+}
+WRITE_EXPRESSIONS = (exp.Insert, exp.Update, exp.Delete, exp.Merge)
+
+
+def referenced_tables(query: str) -> Optional[List[str]]:
+    """Tables a read-only query depends on, or None if it must not be cached."""
+    try:
+        tree = sqlglot.parse_one(strip_statement(query), read="postgres")
+    except sqlglot.errors.ParseError:
+        return None
+    if not isinstance(tree, (exp.Select, exp.Union)):
+        return None
+    if tree.find(*WRITE_EXPRESSIONS) or tree.find(*VOLATILE_EXPRESSIONS):
+        return None
+    if any(
+        function.name.lower() in VOLATILE_FUNCTIONS
+        for function in tree.find_all(exp.Anonymous)
+    ):
+        return None
+
+    ctes = {cte.alias_or_name for cte in tree.find_all(exp.CTE)}
+    tables = set()
+    for table in tree.find_all(exp.Table):
+        if not table.name or (not table.db and table.name in ctes):
+            continue
+        tables.add(exp.table_(table.this, db=table.args.get("db")).sql("postgres"))
+    return sorted(tables) or None
+
+
+def parse_versions(rows: List[tuple]) -> Optional[Versions]:
+    if any(partitions == 0 for _, partitions, _ in rows):
+        return None
+    return {name: version for name, _, version in rows}
+
+
+def table_versions(conn: psycopg.Connection, tables: List[str]) -> Optional[Versions]:
+    with conn.transaction():
+        rows = conn.execute(TABLE_VERSIONS_QUERY, [tables]).fetchall()
+    return parse_versions(rows)
+
+
+async def table_versions_async(
+    conn: psycopg.AsyncConnection, tables: List[str]
+) -> Optional[Versions]:
+    async with conn.transaction():
+        cursor = await conn.execute(TABLE_VERSIONS_QUERY, [tables])
+        rows = await cursor.fetchall()
+    return parse_versions(rows)
+
+
+@dataclass
+class CachedResult:
+    page: ResultPage
+    tables: List[str]
+    versions: Versions
+    size: int
+    created_at: float = field(default_factory=time.time)
+
+
+class ResultCache:
+    """LRU cache of result pages, bounded by the size of their Arrow buffers.
+
+    Entries record the write counters of every table the query reads and are
+    dropped as soon as any of them moves. Backends publish those counters
+    at most once a second and otherwise within about ten seconds, so a write
+    can go unnoticed for that long; the TTL bounds staleness regardless.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None, ttl: Optional[float] = None):
+        self.max_bytes = max_bytes or int(
+            os.getenv("NLQ_RESULT_CACHE_BYTES", 256 * 2**20)
+        )
+        self.ttl = (
+            ttl if ttl is not None else float(os.getenv("NLQ_RESULT_CACHE_TTL", 300))
+        )
+        self.entries: "OrderedDict[str, CachedResult]" = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        # Collapse whitespace outside of quoted literals and identifiers
+        return re.sub(
+            r"('(?:[^']|'')*'|\"(?:[^\"]|\"\")*\")|\s+",
+            lambda match: match.group(1) or " ",
+            strip_statement(query),
+        )
+
+    def make_key(self, target: str, query: str, offset: int, limit: int) -> str:
+        payload = "\x1f".join([target, self.normalize(query), str(offset), str(limit)])
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str, versions: Versions) -> Optional[ResultPage]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if versions != entry.versions or time.time() - entry.created_at > self.ttl:
+                self._discard(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry.page
+
+    def set(
+        self, key: str, page: ResultPage, tables: List[str], versions: Versions
+    ) -> None:
+        size = page.table.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self.entries[key] = CachedResult(page, tables, versions, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+
+    def _discard(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def clear(self) -> None:
+        with self._lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+        }
+
+
+def cached_fetch_page(
+    cache: ResultCache,
+    conn: psycopg.Connection,
+    target: str,
+    query: str,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    **kwargs,
+) -> ResultPage:
+    limit = limit or page_size()
+    tables = referenced_tables(query)
+    versions = table_versions(conn, tables) if tables else None
+    if versions is None:
+        return fetch_page(conn, query, offset=offset, limit=limit, **kwargs)
+
+    key = cache.make_key(target, query, offset, limit)
+    page = cache.get(key, versions)
+    if page is None:
+        # Versions are read before the query runs, so a write that lands in
+        # between invalidates the entry instead of being missed.
+        page = fetch_page(conn, query, offset=offset, limit=limit, **kwargs)
+        cache.set(key, page, tables, versions)
+    return page
+
+
+async def cached_fetch_page_async(
+    cache: ResultCache,
+    conn: psycopg.AsyncConnection,
+    target: str,
+    query: str,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    fetch: Callable[..., Awaitable[ResultPage]] = fetch_page_async,
+    **kwargs,
+) -> ResultPage:
+    limit = limit or page_size()
+    tables = referenced_tables(query)
+    versions = await table_versions_async(conn, tables) if tables else None
+    if versions is None:
+        return await fetch(conn, query, offset=offset, limit=limit, **kwargs)
+
+    key = cache.make_key(target, query, offset, limit)
+    page = cache.get(key, versions)
+    if page is None:
+        page = await fetch(conn, query, offset=offset, limit=limit, **kwargs)
+        # A page left on an open cursor belongs to the caller that opened it
+        if page.cursor is None:
+            cache.set(key, page, tables, versions)
+    return page
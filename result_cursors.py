@@ -0,0 +1,184 @@
+import os
+import time
+import uuid
+import psycopg
+import pyarrow as pa
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+from psycopg_pool import AsyncConnectionPool
+from instrumentation import span
+from query_executor import (
+    FETCH_BATCH_SIZE,
+    ResultPage,
+    cursor_name,
+    description_schema,
+    enum_types_async,
+    estimate_rows_async,
+    fetch_page_async,
+    fetch_table_async,
+    fill_page,
+    is_row_query,
+    page_settings,
+    page_size,
+    register_loaders,
+    strip_statement,
+)
+
+
+@dataclass
+class OpenCursor:
+    pool: AsyncConnectionPool
+    conn: psycopg.AsyncConnection
+    cursor: psycopg.AsyncServerCursor
+    schema: pa.Schema
+    # Offset of the next page, whose first rows may already be in ahead
+    position: int
+    ahead: pa.Table
+    used_at: float = field(default_factory=time.time)
+
+
+class ResultCursors:
+    """Server-side cursors kept open on results that have more pages.
+
+    The first page of a result is read through a cursor in a transaction of
+    its own pooled connection; if rows remain, connection and cursor are kept
+    so the next page continues where the last one stopped instead of running
+    the query again and skipping the rows already shown. The transaction
+    keeps its snapshot, so pages neither overlap nor miss rows. Each open
+    cursor holds a pool connection and an open transaction, so at most
+    max_open are kept and any idle for ttl seconds are closed. Like the
+    pools, an instance must only be used from a single event loop.
+    """
+
+    def __init__(self, max_open: Optional[int] = None, ttl: Optional[float] = None):
+        self.max_open = (
+            max_open
+            if max_open is not None
+            else int(os.getenv("NLQ_MAX_OPEN_CURSORS", 4))
+        )
+        self.ttl = ttl if ttl is not None else float(os.getenv("NLQ_CURSOR_TTL", 300))
+        self.cursors: "OrderedDict[str, OpenCursor]" = OrderedDict()
+
+    async def fetch_page(
+        self,
+        pool: AsyncConnectionPool,
+        conn: psycopg.AsyncConnection,
+        query: str,
+        offset: int = 0,
+        limit: Optional[int] = None,
+        batch_size: int = FETCH_BATCH_SIZE,
+        estimate: bool = True,
+        timeout_ms: Optional[int] = None,
+    ) -> ResultPage:
+        """Read a page of a query on conn, taken from pool with getconn().
+
+        If rows remain, the page's cursor names the open cursor and conn
+        stays checked out until the cursor is closed; otherwise conn is left
+        idle for the caller to return to the pool.
+        """
+        query = strip_statement(query)
+        if not is_row_query(query):
+            return await fetch_page_async(
+                conn, query, offset, limit=limit, timeout_ms=timeout_ms
+            )
+        limit = limit or page_size()
+
+        with span("db.fetch", offset=offset) as fetch_span:
+            page = ResultPage(offset=offset)
+            if estimate:
+                page.estimated_rows = await estimate_rows_async(conn, query)
+            # Outside a transaction block, so the transaction outlives this call
+            for statement, args in page_settings(timeout_ms, offset):
+                await conn.execute(statement, args)
+            enums = await enum_types_async(conn)
+            cursor = conn.cursor(name=cursor_name(), binary=True)
+            register_loaders(cursor, enums)
+            await cursor.execute(query)
+            if offset:
+                await cursor.scroll(offset)
+            schema = description_schema(cursor)
+            table = await fetch_table_async(cursor, schema, limit + 1, batch_size)
+            fill_page(page, table, limit)
+            fetch_span.set(rows=page.num_rows, bytes=page.table.nbytes)
+
+        if not page.has_more:
+            await cursor.close()
+            await conn.commit()
+            return page
+        page.cursor = uuid.uuid4().hex
+        self.cursors[page.cursor] = OpenCursor(
+            pool, conn, cursor, schema, offset + limit, table.slice(limit)
+        )
+        await self.prune()
+        return page
+
+    async def next_page(
+        self,
+        cursor_id: str,
+        offset: int,
+        limit: Optional[int] = None,
+        batch_size: int = FETCH_BATCH_SIZE,
+    ) -> Optional[ResultPage]:
+        """The page at offset from an open cursor, or None if there is none.
+
+        The cursor is closed when its last page is read.
+        """
+        # Taken out while in use, so a concurrent request for it finds none
+        entry = self.cursors.pop(cursor_id, None)
+        if entry is None:
+            return None
+        if offset != entry.position:
+            await self.release(entry)
+            return None
+        limit = limit or page_size()
+
+        try:
+            with span("db.fetch", offset=offset) as fetch_span:
+                rows = limit + 1 - entry.ahead.num_rows
+                more = await fetch_table_async(
+                    entry.cursor, entry.schema, rows, batch_size
+                )
+                table = pa.concat_tables([entry.ahead, more])
+                page = fill_page(ResultPage(offset=offset), table, limit)
+                fetch_span.set(rows=page.num_rows, bytes=page.table.nbytes)
+        except psycopg.Error:
+            # E.g. the server ended the idle transaction; the page is re-run
+            await self.release(entry)
+            return None
+        except BaseException:
+            await self.release(entry)
+            raise
+
+        if not page.has_more:
+            await self.release(entry)
+            return page
+        page.cursor = cursor_id
+        entry.position = offset + limit
+        entry.ahead = table.slice(limit)
+        entry.used_at = time.time()
+        self.cursors[cursor_id] = entry
+        return page
+
+    async def close(self, cursor_id: str) -> None:
+        entry = self.cursors.pop(cursor_id, None)
+        if entry is not None:
+            await self.release(entry)
+
+    async def prune(self) -> None:
+        cutoff = time.time() - self.ttl
+        for cursor_id, entry in list(self.cursors.items()):
+            if entry.used_at < cutoff:
+                await self.close(cursor_id)
+        while len(self.cursors) > self.max_open:
+            _, entry = self.cursors.popitem(last=False)
+            await self.release(entry)
+
+    @staticmethod
+    async def release(entry: OpenCursor) -> None:
+        try:
+            await entry.conn.rollback()
+        except psycopg.Error:
+            pass
+        await entry.pool.putconn(entry.conn)
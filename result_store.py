@@ -0,0 +1,172 @@
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+import weakref
+import pandas as pd
+import pyarrow as pa
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+from pyarrow import ipc
+from instrumentation import span
+from utils import arrow_to_dataframe, data_path
+
+Key = Tuple[str, str]
+
+
+@dataclass
+class StoredResult:
+    frame: Optional[pd.DataFrame]
+    size: int
+    path: Optional[str] = None
+    disk_bytes: int = 0
+
+
+def frame_size(df: pd.DataFrame) -> int:
+    return int(df.memory_usage(deep=True).sum())
+
+
+class ResultStore:
+    """Result frames of every session's tabs under one memory budget.
+
+    When the frames held in memory exceed max_bytes, the least recently
+    viewed ones are written to Arrow IPC files and dropped from memory; they
+    are read back through a memory map the next time their tab is shown.
+    Spill files live in a directory of their own per process, removed at
+    exit.
+    """
+
+    def __init__(
+        self, max_bytes: Optional[int] = None, spill_dir: Optional[str] = None
+    ):
+        self.max_bytes = max_bytes or int(
+            os.getenv("NLQ_RESULT_STORE_BYTES", 1024 * 2**20)
+        )
+        self.spill_dir = tempfile.mkdtemp(
+            prefix="spill-", dir=spill_dir or data_path("")
+        )
+        self.entries: "OrderedDict[Key, StoredResult]" = OrderedDict()
+        self.bytes = 0
+        self.spills = 0
+        self.loads = 0
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def put(self, session_id: str, tab: str, df: pd.DataFrame) -> None:
+        key = (session_id, tab)
+        with self._lock:
+            self._discard(key)
+            entry = StoredResult(df, frame_size(df))
+            self.entries[key] = entry
+            self.bytes += entry.size
+            self._enforce_budget(key)
+
+    def get(self, session_id: str, tab: str) -> Optional[pd.DataFrame]:
+        key = (session_id, tab)
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            if entry.frame is None:
+                entry.frame = self._load(entry)
+                self.bytes += entry.size
+                self._enforce_budget(key)
+            return entry.frame
+
+    def drop(self, session_id: str, tab: Optional[str] = None) -> None:
+        with self._lock:
+            for key in list(self.entries):
+                if key[0] == session_id and tab in (None, key[1]):
+                    self._discard(key)
+
+    def _discard(self, key: Key) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        if entry.frame is not None:
+            self.bytes -= entry.size
+        if entry.path is not None and os.path.exists(entry.path):
+            os.remove(entry.path)
+
+    def _enforce_budget(self, keep: Key) -> None:
+        # The frame being put or viewed stays in memory even when it alone
+        # exceeds the budget.
+        for key, entry in list(self.entries.items()):
+            if self.bytes <= self.max_bytes:
+                break
+            if key != keep and entry.frame is not None:
+                self._spill(entry)
+
+    def _spill(self, entry: StoredResult) -> None:
+        # A frame that was loaded back and not replaced still has its file
+        if entry.path is None:
+            with span("store.spill", rows=len(entry.frame)) as spill_span:
+                entry.path = os.path.join(self.spill_dir, f"{uuid.uuid4().hex}.arrow")
+                table = pa.Table.from_pandas(entry.frame, preserve_index=False)
+                with ipc.new_file(entry.path, table.schema) as writer:
+                    writer.write_table(table)
+                entry.disk_bytes = os.path.getsize(entry.path)
+                spill_span.set(bytes=entry.disk_bytes)
+        entry.frame = None
+        self.bytes -= entry.size
+        self.spills += 1
+
+    def _load(self, entry: StoredResult) -> pd.DataFrame:
+        with span("store.load", bytes=entry.disk_bytes):
+            with pa.memory_map(entry.path) as source:
+                table = ipc.open_file(source).read_all()
+            self.loads += 1
+            return arrow_to_dataframe(table)
+
+    def stats(self, session_id: Optional[str] = None) -> Dict[str, int]:
+        with self._lock:
+            entries = [
+                entry
+                for key, entry in self.entries.items()
+                if session_id is None or key[0] == session_id
+            ]
+            return {
+                "entries": len(entries),
+                "memory_bytes": sum(e.size for e in entries if e.frame is not None),
+                "disk_bytes": sum(e.disk_bytes for e in entries if e.path is not None),
+                "spilled": sum(1 for e in entries if e.frame is None),
+                "spills": self.spills,
+                "loads": self.loads,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self.entries.clear()
+            self.bytes = 0
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+
+class SessionResults:
+    """One session's view of a ResultStore.
+
+    Kept in the session state; when Streamlit discards the session, the
+    handle is garbage collected and the session's frames and spill files are
+    deleted with it.
+    """
+
+    def __init__(self, store: ResultStore):
+        self.store = store
+        self.session_id = uuid.uuid4().hex
+        weakref.finalize(self, store.drop, self.session_id)
+
+    def put(self, tab: str, df: pd.DataFrame) -> None:
+        self.store.put(self.session_id, tab, df)
+
+    def get(self, tab: str) -> Optional[pd.DataFrame]:
+        return self.store.get(self.session_id, tab)
+
+    def drop(self, tab: Optional[str] = None) -> None:
+        self.store.drop(self.session_id, tab)
+
+    def stats(self) -> Dict[str, int]:
+        return self.store.stats(self.session_id)
@@ -0,0 +1,578 @@
+import itertools
+import os
+import psycopg
+import sqlglot
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+from psycopg import sql
+from sqlglot import exp
+from query_executor import strip_statement
+from sql_validator import identifier_name
+from viz_loader import is_numeric_type
+
+ROLLUP_SCHEMA = "nlq"
+MAX_DIMENSIONS = 2
+SUPPORTED_AGGREGATES = (exp.Count, exp.Sum, exp.Avg, exp.Min, exp.Max)
+# Aggregate over the rollup column that replaces each aggregate of a measure
+MEASURE_AGGREGATES = {
+    exp.Min: ("min", exp.Min),
+    exp.Max: ("max", exp.Max),
+}
+
+# Rollups live outside the public schema, so the model never sees them. A
+# statement trigger on the fact table marks its rollups stale on any write,
+# and stale rollups are not used until they are refreshed. A write during a
+# refresh also clears refresh_started, so the refresh does not mark its
+# rollup fresh afterwards.
+SETUP_STATEMENTS = [
+    f"CREATE SCHEMA IF NOT EXISTS {ROLLUP_SCHEMA}",
+    f"""
+    CREATE TABLE IF NOT EXISTS {ROLLUP_SCHEMA}.rollups (
+        name text PRIMARY KEY,
+        fact_table text NOT NULL,
+        dimensions text[] NOT NULL,
+        measures text[] NOT NULL,
+        row_count bigint,
+        stale boolean NOT NULL DEFAULT true,
+        refreshed_at timestamptz
+    )
+    """,
+    f"ALTER TABLE {ROLLUP_SCHEMA}.rollups "
+    "ADD COLUMN IF NOT EXISTS refresh_started timestamptz",
+    f"""
+    CREATE OR REPLACE FUNCTION {ROLLUP_SCHEMA}.mark_rollups_stale()
+    RETURNS trigger LANGUAGE plpgsql SECURITY DEFINER AS $$
+    BEGIN
+        UPDATE {ROLLUP_SCHEMA}.rollups SET stale = true, refresh_started = NULL
+        WHERE fact_table = TG_TABLE_NAME
+            AND (NOT stale OR refresh_started IS NOT NULL);
+        RETURN NULL;
+    END
+    $$
+    """,
+]
+
+# Concurrent CREATE ... IF NOT EXISTS of the same objects fails in one of
+# the transactions, so setups take turns on this advisory lock.
+SETUP_LOCK = 7_318_624_001
+
+# Measure types come from the fact table, so rewritten aggregates can be
+# cast back to the types the original ones return.
+ROLLUPS_QUERY = f"""
+SELECT r.name, r.fact_table, r.dimensions, r.measures, coalesce(r.row_count, 0),
+    ARRAY(
+        SELECT format_type(a.atttypid, a.atttypmod)
+        FROM unnest(r.measures) WITH ORDINALITY AS m(name, position)
+        JOIN pg_attribute a
+            ON a.attrelid = to_regclass(quote_ident(r.fact_table))
+            AND a.attname = m.name
+        ORDER BY m.position
+    )
+FROM {ROLLUP_SCHEMA}.rollups r
+WHERE r.fact_table = %s AND NOT r.stale
+ORDER BY r.row_count
+"""
+
+# Estimated groups per column: pg_stats.n_distinct is negative when it is a
+# fraction of the row count.
+DISTINCT_QUERY = """
+SELECT s.attname,
+    CASE WHEN s.n_distinct < 0 THEN -s.n_distinct * greatest(c.reltuples, 1)
+    ELSE s.n_distinct END
+FROM pg_stats s
+JOIN pg_class c ON c.oid = to_regclass(%s)
+WHERE s.schemaname = 'public' AND s.tablename = %s
+"""
+
+
+def rollup_dimensions() -> List[str]:
+    return os.getenv("NLQ_ROLLUP_DIMENSIONS", "region,status,company,owner").split(",")
+
+
+def rollup_max_rows() -> int:
+    return int(os.getenv("NLQ_ROLLUP_MAX_ROWS", 10_000))
+
+
+@dataclass
+class Rollup:
+    name: str
+    fact_table: str
+    dimensions: Tuple[str, ...]
+    measures: Tuple[str, ...]
+    row_count: int = 0
+    measure_types: Tuple[str, ...] = ()
+
+
+@dataclass
+class Rewrite:
+    sql: str
+    original: str
+    rollup: str
+
+
+def rollup_name(fact_table: str, dimensions: Sequence[str]) -> str:
+    return f"{fact_table}__{'__'.join(dimensions)}"
+
+
+def sum_type(column_type: str) -> str:
+    """Type Postgres gives sum() of a column of this type."""
+    if column_type in ("smallint", "integer"):
+        return "bigint"
+    if column_type in ("real", "double precision"):
+        return column_type
+    return "numeric"
+
+
+def avg_type(column_type: str) -> str:
+    """Type Postgres gives avg() of a column of this type."""
+    if column_type in ("real", "double precision"):
+        return "double precision"
+    return "numeric"
+
+
+def rollup_definition(rollup: Rollup) -> sql.Composed:
+    columns = [sql.Identifier(dimension) for dimension in rollup.dimensions]
+    columns.append(sql.SQL("count(*) AS row_count"))
+    for measure in rollup.measures:
+        for function in ("sum", "count", "min", "max"):
+            columns.append(
+                sql.SQL("{}({}) AS {}").format(
+                    sql.SQL(function),
+                    sql.Identifier(measure),
+                    sql.Identifier(f"{function}_{measure}"),
+                )
+            )
+    return sql.SQL("SELECT {} FROM {} GROUP BY {}").format(
+        sql.SQL(", ").join(columns),
+        sql.Identifier(rollup.fact_table),
+        sql.SQL(", ").join(map(sql.Identifier, rollup.dimensions)),
+    )
+
+
+class RollupManager:
+    """Creates and refreshes the rollup materialized views of fact tables.
+
+    Every combination of up to MAX_DIMENSIONS of the NLQ_ROLLUP_DIMENSIONS
+    columns gets a rollup holding count, sum, min and max of each numeric
+    column, as long as its estimated number of groups stays within
+    NLQ_ROLLUP_MAX_ROWS.
+    """
+
+    def __init__(
+        self,
+        dimensions: Optional[List[str]] = None,
+        max_rows: Optional[int] = None,
+    ):
+        self.dimensions = dimensions or rollup_dimensions()
+        self.max_rows = max_rows or rollup_max_rows()
+
+    @staticmethod
+    def setup(conn: psycopg.Connection) -> None:
+        """Create the rollup catalog; run outside the transactions that create
+        rollups, since those hold the lock until they commit."""
+        with conn.transaction():
+            conn.execute("SELECT pg_advisory_xact_lock(%s)", [SETUP_LOCK])
+            for statement in SETUP_STATEMENTS:
+                conn.execute(statement)
+
+    def plan(self, conn: psycopg.Connection, fact_table: str) -> List[Rollup]:
+        columns = conn.execute(
+            "SELECT attname, format_type(atttypid, atttypmod) FROM pg_attribute "
+            "WHERE attrelid = to_regclass(%s) AND attnum > 0 AND NOT attisdropped",
+            [fact_table],
+        ).fetchall()
+        measures = tuple(
+            name
+            for name, datatype in columns
+            if is_numeric_type(datatype) and name not in self.dimensions
+        )
+        available = [d for d in self.dimensions if d in {name for name, _ in columns}]
+        distinct = dict(conn.execute(DISTINCT_QUERY, [fact_table, fact_table]))
+        rollups = []
+        for size in range(1, MAX_DIMENSIONS + 1):
+            for dimensions in itertools.combinations(available, size):
+                groups = 1.0
+                for dimension in dimensions:
+                    groups *= distinct.get(dimension, float("inf"))
+                if groups <= self.max_rows:
+                    rollups.append(
+                        Rollup(
+                            rollup_name(fact_table, dimensions),
+                            fact_table,
+                            dimensions,
+                            measures,
+                        )
+                    )
+        return rollups
+
+    def drop(self, conn: psycopg.Connection, fact_table: str) -> None:
+        catalog = conn.execute(
+            "SELECT to_regclass(%s)", [f"{ROLLUP_SCHEMA}.rollups"]
+        ).fetchone()[0]
+        if catalog is None:
+            return
+        names = conn.execute(
+            f"DELETE FROM {ROLLUP_SCHEMA}.rollups WHERE fact_table = %s RETURNING name",
+            [fact_table],
+        ).fetchall()
+        for (name,) in names:
+            conn.execute(
+                sql.SQL("DROP MATERIALIZED VIEW IF EXISTS {}").format(
+                    sql.Identifier(ROLLUP_SCHEMA, name)
+                )
+            )
+
+    def create(self, conn: psycopg.Connection, fact_table: str) -> List[Rollup]:
+        """(Re)build the rollups of a table; run after setup() and ANALYZE so
+        the catalog exists and the group estimates are known."""
+        self.drop(conn, fact_table)
+        rollups = self.plan(conn, fact_table)
+        for rollup in rollups:
+            view = sql.Identifier(ROLLUP_SCHEMA, rollup.name)
+            conn.execute(
+                sql.SQL("CREATE MATERIALIZED VIEW {} AS {}").format(
+                    view, rollup_definition(rollup)
+                )
+            )
+            # REFRESH ... CONCURRENTLY needs a unique index
+            conn.execute(
+                sql.SQL("CREATE UNIQUE INDEX ON {} ({})").format(
+                    view,
+                    sql.SQL(", ").join(map(sql.Identifier, rollup.dimensions)),
+                )
+            )
+            rollup.row_count = conn.execute(
+                sql.SQL("SELECT count(*) FROM {}").format(view)
+            ).fetchone()[0]
+            conn.execute(
+                f"INSERT INTO {ROLLUP_SCHEMA}.rollups (name, fact_table, dimensions, "
+                "measures, row_count, stale, refreshed_at) "
+                "VALUES (%s, %s, %s, %s, %s, false, now())",
+                [
+                    rollup.name,
+                    fact_table,
+                    list(rollup.dimensions),
+                    list(rollup.measures),
+                    rollup.row_count,
+                ],
+            )
+        trigger = sql.Identifier(f"{fact_table}_rollups_stale")
+        conn.execute(
+            sql.SQL("DROP TRIGGER IF EXISTS {} ON {}").format(
+                trigger, sql.Identifier(fact_table)
+            )
+        )
+        conn.execute(
+            sql.SQL(
+                "CREATE TRIGGER {} AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE "
+                "ON {} FOR EACH STATEMENT EXECUTE FUNCTION {}()"
+            ).format(
+                trigger,
+                sql.Identifier(fact_table),
+                sql.Identifier(ROLLUP_SCHEMA, "mark_rollups_stale"),
+            )
+        )
+        return rollups
+
+    @staticmethod
+    def refresh(conn: psycopg.Connection, fact_table: str) -> int:
+        """Refresh a table's rollups without blocking readers or writers.
+
+        refresh_started is set before each refresh, once writes that were
+        already in progress have committed, and the rollup is only marked
+        fresh afterwards if no write has cleared it since.
+        """
+        # Each step commits on its own, so no lock is held during a refresh
+        autocommit = conn.autocommit
+        conn.autocommit = True
+        try:
+            return RollupManager.refresh_each(conn, fact_table)
+        finally:
+            conn.autocommit = autocommit
+
+    @staticmethod
+    def refresh_each(conn: psycopg.Connection, fact_table: str) -> int:
+        refreshed = 0
+        names = conn.execute(
+            f"SELECT name FROM {ROLLUP_SCHEMA}.rollups WHERE fact_table = %s",
+            [fact_table],
+        ).fetchall()
+        for (name,) in names:
+            view = sql.Identifier(ROLLUP_SCHEMA, name)
+            with conn.transaction():
+                # Waits for open write transactions, whose triggers may have
+                # found the rollup already stale, so the refresh sees them
+                conn.execute(
+                    sql.SQL("LOCK TABLE {} IN SHARE MODE").format(
+                        sql.Identifier(fact_table)
+                    )
+                )
+                started = conn.execute(
+                    f"UPDATE {ROLLUP_SCHEMA}.rollups SET refresh_started = now() "
+                    "WHERE name = %s RETURNING refresh_started",
+                    [name],
+                ).fetchone()[0]
+            conn.execute(
+                sql.SQL("REFRESH MATERIALIZED VIEW CONCURRENTLY {}").format(view)
+            )
+            row_count = conn.execute(
+                sql.SQL("SELECT count(*) FROM {}").format(view)
+            ).fetchone()[0]
+            conn.execute(
+                f"UPDATE {ROLLUP_SCHEMA}.rollups SET stale = false, "
+                "refreshed_at = refresh_started, refresh_started = NULL, "
+                "row_count = %s WHERE name = %s AND refresh_started = %s",
+                [row_count, name, started],
+            )
+            refreshed += 1
+        return refreshed
+
+
+def fact_table_of(query: str) -> Optional[Tuple[exp.Select, str]]:
+    """The parsed query and its table, if it is a single-table aggregate."""
+    try:
+        tree = sqlglot.parse_one(strip_statement(query), read="postgres")
+    except sqlglot.errors.ParseError:
+        return None
+    if not isinstance(tree, exp.Select) or tree.args.get("distinct"):
+        return None
+    if tree.args.get("joins") or tree.args.get("with") or tree.find(exp.Subquery):
+        return None
+    if tree.find(exp.Window) or tree.find(exp.Filter):
+        return None
+    if any(not isinstance(star.parent, exp.Count) for star in tree.find_all(exp.Star)):
+        return None
+    if len(list(tree.find_all(exp.Select))) != 1:
+        return None
+    source = tree.args.get("from")
+    if source is None or not isinstance(source.this, exp.Table):
+        return None
+    table = source.this
+    if table.db and table.db.lower() != "public":
+        return None
+    if tree.args.get("group") is None and not tree.find(exp.AggFunc):
+        return None
+    return tree, identifier_name(table.this)
+
+
+def counts_rows(aggregate: exp.Expression) -> bool:
+    """Whether this is count(*) or count of a non-null constant."""
+    if not isinstance(aggregate, exp.Count):
+        return False
+    argument = aggregate.this
+    return isinstance(argument, exp.Star) or isinstance(argument, exp.Literal)
+
+
+def is_rollup_argument(aggregate: exp.Expression) -> bool:
+    argument = aggregate.this
+    if isinstance(argument, exp.Column) or counts_rows(aggregate):
+        return True
+    return (
+        isinstance(aggregate, exp.Count)
+        and isinstance(argument, exp.Distinct)
+        and len(argument.expressions) == 1
+        and isinstance(argument.expressions[0], exp.Column)
+    )
+
+
+def required_columns(
+    tree: exp.Select, table_names: Set[str]
+) -> Optional[Tuple[Set[str], Set[str]]]:
+    """Dimensions and measures a rollup needs to answer the query, or None if
+    the query uses something a rollup cannot provide."""
+    aliases = {
+        identifier_name(expression.args["alias"])
+        for expression in tree.expressions
+        if isinstance(expression, exp.Alias)
+    }
+    dimensions: Set[str] = set()
+    measures: Set[str] = set()
+    for aggregate in tree.find_all(exp.AggFunc):
+        if not isinstance(aggregate, SUPPORTED_AGGREGATES):
+            return None
+        if not is_rollup_argument(aggregate):
+            return None
+    for column in tree.find_all(exp.Column):
+        qualifier = column.args.get("table")
+        if qualifier is not None and identifier_name(qualifier) not in table_names:
+            return None
+        name = identifier_name(column.this)
+        aggregate = column.find_ancestor(exp.AggFunc)
+        if aggregate is None:
+            if (
+                qualifier is None
+                and name in aliases
+                and column.find_ancestor(exp.Order, exp.Having, exp.Group)
+            ):
+                continue
+            dimensions.add(name)
+        elif isinstance(aggregate.this, exp.Distinct):
+            # count(DISTINCT d) is the number of d groups in the rollup
+            if not isinstance(aggregate, exp.Count):
+                return None
+            dimensions.add(name)
+        elif aggregate.this is column:
+            measures.add(name)
+        else:
+            # Aggregates of expressions cannot be rebuilt from the partials
+            return None
+    return dimensions, measures
+
+
+def rewrite_aggregate(
+    node: exp.Expression, qualifier: str, types: Dict[str, str]
+) -> exp.Expression:
+    if not isinstance(node, SUPPORTED_AGGREGATES) or isinstance(
+        node.this, exp.Distinct
+    ):
+        return node
+
+    def partial(function: str, measure: str) -> exp.Column:
+        return exp.column(f"{function}_{measure}", table=qualifier, quoted=True)
+
+    def cast(expression: exp.Expression, to: str) -> exp.Cast:
+        return exp.Cast(this=expression, to=exp.DataType.build(to))
+
+    if isinstance(node, exp.Count):
+        column = (
+            exp.column("row_count", table=qualifier, quoted=True)
+            if counts_rows(node)
+            else partial("count", identifier_name(node.this.this))
+        )
+        # count() is 0, not NULL, when no rollup row matches
+        return exp.Coalesce(
+            this=cast(exp.Sum(this=column), "bigint"),
+            expressions=[exp.Literal.number(0)],
+        )
+    measure = identifier_name(node.this.this)
+    if isinstance(node, exp.Avg):
+        return exp.Paren(
+            this=exp.Div(
+                this=cast(
+                    exp.Sum(this=partial("sum", measure)), avg_type(types[measure])
+                ),
+                expression=exp.Nullif(
+                    this=exp.Sum(this=partial("count", measure)),
+                    expression=exp.Literal.number(0),
+                ),
+                typed=True,
+            )
+        )
+    if isinstance(node, exp.Sum):
+        # sum() of the bigint partial sums would be numeric, not bigint
+        return cast(exp.Sum(this=partial("sum", measure)), sum_type(types[measure]))
+    function, aggregate = MEASURE_AGGREGATES[type(node)]
+    return aggregate(this=partial(function, measure))
+
+
+class RollupRewriter:
+    """Points single-table aggregate queries at a fresh covering rollup.
+
+    A rollup covers a query when every column the query filters, groups or
+    selects on is one of its dimensions and every aggregate is a count, sum,
+    avg, min or max of one of its measures. The smallest covering rollup is
+    used.
+    """
+
+    @staticmethod
+    def choose(query: str, rollups: List[Rollup]) -> Optional[Rewrite]:
+        parsed = fact_table_of(query)
+        if parsed is None:
+            return None
+        tree, fact_table = parsed
+        table = tree.args["from"].this
+        qualifier = (
+            identifier_name(table.args["alias"].this) if table.alias else fact_table
+        )
+        required = required_columns(tree, {qualifier})
+        if required is None:
+            return None
+        dimensions, measures = required
+        for rollup in rollups:
+            if rollup.fact_table != fact_table:
+                continue
+            if dimensions <= set(rollup.dimensions) and measures <= set(
+                rollup.measures
+            ):
+                return Rewrite(
+                    RollupRewriter.rewrite(tree, rollup, qualifier), query, rollup.name
+                )
+        return None
+
+    @staticmethod
+    def rewrite(tree: exp.Select, rollup: Rollup, qualifier: str) -> str:
+        tree = tree.copy()
+        # Keep the output column names Postgres gives unnamed aggregates
+        tree.set(
+            "expressions",
+            [
+                exp.alias_(expression, expression.key, quoted=False)
+                if isinstance(expression, exp.AggFunc)
+                else expression
+                for expression in tree.expressions
+            ],
+        )
+        tree.args["from"].set(
+            "this",
+            exp.table_(
+                exp.to_identifier(rollup.name, quoted=True),
+                db=exp.to_identifier(ROLLUP_SCHEMA),
+                alias=exp.to_identifier(qualifier, quoted=True),
+            ),
+        )
+        types = dict(zip(rollup.measures, rollup.measure_types))
+        tree = tree.transform(lambda node: rewrite_aggregate(node, qualifier, types))
+        return tree.sql("postgres") + ";"
+
+    # A rewrite is only an optimization: if anything goes wrong the original
+    # query runs instead.
+    def rewrite_query(self, conn: psycopg.Connection, query: str) -> Optional[Rewrite]:
+        try:
+            parsed = fact_table_of(query)
+            if parsed is None:
+                return None
+            return self.choose(query, self.fresh_rollups(conn, parsed[1]))
+        except Exception as e:
+            print(f"Skipping rollup rewrite: {e}")
+            return None
+
+    async def rewrite_query_async(
+        self, conn: psycopg.AsyncConnection, query: str
+    ) -> Optional[Rewrite]:
+        try:
+            parsed = fact_table_of(query)
+            if parsed is None:
+                return None
+            rollups = await self.fresh_rollups_async(conn, parsed[1])
+            return self.choose(query, rollups)
+        except Exception as e:
+            print(f"Skipping rollup rewrite: {e}")
+            return None
+
+    @staticmethod
+    def fresh_rollups(conn: psycopg.Connection, fact_table: str) -> List[Rollup]:
+        try:
+            with conn.transaction():
+                rows = conn.execute(ROLLUPS_QUERY, [fact_table]).fetchall()
+        except psycopg.errors.UndefinedTable:
+            return []
+        return [
+            Rollup(n, t, tuple(d), tuple(m), c, tuple(types))
+            for n, t, d, m, c, types in rows
+        ]
+
+    @staticmethod
+    async def fresh_rollups_async(
+        conn: psycopg.AsyncConnection, fact_table: str
+    ) -> List[Rollup]:
+        try:
+            async with conn.transaction():
+                cursor = await conn.execute(ROLLUPS_QUERY, [fact_table])
+                rows = await cursor.fetchall()
+        except psycopg.errors.UndefinedTable:
+            return []
+        return [
+            Rollup(n, t, tuple(d), tuple(m), c, tuple(types))
+            for n, t, d, m, c, types in rows
+        ]
@@ -2,17 +2,29 @@
 
 # First, run 'chmod +x runner.sh'.
 # Then, run './runner.sh app' to run the Streamlit app
-# or './runner.sh seed' to run the seeder script.
+# or './runner.sh seed [plan.toml]' to seed the tables of a seed plan.
+# './runner.sh batch questions.jsonl -o results.jsonl' answers a file of questions.
+# './runner.sh advise' recommends indexes for the logged queries.
+# './runner.sh rollups' builds the rollup tables ('--refresh' refreshes them).
+# './runner.sh bench -o report.json' benchmarks the pipeline against a stub LLM.
 
 if [ "$1" == "app" ]; then
     streamlit run app.py
 elif [ "$1" == "seed" ]; then
-    python setup.py
+    python setup.py "${@:2}"
+elif [ "$1" == "batch" ] || [ "$1" == "advise" ] || [ "$1" == "rollups" ]; then
+    python database_query.py "$@"
+elif [ "$1" == "bench" ]; then
+    python -m benchmarks.pipeline "${@:2}"
 elif [ "$1" == "format" ]; then
     black .
 else
     echo "Please use one of the following commands:"
+    echo "'advise' to recommend indexes for the logged queries"
     echo "'app' to run the Streamlit app"
+    echo "'bench' to benchmark the pipeline offline"
+    echo "'batch' to answer questions from a JSONL file"
     echo "'format' to format the code with Black"
-    echo "'seed' to run the seeder script"
+    echo "'rollups' to build or refresh the rollup tables"
+    echo "'seed' to seed the tables of seed_plan.toml (or another plan)"
 fi
\ No newline at end of file
@@ -0,0 +1,164 @@
+import math
+import os
+import re
+
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+Schema = Dict[str, Dict[str, str]]
+ForeignKeys = Dict[str, Dict[str, Tuple[str, str]]]
+# Table -> column -> the labels of its enum type, in their sort order
+EnumLabels = Dict[str, Dict[str, List[str]]]
+
+TABLE_NAME_WEIGHT = 3
+
+
+def singularize(word: str) -> str:
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    return [singularize(t) for t in re.findall(r"[a-z0-9]+", text.lower())]
+
+
+def format_compact(
+    schema: Schema,
+    tables: Optional[Iterable[str]] = None,
+    primary_keys: Optional[Dict[str, List[str]]] = None,
+    foreign_keys: Optional[ForeignKeys] = None,
+    row_estimates: Optional[Dict[str, int]] = None,
+    enum_labels: Optional[EnumLabels] = None,
+) -> str:
+    names = schema.keys() if tables is None else tables
+    primary_keys = primary_keys or {}
+    foreign_keys = foreign_keys or {}
+    row_estimates = row_estimates or {}
+    enum_labels = enum_labels or {}
+    lines = []
+    for table in names:
+        if table not in schema:
+            continue
+        columns = []
+        for column, dtype in schema[table].items():
+            definition = f"{column} {dtype}"
+            labels = enum_labels.get(table, {}).get(column)
+            if labels:
+                # Only these exact values compare with the column
+                quoted = ",".join(
+                    "'" + label.replace("'", "''") + "'" for label in labels
+                )
+                definition += f"{{{quoted}}}"
+            if column in primary_keys.get(table, []):
+                definition += " pk"
+            if column in foreign_keys.get(table, {}):
+                ref_table, ref_column = foreign_keys[table][column]
+                definition += f" ->{ref_table}.{ref_column}"
+            columns.append(definition)
+        rows = f" ~{row_estimates[table]} rows" if row_estimates.get(table) else ""
+        lines.append(f"{table}({', '.join(columns)}){rows}")
+    return "\n".join(lines)
+
+
+class SchemaIndex:
+    def __init__(
+        self,
+        schema: Schema,
+        foreign_keys: Optional[ForeignKeys] = None,
+        primary_keys: Optional[Dict[str, List[str]]] = None,
+        row_estimates: Optional[Dict[str, int]] = None,
+        enum_labels: Optional[EnumLabels] = None,
+        top_k: Optional[int] = None,
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        self.schema = schema
+        self.foreign_keys = foreign_keys
+        self.primary_keys = primary_keys
+        self.row_estimates = row_estimates
+        self.enum_labels = enum_labels
+        self.top_k = top_k or int(os.getenv("NLQ_SCHEMA_TOP_K", 5))
+        self.k1 = k1
+        self.b = b
+        self.documents: Dict[str, Counter] = {}
+        for table, columns in schema.items():
+            tokens = tokenize(table) * TABLE_NAME_WEIGHT
+            for column, dtype in columns.items():
+                tokens += tokenize(column) + tokenize(dtype)
+            self.documents[table] = Counter(tokens)
+
+        self.lengths = {t: sum(doc.values()) for t, doc in self.documents.items()}
+        self.avg_length = sum(self.lengths.values()) / max(len(self.documents), 1)
+        document_frequency = Counter(
+            token for doc in self.documents.values() for token in doc
+        )
+        n = len(self.documents)
+        self.idf = {
+            token: math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for token, df in document_frequency.items()
+        }
+        self.neighbors = self._build_neighbors(foreign_keys)
+
+    def _build_neighbors(self, foreign_keys: Optional[ForeignKeys]) -> Dict[str, Set]:
+        neighbors: Dict[str, Set] = {table: set() for table in self.schema}
+        if foreign_keys is not None:
+            for table, references in foreign_keys.items():
+                for ref_table, _ in references.values():
+                    if table in neighbors and ref_table in neighbors:
+                        neighbors[table].add(ref_table)
+                        neighbors[ref_table].add(table)
+            return neighbors
+
+        # Without declared foreign keys, treat "<table>_id" columns as joins
+        singular = {singularize(t): t for t in self.schema}
+        for table, columns in self.schema.items():
+            for column in columns:
+                if not column.endswith("_id"):
+                    continue
+                base = column[:-3]
+                target = singular.get(base) or (base if base in self.schema else None)
+                if target is not None and target != table:
+                    neighbors[table].add(target)
+                    neighbors[target].add(table)
+        return neighbors
+
+    def score(self, question: str) -> List[Tuple[str, float]]:
+        terms = set(tokenize(question))
+        scores = []
+        for table, doc in self.documents.items():
+            norm = self.k1 * (
+                1 - self.b + self.b * self.lengths[table] / self.avg_length
+            )
+            total = 0.0
+            for term in terms & doc.keys():
+                tf = doc[term]
+                total += self.idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            if total > 0:
+                scores.append((table, total))
+        return sorted(scores, key=lambda item: item[1], reverse=True)
+
+    def select_tables(self, question: str) -> List[str]:
+        if len(self.schema) <= self.top_k:
+            return list(self.schema)
+        selected = [table for table, _ in self.score(question)[: self.top_k]]
+        for table in list(selected):
+            for neighbor in sorted(self.neighbors[table]):
+                if neighbor not in selected:
+                    selected.append(neighbor)
+        return selected
+
+    def prompt_schema(self, question: str) -> Optional[str]:
+        tables = self.select_tables(question)
+        if not tables:
+            return None
+        return format_compact(
+            self.schema,
+            tables,
+            self.primary_keys,
+            self.foreign_keys,
+            self.row_estimates,
+            self.enum_labels,
+        )
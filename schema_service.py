@@ -0,0 +1,224 @@
+import os
+import threading
+import time
+import psycopg
+
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional
+from psycopg_pool import ConnectionPool
+from instrumentation import span
+from schema_index import (
+    EnumLabels,
+    ForeignKeys,
+    Schema,
+    SchemaIndex,
+    format_compact,
+)
+from utils import fingerprint_schema
+
+SCHEMA_QUERY = """
+SELECT
+    c.relname,
+    a.attname,
+    format_type(a.atttypid, a.atttypmod),
+    -- Partitioned tables have no rows of their own
+    CASE WHEN c.relkind = 'p' THEN (
+        SELECT coalesce(sum(greatest(pc.reltuples, 0)), 0)
+        FROM pg_partition_tree(c.oid) t
+        JOIN pg_class pc ON pc.oid = t.relid
+        WHERE t.isleaf
+    ) ELSE c.reltuples END::bigint,
+    pk.conname IS NOT NULL,
+    fk.ref_table,
+    fk.ref_column,
+    (
+        SELECT array_agg(e.enumlabel ORDER BY e.enumsortorder)
+        FROM pg_enum e
+        WHERE e.enumtypid = a.atttypid
+    )
+FROM pg_class c
+JOIN pg_attribute a
+    ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+LEFT JOIN LATERAL (
+    SELECT p.conname
+    FROM pg_constraint p
+    WHERE p.conrelid = c.oid AND p.contype = 'p' AND a.attnum = ANY (p.conkey)
+    LIMIT 1
+) pk ON true
+LEFT JOIN LATERAL (
+    SELECT rc.relname AS ref_table, ra.attname AS ref_column
+    FROM pg_constraint f
+    JOIN pg_class rc ON rc.oid = f.confrelid
+    JOIN pg_attribute ra
+        ON ra.attrelid = f.confrelid
+        AND ra.attnum = f.confkey[array_position(f.conkey, a.attnum)]
+    WHERE f.conrelid = c.oid AND f.contype = 'f' AND a.attnum = ANY (f.conkey)
+    LIMIT 1
+) fk ON true
+WHERE c.relnamespace = 'public'::regnamespace
+    AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+    AND NOT c.relispartition
+ORDER BY c.relname, a.attnum;
+"""
+
+# Partitions and inheritance children of public tables, each mapped to the
+# root of its tree; plans name the partitions they scan, not their parent.
+PARTITIONS_QUERY = """
+WITH RECURSIVE tree AS (
+    SELECT inhrelid AS child, inhparent AS parent FROM pg_inherits
+    UNION ALL
+    SELECT tree.child, i.inhparent
+    FROM tree
+    JOIN pg_inherits i ON i.inhrelid = tree.parent
+)
+SELECT c.relname, p.relname
+FROM tree
+JOIN pg_class c ON c.oid = tree.child
+JOIN pg_class p ON p.oid = tree.parent
+WHERE p.relnamespace = 'public'::regnamespace
+    AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = tree.parent);
+"""
+
+# Any DDL rewrites the affected pg_class/pg_attribute/pg_constraint rows and so
+# changes their xmin; ANALYZE updates pg_class in place and does not.
+MARKER_QUERY = """
+SELECT md5(
+    coalesce((
+        SELECT string_agg(
+            c.oid::text || ':' || c.xmin::text || ':' || c.relnatts::text,
+            ',' ORDER BY c.oid
+        )
+        FROM pg_class c
+        WHERE c.relnamespace = 'public'::regnamespace
+            AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+    ), '')
+    || coalesce((
+        SELECT string_agg(
+            a.attrelid::text || '.' || a.attnum::text || ':' || a.xmin::text,
+            ',' ORDER BY a.attrelid, a.attnum
+        )
+        FROM pg_attribute a
+        JOIN pg_class c ON c.oid = a.attrelid
+        WHERE c.relnamespace = 'public'::regnamespace
+            AND c.relkind IN ('r', 'p', 'v', 'm', 'f')
+            AND a.attnum > 0
+    ), '')
+    || coalesce((
+        SELECT string_agg(p.oid::text || ':' || p.xmin::text, ',' ORDER BY p.oid)
+        FROM pg_constraint p
+        WHERE p.connamespace = 'public'::regnamespace
+    ), '')
+    -- ALTER TYPE ... ADD VALUE only adds pg_enum rows
+    || coalesce((
+        SELECT string_agg(e.oid::text || ':' || e.xmin::text, ',' ORDER BY e.oid)
+        FROM pg_enum e
+    ), '')
+);
+"""
+
+
+@dataclass
+class SchemaSnapshot:
+    tables: Schema = field(default_factory=dict)
+    primary_keys: Dict[str, List[str]] = field(default_factory=dict)
+    foreign_keys: ForeignKeys = field(default_factory=dict)
+    row_estimates: Dict[str, int] = field(default_factory=dict)
+    enum_labels: EnumLabels = field(default_factory=dict)
+    # Partition -> the table it belongs to
+    partitions: Dict[str, str] = field(default_factory=dict)
+    marker: str = ""
+    fingerprint: str = ""
+    checked_at: float = 0.0
+
+    def format(self, tables: Optional[Iterable[str]] = None) -> str:
+        return format_compact(
+            self.tables,
+            tables,
+            self.primary_keys,
+            self.foreign_keys,
+            self.row_estimates,
+            self.enum_labels,
+        )
+
+    def build_index(self) -> SchemaIndex:
+        return SchemaIndex(
+            self.tables,
+            foreign_keys=self.foreign_keys,
+            primary_keys=self.primary_keys,
+            row_estimates=self.row_estimates,
+            enum_labels=self.enum_labels,
+        )
+
+
+class SchemaService:
+    def __init__(self, refresh_interval: Optional[float] = None):
+        self.refresh_interval = (
+            refresh_interval
+            if refresh_interval is not None
+            else float(os.getenv("NLQ_SCHEMA_REFRESH_INTERVAL", 60))
+        )
+        self._snapshots: Dict[str, SchemaSnapshot] = {}
+        self._lock = threading.Lock()
+
+    def get(self, pool: ConnectionPool, force: bool = False) -> SchemaSnapshot:
+        with self._lock:
+            snapshot = self._snapshots.get(pool.name)
+            now = time.monotonic()
+            if (
+                snapshot is not None
+                and not force
+                and now - snapshot.checked_at < self.refresh_interval
+            ):
+                return snapshot
+
+            with pool.connection() as conn:
+                marker = conn.execute(MARKER_QUERY).fetchone()[0]
+                if snapshot is None or force or marker != snapshot.marker:
+                    snapshot = self.introspect(conn)
+                    snapshot.marker = marker
+            snapshot.checked_at = now
+            self._snapshots[pool.name] = snapshot
+            return snapshot
+
+    def invalidate(self, pool: ConnectionPool) -> None:
+        with self._lock:
+            self._snapshots.pop(pool.name, None)
+
+    @staticmethod
+    def introspect(conn: psycopg.Connection) -> SchemaSnapshot:
+        snapshot = SchemaSnapshot()
+        with span("schema.introspect") as introspect_span:
+            rows = conn.execute(SCHEMA_QUERY).fetchall()
+            snapshot.partitions = dict(conn.execute(PARTITIONS_QUERY).fetchall())
+            introspect_span.set(rows=len(rows))
+        for (
+            table,
+            column,
+            datatype,
+            reltuples,
+            is_pk,
+            ref_table,
+            ref_column,
+            labels,
+        ) in rows:
+            snapshot.tables.setdefault(table, {})[column] = datatype
+            if labels:
+                snapshot.enum_labels.setdefault(table, {})[column] = labels
+            # reltuples is -1 until the table has been vacuumed or analyzed
+            snapshot.row_estimates[table] = max(reltuples, 0)
+            if is_pk:
+                snapshot.primary_keys.setdefault(table, []).append(column)
+            if ref_table is not None:
+                snapshot.foreign_keys.setdefault(table, {})[column] = (
+                    ref_table,
+                    ref_column,
+                )
+        snapshot.fingerprint = fingerprint_schema(
+            {
+                "tables": snapshot.tables,
+                "primary_keys": snapshot.primary_keys,
+                "foreign_keys": snapshot.foreign_keys,
+                "enum_labels": snapshot.enum_labels,
+            }
+        )
+        return snapshot
@@ -1,11 +1,15 @@
-from db.generators.oil_data import OilDataGenerator
-from db.seed import Seeder
+import argparse
+import sys
+from db.seed_plan import SeedPlan
 
-# Seed your data of choice using a generator
-oil_generator = OilDataGenerator()
-seeder = Seeder(oil_generator)
+# Seed the tables listed in a seed plan; see seed_plan.toml
+parser = argparse.ArgumentParser(description="Seed the tables of a seed plan.")
+parser.add_argument("plan", nargs="?", default="seed_plan.toml")
+parser.add_argument("--tables", nargs="+", help="only seed these tables")
+parser.add_argument(
+    "--force", action="store_true", help="reseed tables even if unchanged"
+)
+args = parser.parse_args()
 
-file_name = "oil_data.csv"
-table_name = "oil_data"
-
-seeder.seed(file_name, table_name, rows=100)
+if not SeedPlan.load(args.plan).run(args.tables, args.force):
+    sys.exit(1)
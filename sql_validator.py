@@ -0,0 +1,221 @@
+import difflib
+import re
+import sqlglot
+
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set
+from sqlglot import exp
+from schema_index import Schema
+
+READ_ONLY_STATEMENTS = (exp.Select, exp.Union)
+WRITE_EXPRESSIONS = (exp.Insert, exp.Update, exp.Delete, exp.Merge, exp.Command)
+STATEMENT_START = (
+    r"^\s*\(*\s*(select|with|values|table|insert|update|delete|merge|create|"
+    r"drop|alter|truncate|grant|revoke|copy|call|do)\b"
+)
+
+
+class SQLValidationError(ValueError):
+    pass
+
+
+@dataclass
+class ValidationResult:
+    sql: str
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def valid(self) -> bool:
+        return not self.errors
+
+
+DOLLAR_QUOTE = re.compile(r"\$([A-Za-z_][A-Za-z0-9_]*)?\$")
+
+
+def statement_start(text: str) -> Optional[int]:
+    # Statements start on their own line; prose may mention "select" too.
+    # Write statements are kept so they can be rejected rather than reduced
+    # to an embedded subquery.
+    start = re.search(STATEMENT_START, text, re.I | re.M)
+    return None if start is None else start.start()
+
+
+def statement_end(text: str) -> Optional[int]:
+    """Index of the first semicolon outside of literals, identifiers and
+    comments, or None if there is none yet."""
+    index = 0
+    while index < len(text):
+        char = text[index]
+        if char in "'\"":
+            # A doubled quote is an escaped one: it closes and reopens
+            escapes = char == "'" and text[index - 1 : index] in ("E", "e")
+            index += 1
+            while index < len(text) and text[index] != char:
+                index += 2 if escapes and text[index] == "\\" else 1
+            if index >= len(text):
+                return None
+        elif text.startswith("--", index):
+            index = text.find("\n", index)
+            if index < 0:
+                return None
+        elif text.startswith("/*", index):
+            # Block comments nest in Postgres
+            depth = 0
+            while index < len(text):
+                if text.startswith("/*", index):
+                    depth += 1
+                    index += 2
+                elif text.startswith("*/", index):
+                    depth -= 1
+                    index += 2
+                    if depth == 0:
+                        break
+                else:
+                    index += 1
+            if depth:
+                return None
+            continue
+        elif char == "$" and not (index and re.match(r"\w", text[index - 1])):
+            tag = DOLLAR_QUOTE.match(text, index)
+            if tag is not None:
+                end = text.find(tag.group(0), tag.end())
+                if end < 0:
+                    return None
+                index = end + len(tag.group(0))
+                continue
+        elif char == ";":
+            return index
+        index += 1
+    return None
+
+
+def complete_statement(text: str) -> bool:
+    """Whether a partial model reply already holds a statement ending in ';'."""
+    start = statement_start(text)
+    return start is not None and statement_end(text[start:]) is not None
+
+
+def extract_sql(text: str) -> str:
+    """Pull the first SQL statement out of a model reply, dropping prose."""
+    fenced = re.search(r"```(?:sql)?\s*(.*?)```", text, re.S | re.I)
+    if fenced:
+        text = fenced.group(1)
+    start = statement_start(text)
+    if start is not None:
+        text = text[start:]
+    end = statement_end(text)
+    if end is not None:
+        text = text[:end]
+    return text.strip() + ";"
+
+
+def identifier_name(identifier: exp.Expression) -> str:
+    # Unquoted identifiers fold to lower case in Postgres
+    if isinstance(identifier, exp.Identifier) and identifier.quoted:
+        return identifier.name
+    return identifier.name.lower()
+
+
+def is_function_source(source: Optional[exp.Expression]) -> bool:
+    if isinstance(source, exp.Table):
+        return isinstance(source.this, exp.Func)
+    return source is not None and not isinstance(source, exp.Subquery)
+
+
+class SQLValidator:
+    """Checks generated SQL locally before it is sent to Postgres.
+
+    Only single read-only statements pass. With a schema, tables and columns
+    are checked against it as well; names introduced by the query itself
+    (aliases, CTEs, subqueries) are accepted wherever they could apply.
+    """
+
+    def __init__(self, schema: Optional[Schema] = None):
+        self.schema = {table: set(columns) for table, columns in (schema or {}).items()}
+        self.all_columns: Set[str] = set().union(*self.schema.values())
+
+    def validate(self, text: str) -> ValidationResult:
+        result = ValidationResult(extract_sql(text))
+        try:
+            statements = [
+                statement
+                for statement in sqlglot.parse(result.sql, read="postgres")
+                if statement is not None
+            ]
+        except sqlglot.errors.ParseError as e:
+            description = e.errors[0]["description"] if e.errors else str(e)
+            result.errors.append(f"syntax error: {description}")
+            return result
+
+        if len(statements) != 1:
+            result.errors.append("expected exactly one SQL statement")
+            return result
+        tree = statements[0]
+        if not isinstance(tree, READ_ONLY_STATEMENTS) or tree.find(*WRITE_EXPRESSIONS):
+            result.errors.append("only SELECT queries are allowed")
+            return result
+        if self.schema:
+            result.errors.extend(self.check_identifiers(tree))
+        return result
+
+    def check_identifiers(self, tree: exp.Expression) -> List[str]:
+        errors = []
+        ctes = {
+            identifier_name(cte.args["alias"].this) for cte in tree.find_all(exp.CTE)
+        }
+        local_names = set(ctes)
+        for alias in tree.find_all(exp.TableAlias):
+            local_names.update(identifier_name(column) for column in alias.columns)
+            if not alias.columns and alias.this and is_function_source(alias.parent):
+                # The alias of a function in FROM also names its output column
+                local_names.add(identifier_name(alias.this))
+        for alias in tree.find_all(exp.Alias):
+            local_names.add(identifier_name(alias.args["alias"]))
+
+        tables: Dict[str, str] = {}
+        external = False
+        for table in tree.find_all(exp.Table):
+            if not table.name:
+                continue
+            name = identifier_name(table.this)
+            if table.db and table.db.lower() != "public":
+                # Catalog and other schemas are not introspected
+                external = True
+                continue
+            if not table.db and name in ctes:
+                continue
+            if name not in self.schema:
+                errors.append(self.unknown("table", name, self.schema))
+                continue
+            tables[
+                identifier_name(table.args["alias"].this) if table.alias else name
+            ] = name
+
+        derived = bool(ctes) or tree.find(exp.Subquery) is not None
+        visible = set().union(*(self.schema[name] for name in tables.values()))
+        for column in tree.find_all(exp.Column):
+            if isinstance(column.this, exp.Star):
+                continue
+            name = identifier_name(column.this)
+            qualifier = column.args.get("table")
+            if qualifier is not None and identifier_name(qualifier) in tables:
+                table = tables[identifier_name(qualifier)]
+                if name not in self.schema[table]:
+                    errors.append(
+                        self.unknown(f"column of {table}", name, self.schema[table])
+                    )
+                continue
+            if external:
+                continue
+            candidates = self.all_columns if derived or qualifier else visible
+            if name not in candidates and name not in local_names:
+                errors.append(self.unknown("column", name, visible or self.all_columns))
+        return list(dict.fromkeys(errors))
+
+    @staticmethod
+    def unknown(kind: str, name: str, known: Set[str]) -> str:
+        message = f"unknown {kind} '{name}'"
+        matches = difflib.get_close_matches(name, known, n=3)
+        if matches:
+            message += f" (did you mean {', '.join(matches)}?)"
+        return message
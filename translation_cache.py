@@ -0,0 +1,129 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from typing import Dict, Optional, Sequence
+from utils import data_path
+
+
+class TranslationCache:
+    def __init__(
+        self,
+        path: Optional[str] = None,
+        ttl: Optional[float] = None,
+        max_entries: Optional[int] = None,
+    ):
+        self.path = path or data_path("translations.sqlite3")
+        self.ttl = ttl if ttl is not None else float(os.getenv("NLQ_CACHE_TTL", 86400))
+        self.max_entries = (
+            max_entries
+            if max_entries is not None
+            else int(os.getenv("NLQ_CACHE_SIZE", 256))
+        )
+        self.memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS translations "
+            "(key TEXT PRIMARY KEY, sql TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        question = re.sub(r"\s+", " ", question.strip().lower())
+        return question.rstrip(" ?.!;")
+
+    def make_key(
+        self,
+        question: str,
+        schema_fingerprint: str,
+        model_id: str,
+        context: Sequence[Dict[str, str]] = (),
+    ) -> str:
+        """Key of a question asked after the given earlier user and assistant
+        turns; follow-ups like "only the active ones" depend on them."""
+        turns = [
+            f"user:{self.normalize(m['content'])}"
+            if m["role"] == "user"
+            else f"assistant:{m['content'].strip()}"
+            for m in context
+            if m["role"] in ("user", "assistant")
+        ]
+        conversation = hashlib.sha256("\x1e".join(turns).encode()).hexdigest()
+        payload = "\x1f".join(
+            [self.normalize(question), schema_fingerprint, model_id, conversation]
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self.memory.get(key)
+            if entry is not None and now - entry[1] < self.ttl:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+            row = self._db.execute(
+                "SELECT sql, created_at FROM translations WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] < self.ttl:
+                self._remember(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return row[0]
+
+            if row is not None:
+                self._db.execute("DELETE FROM translations WHERE key = ?", (key,))
+                self._db.commit()
+            self.memory.pop(key, None)
+            self.misses += 1
+            return None
+
+    def set(self, key: str, sql: str) -> None:
+        now = time.time()
+        with self._lock:
+            self._remember(key, sql, now)
+            self._db.execute(
+                "INSERT OR REPLACE INTO translations (key, sql, created_at) "
+                "VALUES (?, ?, ?)",
+                (key, sql, now),
+            )
+            self._db.commit()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self.memory.pop(key, None)
+            self._db.execute("DELETE FROM translations WHERE key = ?", (key,))
+            self._db.commit()
+
+    def _remember(self, key: str, sql: str, created_at: float) -> None:
+        self.memory[key] = (sql, created_at)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def purge_expired(self) -> None:
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM translations WHERE created_at < ?",
+                (time.time() - self.ttl,),
+            )
+            self._db.commit()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "memory_hits": self.hits - self.disk_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "entries": len(self.memory),
+        }
@@ -1,13 +1,132 @@
-from typing import Optional
-from pandas import DataFrame
-from sqlalchemy import create_engine
+from collections import defaultdict
+from typing import Dict, List, Optional
+from psycopg_pool import ConnectionPool
+from connection_pool import ConnectionParams, PoolRegistry
 from openai_query import OpenAIQuery
+from async_engine import AsyncEngine
+from index_advisor import IndexAdvisor, advisor_trial_rows
+from instrumentation import Span, collect, serve_metrics, span
+from query_executor import ResultPage, max_result_rows, page_size
+from result_cache import ResultCache
+from result_store import ResultStore, SessionResults
+from rollups import ROLLUP_SCHEMA
+from schema_index import SchemaIndex
+from schema_service import SchemaService, SchemaSnapshot
+from sql_validator import SQLValidator
+from translation_cache import TranslationCache
+from utils import arrow_to_dataframe
+from workload_log import WorkloadLog
+from viz_loader import (
+    SAMPLE_METHODS,
+    FrameCache,
+    SampleSpec,
+    is_numeric_type,
+    load_sample,
+    viz_sample_rows,
+)
 from pygwalker.api.streamlit import StreamlitRenderer, init_streamlit_comm
 import os
+import time
 import pandas as pd
 import streamlit as st
 import psycopg
-import json
+
+
+@st.cache_resource
+def get_pool_registry() -> PoolRegistry:
+    return PoolRegistry()
+
+
+JOB_POLL_INTERVAL = 0.5
+STREAM_POLL_INTERVAL = 0.1
+MIN_VIZ_SAMPLE_ROWS = 1_000
+PERFORMANCE_COLUMNS = (
+    "stage",
+    "count",
+    "ms",
+    "rows",
+    "bytes",
+    "prompt_tokens",
+    "completion_tokens",
+    "process_peak_rss_mb",
+)
+
+
+@st.cache_resource(show_spinner=False)
+def start_metrics_server() -> None:
+    serve_metrics()
+
+
+def summarize_spans(spans: List[Span]) -> pd.DataFrame:
+    stages: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+    for stage_span in spans:
+        stage = stages[stage_span.name]
+        stage["count"] += 1
+        stage["ms"] += stage_span.seconds * 1000
+        for attribute in ("rows", "bytes", "prompt_tokens", "completion_tokens"):
+            value = stage_span.attributes.get(attribute)
+            if isinstance(value, (int, float)):
+                stage[attribute] += value
+        stage["process_peak_rss_mb"] = max(
+            stage["process_peak_rss_mb"],
+            stage_span.attributes.get("process_peak_rss_bytes", 0) / 2**20,
+        )
+    return (
+        pd.DataFrame(
+            [{"stage": name, **values} for name, values in stages.items()],
+            columns=PERFORMANCE_COLUMNS,
+        )
+        .fillna(0)
+        .round(1)
+    )
+
+
+@st.cache_resource
+def get_result_cache() -> ResultCache:
+    return ResultCache()
+
+
+# Created before set_page_config, so it must not show a spinner
+@st.cache_resource(show_spinner=False)
+def get_result_store() -> ResultStore:
+    return ResultStore()
+
+
+@st.cache_resource
+def get_workload_log() -> WorkloadLog:
+    return WorkloadLog()
+
+
+@st.cache_resource
+def get_async_engine() -> AsyncEngine:
+    return AsyncEngine(result_cache=get_result_cache(), workload_log=get_workload_log())
+
+
+@st.cache_resource
+def get_translation_cache() -> TranslationCache:
+    return TranslationCache()
+
+
+@st.cache_resource
+def get_schema_service() -> SchemaService:
+    return SchemaService()
+
+
+@st.cache_resource
+def get_viz_cache() -> FrameCache:
+    return FrameCache()
+
+
+@st.cache_resource(max_entries=8)
+def get_schema_index(schema_fingerprint: str, _snapshot: SchemaSnapshot) -> SchemaIndex:
+    return _snapshot.build_index()
+
+
+@st.cache_resource(max_entries=8)
+def get_sql_validator(
+    schema_fingerprint: str, _snapshot: SchemaSnapshot
+) -> SQLValidator:
+    return SQLValidator(_snapshot.tables)
 
 
 class UI:
@@ -15,29 +134,53 @@ class UI:
         self.initialize_session_state()
 
     def setup_pygwalker(self) -> None:
-        init_streamlit_comm()
+        spec = st.session_state.get("viz_spec")
+        if spec is None:
+            st.info("Pick a table in the sidebar and load it to explore it here.")
+            return
 
-        @st.cache_resource
-        def get_pyg_renderer() -> "StreamlitRenderer":
-            connection_string = (
-                f"postgresql+psycopg://"
-                f"{os.getenv('DB_USER')}:"
-                f"{os.getenv('DB_PASSWORD')}@"
-                f"{os.getenv('DB_HOST')}:"
-                f"{os.getenv('DB_PORT')}/"
-                f"{os.getenv('DB_NAME')}"
+        init_streamlit_comm()
+        pool = self.get_pool()
+        cache = get_viz_cache()
+        renderer = cache.get((pool.name, spec))
+        if renderer is None:
+            snapshot = st.session_state.get("schema_snapshot")
+            if snapshot is None or spec.table not in snapshot.tables:
+                # E.g. after connecting to another database or dropping it
+                del st.session_state["viz_spec"]
+                st.info(f"{spec.table} is no longer in the schema; pick a table.")
+                return
+            try:
+                with st.spinner(f"Loading {spec.describe()}…"):
+                    with pool.connection() as conn:
+                        df = load_sample(
+                            conn,
+                            spec,
+                            snapshot.tables[spec.table],
+                            snapshot.row_estimates.get(spec.table),
+                        )
+            except psycopg.Error as e:
+                st.error(f"Error loading {spec.table}: {e}")
+                return
+            renderer = StreamlitRenderer(df, spec="./gw_config.json", debug=False)
+            cache.set(
+                (pool.name, spec), renderer, int(df.memory_usage(deep=True).sum())
             )
-            engine = create_engine(connection_string)
-            query = "SELECT * FROM oil_data"
-            df = pd.read_sql_query(query, engine)
-            return StreamlitRenderer(df, spec="./gw_config.json", debug=False)
-
-        renderer = get_pyg_renderer()
+        st.caption(spec.describe())
         renderer.render_explore()
 
+    @staticmethod
+    def get_pool() -> Optional[ConnectionPool]:
+        params = st.session_state.get("connection")
+        if params is None:
+            return None
+        return get_pool_registry().get(params)
+
     def initialize_session_state(self) -> None:
         st.session_state.setdefault("tabs", ["Database Connection"])
         st.session_state.setdefault("active_tab", "Database Connection")
+        if "results" not in st.session_state:
+            st.session_state["results"] = SessionResults(get_result_store())
 
     def add_new_tab(self, new_tab_name):
         if new_tab_name and new_tab_name not in st.session_state["tabs"]:
@@ -45,6 +188,7 @@ class UI:
             self.initialize_query_log(self.create_key("query_log", new_tab_name))
 
     def delete_all_tabs(self):
+        st.session_state["results"].drop()
         st.session_state["tabs"] = ["Database Connection"]
         st.session_state["active_tab"] = "Database Connection"
 
@@ -54,7 +198,13 @@ class UI:
 
     def handle_sidebar(self) -> None:
         with st.sidebar:
-            pages = ["Database", "Schema", "Conversations", "Visualizations"]
+            pages = [
+                "Database",
+                "Schema",
+                "Conversations",
+                "Visualizations",
+                "Workload",
+            ]
             page = st.radio("Go to", pages)
 
             st.session_state["current_page"] = page
@@ -76,13 +226,53 @@ class UI:
                 if st.button("Close Database"):
                     self.handle_close_database_button()
 
+                pool_stats = get_pool_registry().stats()
+                pool_stats.update(get_async_engine().stats())
+                for name, stats in pool_stats.items():
+                    st.caption(
+                        f"Pool {name}: {stats.get('pool_size', 0)} open, "
+                        f"{stats.get('pool_available', 0)} idle, "
+                        f"{stats.get('requests_waiting', 0)} waiting "
+                        f"(min {stats.get('pool_min')}, max {stats.get('pool_max')})"
+                    )
+
+                stats = get_result_cache().stats()
+                st.caption(
+                    f"Result cache: {stats['hit_rate']:.0%} hit rate "
+                    f"({stats['hits']} hits, {stats['misses']} misses), "
+                    f"{stats['entries']} entries, {stats['bytes'] / 2**20:.1f} MB"
+                )
+
+                for label, stats in (
+                    ("This session", st.session_state["results"].stats()),
+                    ("All sessions", get_result_store().stats()),
+                ):
+                    st.caption(
+                        f"{label}: {stats['entries']} results, "
+                        f"{stats['memory_bytes'] / 2**20:.1f} MB in memory, "
+                        f"{stats['disk_bytes'] / 2**20:.1f} MB on disk "
+                        f"({stats['spilled']} spilled)"
+                    )
+
             elif page == "Schema":
                 if "schema" in st.session_state:
-                    schema = st.session_state["schema"]
-                    for table_name, columns in schema.items():
+                    snapshot = st.session_state["schema_snapshot"]
+                    for table_name, columns in snapshot.tables.items():
                         st.markdown(f"<h3>📋{table_name}</h3>", unsafe_allow_html=True)
+                        if snapshot.row_estimates.get(table_name):
+                            st.caption(f"~{snapshot.row_estimates[table_name]:,} rows")
+                        primary_keys = snapshot.primary_keys.get(table_name, [])
+                        foreign_keys = snapshot.foreign_keys.get(table_name, {})
                         for column_name, data_type in columns.items():
-                            st.markdown(f"🔹 {column_name} ({data_type})")
+                            marker = "🔑" if column_name in primary_keys else "🔹"
+                            reference = ""
+                            if column_name in foreign_keys:
+                                reference = " → {}.{}".format(
+                                    *foreign_keys[column_name]
+                                )
+                            st.markdown(
+                                f"{marker} {column_name} ({data_type}){reference}"
+                            )
                 else:
                     st.info("No schema available. Please connect to a database first.")
 
@@ -99,17 +289,155 @@ class UI:
                         if st.button(tab):
                             st.session_state["active_tab"] = tab
 
+                stats = get_translation_cache().stats()
+                st.caption(
+                    f"Translation cache: {stats['hits']} hits "
+                    f"({stats['disk_hits']} from disk), {stats['misses']} misses"
+                )
+
             elif page == "Visualizations":
-                pass
+                self.handle_visualization_sidebar()
+
+    def handle_workload_page(self) -> None:
+        st.title("Workload")
+        pool = self.get_pool()
+        snapshot = st.session_state.get("schema_snapshot")
+        if snapshot is None:
+            st.info("No schema available. Please connect to a database first.")
+            return
+        entries = get_workload_log().entries(pool.name)
+        st.caption(f"{len(entries)} generated queries logged for {pool.name}.")
+        if not entries:
+            return
+
+        # Trial indexes are real builds that block writers, so only admins
+        # (NLQ_ADMIN=1) may run them.
+        admin = os.getenv("NLQ_ADMIN") == "1"
+        advisor = IndexAdvisor(
+            snapshot.tables,
+            snapshot.row_estimates,
+            snapshot.partitions,
+            allow_trial=admin,
+        )
+        hot = advisor.hot_columns(entries)
+        st.subheader("Hot columns")
+        st.dataframe(
+            pd.DataFrame([vars(column) for column in hot]).round(3),
+            hide_index=True,
+        )
+
+        try:
+            with pool.connection() as conn:
+                hypopg = IndexAdvisor.has_hypopg(conn)
+        except psycopg.Error as e:
+            st.error(f"Error checking for hypopg: {e}")
+            return
+        if not hypopg:
+            if not admin:
+                st.info(
+                    "Install the hypopg extension to compare plans with "
+                    "hypothetical indexes."
+                )
+                return
+            st.warning(
+                "The hypopg extension is not installed, so each candidate index "
+                f"on a table of up to {advisor_trial_rows():,} rows is really "
+                "built and then rolled back. Writes to that table wait while "
+                "the index builds."
+            )
+        if st.button("Analyze indexes", type="primary"):
+            try:
+                with st.spinner("Comparing plans with candidate indexes…"):
+                    with pool.connection() as conn:
+                        st.session_state["index_recommendations"] = advisor.advise(
+                            conn, entries
+                        )
+            except psycopg.Error as e:
+                st.error(f"Error analyzing indexes: {e}")
+        recommendations = st.session_state.get("index_recommendations")
+        if recommendations is None:
+            return
+
+        st.subheader("Recommended indexes")
+        recommended = [r for r in recommendations if r.recommended]
+        if not recommended:
+            st.info("No index would noticeably lower the cost of the logged queries.")
+        # Creating indexes is only offered to admins
+        apply = admin and st.toggle("Allow applying indexes")
+        for number, recommendation in enumerate(recommended):
+            st.markdown(recommendation.describe())
+            st.code(f"{recommendation.ddl};", language="sql")
+            if apply and st.button("Apply", key=f"apply_index_{number}"):
+                try:
+                    with st.spinner("Creating index…"):
+                        with pool.connection() as conn:
+                            IndexAdvisor.apply(conn, recommendation)
+                    st.success(f"Created index on {recommendation.table}.")
+                    del st.session_state["index_recommendations"]
+                except psycopg.Error as e:
+                    st.error(f"Error creating index: {e}")
+        rejected = [r for r in recommendations if not r.recommended]
+        if rejected:
+            with st.expander("Other candidates"):
+                for recommendation in rejected:
+                    st.markdown(recommendation.describe())
+
+    def handle_visualization_sidebar(self) -> None:
+        snapshot = st.session_state.get("schema_snapshot")
+        if snapshot is None:
+            st.info("No schema available. Please connect to a database first.")
+            return
+
+        table = st.selectbox("Table", sorted(snapshot.tables))
+        columns = snapshot.tables[table]
+        estimate = snapshot.row_estimates.get(table)
+        if estimate:
+            st.caption(f"~{estimate:,} rows")
+        method = st.selectbox(
+            "Loading", list(SAMPLE_METHODS), format_func=SAMPLE_METHODS.get
+        )
+        group_by: List[str] = []
+        if method == "aggregate":
+            group_by = st.multiselect(
+                "Group by",
+                [
+                    column
+                    for column, datatype in columns.items()
+                    if not is_numeric_type(datatype)
+                ],
+            )
+        rows = st.number_input(
+            "Max rows",
+            min_value=MIN_VIZ_SAMPLE_ROWS,
+            value=max(viz_sample_rows(), MIN_VIZ_SAMPLE_ROWS),
+            step=10_000,
+        )
+        if st.button(
+            "Load", type="primary", disabled=method == "aggregate" and not group_by
+        ):
+            st.session_state["viz_spec"] = SampleSpec(
+                table, method, int(rows), tuple(group_by)
+            )
+
+        stats = get_viz_cache().stats()
+        st.caption(
+            f"Visualization cache: {stats['entries']} frames, "
+            f"{stats['bytes'] / 2**20:.1f} MB, {stats['evictions']} evicted"
+        )
 
     def connect_to_database(
         self, host: str, port: str, user: str, password: str, dbname: str
-    ):
+    ) -> Optional[ConnectionParams]:
+        params = {
+            "host": host,
+            "port": port,
+            "user": user,
+            "password": password,
+            "dbname": dbname,
+        }
         try:
-            conn = psycopg.connect(
-                host=host, port=port, user=user, password=password, dbname=dbname
-            )
-            return conn
+            get_pool_registry().get(params)
+            return params
         except psycopg.Error as e:
             st.error(f"Connection failed: {e}")
             return None
@@ -119,52 +447,130 @@ class UI:
             st.title("Database Connection")
             if "connection" in st.session_state:
                 st.success("Connected to the database!")
-                self.retrieve_and_store_schema(st.session_state["cursor"])
+                self.retrieve_and_store_schema()
             else:
                 st.error("Not connected to any database.")
 
-    def handle_successful_connection(self, connection):
-        cursor = connection.cursor()
-        # Store connection and cursor in session state
-        st.session_state["connection"] = connection
-        st.session_state["cursor"] = cursor
+    def handle_successful_connection(self, params: ConnectionParams):
+        # Sessions only keep the connection parameters; connections are
+        # borrowed from the shared pool for each query.
+        st.session_state["connection"] = params
         # Retrieve and store schema
-        self.retrieve_and_store_schema(cursor)
-
-    def retrieve_and_store_schema(self, cursor):
-        cursor.execute(
-            """
-        SELECT 
-            table_name, 
-            column_name, 
-            data_type 
-        FROM 
-            information_schema.columns 
-        WHERE 
-            table_schema = 'public';
-        """
-        )
-        schema_data = cursor.fetchall()
-        schema = {}
-        for table, column, datatype in schema_data:
-            if table not in schema:
-                schema[table] = {}
-            schema[table][column] = datatype
-        st.session_state["schema"] = schema
-        formatted_schema = json.dumps(schema, indent=4)
-        st.session_state["formatted_schema"] = formatted_schema
-
-    def execute_sql_query(self, cursor, query: str) -> Optional[DataFrame]:
-        try:
-            cursor.execute(query)
-            rows = cursor.fetchall()
-            column_names = [desc[0] for desc in cursor.description]
-            df = pd.DataFrame(rows, columns=column_names)
-            return df
-        except Exception as e:
-            st.error(f"Error executing query: {e}")
-            cursor.execute("ROLLBACK")
-            return None
+        self.retrieve_and_store_schema()
+
+    def retrieve_and_store_schema(self, force: bool = False):
+        snapshot = get_schema_service().get(self.get_pool(), force=force)
+        if st.session_state.get("schema_fingerprint") == snapshot.fingerprint:
+            return
+        st.session_state["schema"] = snapshot.tables
+        st.session_state["schema_snapshot"] = snapshot
+        st.session_state["schema_fingerprint"] = snapshot.fingerprint
+        st.session_state["formatted_schema"] = snapshot.format()
+
+    def execute_sql_query(
+        self,
+        selected_tab: str,
+        query: str,
+        offset: int = 0,
+        force: bool = False,
+        cursor: Optional[str] = None,
+    ) -> None:
+        params = st.session_state.get("connection")
+        if params is None:
+            st.error("Not connected to any database.")
+            return
+        job = get_async_engine().submit_query(params, query, offset, force, cursor)
+        st.session_state[self.create_key("job", selected_tab)] = job.id
+
+    def poll_job(self, selected_tab: str) -> None:
+        job_key = self.create_key("job", selected_tab)
+        job_id = st.session_state.get(job_key)
+        if job_id is None:
+            return
+        engine = get_async_engine()
+        job = engine.get(job_id)
+        if job is None:
+            del st.session_state[job_key]
+            return
+
+        if not job.done:
+            label = (
+                "Translating question"
+                if job.status == "translating"
+                else "Running query"
+            )
+            st.info(f"{label}… {job.elapsed:.1f}s")
+            if st.button("Cancel", key=self.create_key("cancel", selected_tab)):
+                engine.cancel(job_id)
+            streaming = job.status == "translating" and job.sql is not None
+            if streaming:
+                st.text_area(
+                    "Generated SQL Query:", value=job.sql, height=200, disabled=True
+                )
+            st.session_state["poll_jobs"] = (
+                STREAM_POLL_INTERVAL if streaming else JOB_POLL_INTERVAL
+            )
+            return
+
+        engine.pop(job_id)
+        del st.session_state[job_key]
+        if job.messages:
+            st.session_state[self.create_key("query_log", selected_tab)] = job.messages
+        if job.sql is not None and (job.kind == "question" or job.plan is not None):
+            st.session_state[self.create_key("generated_query", selected_tab)] = job.sql
+        if job.plan is not None:
+            st.session_state[self.create_key("plan", selected_tab)] = job.plan
+        if job.rewrite is not None:
+            st.session_state[self.create_key("rewrite", selected_tab)] = job.rewrite
+        if job.kind == "question":
+            st.session_state[self.create_key("timings", selected_tab)] = (
+                job.time_to_first_output,
+                job.time_to_results,
+            )
+        if job.page is not None:
+            with collect(job.spans):
+                self.store_result_page(selected_tab, job.page)
+        st.session_state[self.create_key("spans", selected_tab)] = job.spans
+        if job.status == "confirm":
+            st.session_state[self.create_key("confirm", selected_tab)] = job.error
+        elif job.status == "blocked":
+            st.error(job.error)
+        elif job.status == "failed":
+            st.error(f"Error executing query: {job.error}")
+        elif job.status == "cancelled":
+            st.warning("Query cancelled.")
+
+    @staticmethod
+    def schedule_poll() -> None:
+        # Rerun while the active tab has a job in flight so it picks up the result
+        interval = st.session_state.pop("poll_jobs", None)
+        if interval:
+            time.sleep(interval)
+            st.rerun()
+
+    def store_result_page(self, selected_tab: str, page: ResultPage) -> None:
+        results = st.session_state["results"]
+        page_key = self.create_key("result_page", selected_tab)
+        df = arrow_to_dataframe(page.table)
+        previous = st.session_state.get(page_key)
+        shown = results.get(selected_tab) if page.offset else None
+        if shown is not None:
+            # Keep a sliding window of at most max_result_rows rows per tab
+            df = pd.concat([shown, df], ignore_index=True)
+            df = df.iloc[-max_result_rows() :].reset_index(drop=True)
+        results.put(selected_tab, df)
+        if page.offset == 0 and previous is not None and previous.get("cursor"):
+            # The tab's earlier result will not be paged any further
+            get_async_engine().close_cursor(previous["cursor"])
+        st.session_state[page_key] = {
+            "next_offset": page.offset + page.num_rows,
+            "has_more": page.has_more,
+            "cursor": page.cursor,
+            "estimated_rows": (
+                page.estimated_rows if page.offset == 0 else previous["estimated_rows"]
+            ),
+            "window_start": page.offset + page.num_rows - len(df),
+        }
 
     def initialize_query_log(self, tab_key: str) -> None:
         if tab_key not in st.session_state:
@@ -185,17 +591,16 @@ class UI:
             ]
 
     def handle_query_tab(self) -> None:
-        if "cursor" not in st.session_state:
-            st.session_state["cursor"] = None
-
         if st.session_state["active_tab"] != "Database Connection":
             selected_tab = st.session_state["active_tab"]
             st.title(selected_tab)
 
             self.initialize_query_log(selected_tab)
             self.handle_query_generation(selected_tab)
+            self.poll_job(selected_tab)
             self.display_generated_query(selected_tab)
             self.display_dataframe(selected_tab)
+            self.display_performance(selected_tab)
 
     def handle_query_generation(self, selected_tab):
         user_input_key = self.create_key("user_input", selected_tab)
@@ -206,37 +611,49 @@ class UI:
         )
         st.session_state[user_input_key] = user_query  # Store the current input
 
-        if st.button("Generate SQL Query", key=f"button_{selected_tab}"):
+        job_running = self.create_key("job", selected_tab) in st.session_state
+        if (
+            st.button("Generate SQL Query", key=f"button_{selected_tab}")
+            and not job_running
+        ):
             self.generate_sql_query(selected_tab, user_query)
 
     def generate_sql_query(self, selected_tab, user_query):
         tab_key = self.create_key("query_log", selected_tab)
-        st.session_state[tab_key].append({"role": "user", "content": user_query})
-
-        query = OpenAIQuery(api_key=os.getenv("OPENAI_API_KEY"))
-        client = query.client
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo", messages=st.session_state[tab_key]
-        )
-
-        st.session_state[tab_key].append(
-            {
-                "role": "assistant",
-                "content": response.choices[0].message.content.strip(),
-            }
+        schema_fingerprint = st.session_state.get("schema_fingerprint", "")
+        query = OpenAIQuery(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            cache=get_translation_cache(),
+            schema_fingerprint=schema_fingerprint,
         )
-
-        model_query = st.session_state[tab_key][-1]["content"]
+        if "schema_snapshot" in st.session_state:
+            query.schema_index = get_schema_index(
+                schema_fingerprint, st.session_state["schema_snapshot"]
+            )
+            query.validator = get_sql_validator(
+                schema_fingerprint, st.session_state["schema_snapshot"]
+            )
+            query.update_system_message(st.session_state[tab_key], user_query)
+
+        params = st.session_state.get("connection")
+        if params is None:
+            st.error("Not connected to any database.")
+            return
+        for prefix in ("generated_query", "plan", "rewrite", "confirm", "timings"):
+            st.session_state.pop(self.create_key(prefix, selected_tab), None)
+        messages = st.session_state[tab_key] + [{"role": "user", "content": user_query}]
+        job = get_async_engine().submit_question(params, query, messages)
+        st.session_state[self.create_key("job", selected_tab)] = job.id
+
+    def load_next_page(self, selected_tab):
         generated_query_key = self.create_key("generated_query", selected_tab)
-        st.session_state[generated_query_key] = model_query
-
-        df = self.execute_sql_query(
-            cursor=st.session_state["cursor"],
-            query=model_query,
+        page_state = st.session_state[self.create_key("result_page", selected_tab)]
+        self.execute_sql_query(
+            selected_tab,
+            st.session_state[generated_query_key],
+            offset=page_state["next_offset"],
+            cursor=page_state.get("cursor"),
         )
-        if df is not None:
-            dataframe_key = self.create_key("dataframe", selected_tab)
-            st.session_state[dataframe_key] = df
 
     def display_generated_query(self, selected_tab):
         generated_query_key = self.create_key("generated_query", selected_tab)
@@ -248,14 +665,77 @@ class UI:
                 height=200,
                 key=query_display_key,
             )
+            plan = st.session_state.get(self.create_key("plan", selected_tab))
+            if plan is not None:
+                st.caption(f"Plan: {plan.describe()}")
+            rewrite = st.session_state.get(self.create_key("rewrite", selected_tab))
+            if rewrite is not None:
+                st.caption(f"Answered from rollup {ROLLUP_SCHEMA}.{rewrite.rollup}")
+                with st.expander("Original query"):
+                    st.code(rewrite.original, language="sql")
+            timings = st.session_state.get(self.create_key("timings", selected_tab))
+            if timings is not None:
+                first_output, results = timings
+                st.caption(
+                    " · ".join(
+                        f"{label} after {seconds:.2f}s"
+                        for label, seconds in (
+                            ("First output", first_output),
+                            ("results", results),
+                        )
+                        if seconds is not None
+                    )
+                )
+
+            confirm_key = self.create_key("confirm", selected_tab)
+            if confirm_key in st.session_state:
+                st.warning(st.session_state[confirm_key])
+                if st.button("Run anyway", key=self.create_key("force", selected_tab)):
+                    del st.session_state[confirm_key]
+                    self.execute_sql_query(
+                        selected_tab,
+                        st.session_state[generated_query_key],
+                        force=True,
+                    )
+                    st.rerun()
 
     def display_dataframe(self, selected_tab):
-        dataframe_key = self.create_key("dataframe", selected_tab)
-        if dataframe_key in st.session_state:
-            st.dataframe(st.session_state[dataframe_key])
+        df = st.session_state["results"].get(selected_tab)
+        if df is not None:
+            page_state = st.session_state.get(
+                self.create_key("result_page", selected_tab)
+            )
+            if page_state is not None:
+                start = page_state["window_start"]
+                estimate = page_state["estimated_rows"]
+                st.caption(
+                    f"Rows {start + 1 if len(df) else 0:,}–{start + len(df):,}"
+                    + (f" of ~{estimate:,} (estimated)" if estimate is not None else "")
+                )
+            with span("ui.render", rows=len(df)) as render_span:
+                st.dataframe(df)
+            st.session_state[self.create_key("render_span", selected_tab)] = render_span
+            job_running = self.create_key("job", selected_tab) in st.session_state
+            if page_state is not None and page_state["has_more"] and not job_running:
+                if st.button(
+                    f"Load next {page_size():,} rows",
+                    key=self.create_key("load_next", selected_tab),
+                ):
+                    self.load_next_page(selected_tab)
+                    st.rerun()
+
+    def display_performance(self, selected_tab):
+        spans = list(st.session_state.get(self.create_key("spans", selected_tab), []))
+        render_span = st.session_state.get(self.create_key("render_span", selected_tab))
+        if render_span is not None:
+            spans.append(render_span)
+        if spans:
+            with st.expander("Performance"):
+                st.dataframe(summarize_spans(spans), hide_index=True)
 
     def handle_close_database_button(self) -> None:
-        if "cursor" in st.session_state and "connection" in st.session_state:
-            st.session_state["cursor"].close()
-            st.session_state["cursor"] = None
+        # The pool is shared with other sessions, so only this session's
+        # reference to it is dropped here.
+        if "connection" in st.session_state:
+            del st.session_state["connection"]
             st.session_state["active_tab"] = "Database Connection"
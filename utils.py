@@ -1,13 +1,206 @@
+import hashlib
+import json
+import operator
+import os
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 
-from typing import List, Dict, Any
+from decimal import Decimal
+from typing import List, Dict, Any, Optional, Sequence, Tuple
+from instrumentation import span
+
+# Arrow types for the Postgres type OIDs reported in cursor descriptions;
+# anything else is materialized as text. numeric is handled separately.
+ARROW_TYPES = {
+    16: pa.bool_(),
+    17: pa.binary(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    26: pa.int64(),
+    700: pa.float32(),
+    701: pa.float64(),
+    19: pa.string(),
+    25: pa.string(),
+    1042: pa.string(),
+    1043: pa.string(),
+    1082: pa.date32(),
+    1083: pa.time64("us"),
+    1114: pa.timestamp("us"),
+    1184: pa.timestamp("us", tz="UTC"),
+}
 
 
 def format_as_dataframe(rows: List[List[Any]], column_names: List[str]) -> pd.DataFrame:
-    return pd.DataFrame(rows, columns=column_names)
+    with span("format.dataframe", rows=len(rows)):
+        return pd.DataFrame(rows, columns=column_names)
 
 
 def format_as_dict(
     rows: List[List[Any]], column_names: List[str]
 ) -> List[Dict[str, Any]]:
-    return [dict(zip(column_names, row)) for row in rows]
+    with span("format.dict", rows=len(rows)):
+        return [dict(zip(column_names, row)) for row in rows]
+
+
+NUMERIC = 1700
+MAX_DECIMAL_PRECISION = 38
+# Marks text fields holding numeric values of no declared precision
+NUMERIC_TEXT = {b"pg_type": b"numeric"}
+
+
+def arrow_field(
+    name: str,
+    type_code: int,
+    numeric: Optional[Tuple[Optional[int], Optional[int]]] = None,
+) -> pa.Field:
+    if type_code != NUMERIC:
+        return pa.field(name, ARROW_TYPES.get(type_code, pa.string()))
+    precision, scale = numeric or (None, None)
+    if precision is not None and precision <= MAX_DECIMAL_PRECISION:
+        return pa.field(name, pa.decimal128(precision, scale or 0))
+    # Exact as text until the values are known, see numeric_text_to_decimal
+    return pa.field(name, pa.string(), metadata=NUMERIC_TEXT)
+
+
+def arrow_schema(
+    column_names: List[str],
+    type_codes: Sequence[int],
+    numerics: Optional[Sequence[Tuple[Optional[int], Optional[int]]]] = None,
+) -> pa.Schema:
+    """Arrow schema for a result; numerics are the (precision, scale) of each
+    column, None for numeric columns of no declared precision."""
+    numerics = numerics or [(None, None)] * len(type_codes)
+    return pa.schema(
+        [
+            arrow_field(name, type_code, numeric)
+            for name, type_code, numeric in zip(column_names, type_codes, numerics)
+        ]
+    )
+
+
+def numeric_text_to_decimal(table: pa.Table) -> pa.Table:
+    """Convert numeric columns held as text to the narrowest decimal128 that
+    holds all their values; columns that need more than 38 digits, or hold
+    NaN or infinity, stay text."""
+    for index, arrow_field in enumerate(table.schema):
+        if arrow_field.metadata != NUMERIC_TEXT:
+            continue
+        integer_digits, scale = 1, 0
+        for value in table.column(index).drop_null().to_pylist():
+            exponent = Decimal(value).as_tuple().exponent
+            if not isinstance(exponent, int):
+                break
+            scale = max(scale, -exponent)
+            integer_digits = max(integer_digits, len(value.lstrip("-").split(".")[0]))
+        else:
+            precision = integer_digits + scale
+            if precision <= MAX_DECIMAL_PRECISION:
+                decimal = pa.decimal128(precision, scale)
+                table = table.set_column(
+                    index,
+                    pa.field(arrow_field.name, decimal),
+                    table.column(index).cast(decimal),
+                )
+    return table
+
+
+def to_text(value: Any) -> Optional[str]:
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, Decimal):
+        # Fixed-point notation, which Arrow's decimal cast can parse
+        return format(value, "f")
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str)
+    return str(value)
+
+
+def format_as_arrow(
+    rows: List[List[Any]],
+    column_names: List[str],
+    schema: Optional[pa.Schema] = None,
+) -> pa.RecordBatch:
+    with span("format.arrow", rows=len(rows)) as format_span:
+        batch = rows_to_record_batch(rows, column_names, schema)
+        format_span.set(bytes=batch.nbytes)
+    return batch
+
+
+def rows_to_record_batch(
+    rows: List[List[Any]],
+    column_names: List[str],
+    schema: Optional[pa.Schema] = None,
+) -> pa.RecordBatch:
+    arrays: Dict[int, pa.Array] = {}
+    float_indexes = []
+    if schema is not None and rows:
+        float_indexes = [
+            i
+            for i, arrow_field in enumerate(schema)
+            if pa.types.is_floating(arrow_field.type)
+        ]
+    if float_indexes:
+        # Converting all float columns through one 2-D NumPy array is several
+        # times faster than building each column from Python objects.
+        getter = operator.itemgetter(*float_indexes)
+        matrix = np.array(list(map(getter, rows)), dtype=np.float64).reshape(
+            len(rows), len(float_indexes)
+        )
+        for j, i in enumerate(float_indexes):
+            column = pa.array(np.ascontiguousarray(matrix[:, j]), from_pandas=True)
+            arrays[i] = column.cast(schema.field(i).type)
+
+    remaining = [i for i in range(len(column_names)) if i not in arrays]
+    if rows and len(remaining) == 1:
+        columns = [[row[remaining[0]] for row in rows]]
+    elif rows and remaining:
+        columns = list(zip(*map(operator.itemgetter(*remaining), rows)))
+    else:
+        columns = [()] * len(remaining)
+    for i, values in zip(remaining, columns):
+        arrow_type = schema.field(i).type if schema is not None else None
+        if arrow_type == pa.string():
+            values = [to_text(value) for value in values]
+        arrays[i] = pa.array(values, type=arrow_type)
+    return pa.RecordBatch.from_arrays(
+        [arrays[i] for i in range(len(column_names))], names=column_names
+    )
+
+
+def arrow_to_dataframe(table: pa.Table) -> pd.DataFrame:
+    with span("format.arrow_to_dataframe", rows=table.num_rows, bytes=table.nbytes):
+        return table.to_pandas(split_blocks=True)
+
+
+def arrow_to_dicts(table: pa.Table) -> List[Dict[str, Any]]:
+    with span("format.arrow_to_dicts", rows=table.num_rows, bytes=table.nbytes):
+        return table_to_dicts(table)
+
+
+def table_to_dicts(table: pa.Table) -> List[Dict[str, Any]]:
+    columns: List[List[Any]] = []
+    for column in table.columns:
+        if column.null_count == 0 and (
+            pa.types.is_integer(column.type)
+            or pa.types.is_floating(column.type)
+            or pa.types.is_boolean(column.type)
+        ):
+            # NumPy's tolist is far cheaper than building Arrow scalars
+            columns.append(column.to_numpy().tolist())
+        else:
+            columns.append(column.to_pylist())
+    names = table.column_names
+    return [dict(zip(names, row)) for row in zip(*columns)]
+
+
+def fingerprint_schema(schema: Dict[str, Any]) -> str:
+    serialized = json.dumps(schema, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def data_path(file_name: str) -> str:
+    data_dir = os.getenv("NLQ_DATA_DIR", ".nlq")
+    os.makedirs(data_dir, exist_ok=True)
+    return os.path.join(data_dir, file_name)
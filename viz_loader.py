@@ -0,0 +1,235 @@
+import os
+import threading
+import uuid
+import numpy as np
+import pandas as pd
+import psycopg
+import pyarrow as pa
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+from psycopg import sql
+from instrumentation import span
+from query_executor import (
+    FETCH_BATCH_SIZE,
+    SET_STATEMENT_TIMEOUT,
+    description_schema,
+    enum_types,
+    fetch_page,
+    register_loaders,
+    statement_timeout_ms,
+)
+from utils import arrow_to_dataframe, format_as_arrow
+
+SAMPLE_METHODS = {
+    "system": "Block sample (TABLESAMPLE SYSTEM)",
+    "bernoulli": "Row sample (TABLESAMPLE BERNOULLI)",
+    "reservoir": "Uniform sample (reservoir, reads the whole table)",
+    "aggregate": "Aggregate in Postgres (GROUP BY)",
+}
+NUMERIC_TYPES = (
+    "smallint",
+    "integer",
+    "bigint",
+    "real",
+    "double precision",
+    "numeric",
+)
+# Block sampling returns a varying number of rows, so ask for some extra
+# and cut the result down with LIMIT.
+SAMPLE_OVERSHOOT = 1.5
+
+
+def viz_sample_rows() -> int:
+    return int(os.getenv("NLQ_VIZ_SAMPLE_ROWS", 100_000))
+
+
+def is_numeric_type(datatype: str) -> bool:
+    return datatype.startswith(NUMERIC_TYPES)
+
+
+@dataclass(frozen=True)
+class SampleSpec:
+    table: str
+    method: str = "system"
+    rows: int = 100_000
+    group_by: Tuple[str, ...] = ()
+    seed: int = 0
+
+    def describe(self) -> str:
+        if self.method == "aggregate":
+            return f"{self.table} grouped by {', '.join(self.group_by)}"
+        return f"{self.table}, {SAMPLE_METHODS[self.method]}, up to {self.rows:,} rows"
+
+
+def sample_percent(rows: int, estimated_rows: Optional[int]) -> float:
+    if not estimated_rows or estimated_rows <= 0:
+        return 100.0
+    return min(100.0, 100.0 * rows * SAMPLE_OVERSHOOT / estimated_rows)
+
+
+def build_sample_query(
+    spec: SampleSpec,
+    columns: Dict[str, str],
+    estimated_rows: Optional[int] = None,
+) -> sql.Composed:
+    table = sql.Identifier(spec.table)
+    if spec.method == "aggregate":
+        if not spec.group_by:
+            raise ValueError("aggregate sampling needs at least one group by column")
+        groups = sql.SQL(", ").join(map(sql.Identifier, spec.group_by))
+        measures = [sql.SQL("count(*) AS row_count")]
+        for column, datatype in columns.items():
+            if column in spec.group_by or not is_numeric_type(datatype):
+                continue
+            for function in ("sum", "avg"):
+                measures.append(
+                    sql.SQL("{}({}) AS {}").format(
+                        sql.SQL(function),
+                        sql.Identifier(column),
+                        sql.Identifier(f"{function}_{column}"),
+                    )
+                )
+        return sql.SQL(
+            "SELECT {groups}, {measures} FROM {table} GROUP BY {groups} "
+            "ORDER BY row_count DESC"
+        ).format(groups=groups, measures=sql.SQL(", ").join(measures), table=table)
+
+    if spec.method in ("system", "bernoulli"):
+        percent = sample_percent(spec.rows, estimated_rows)
+        if percent < 100.0:
+            return sql.SQL(
+                "SELECT * FROM {} TABLESAMPLE {} ({}) REPEATABLE ({})"
+            ).format(
+                table,
+                sql.SQL(spec.method.upper()),
+                sql.Literal(percent),
+                sql.Literal(spec.seed),
+            )
+    return sql.SQL("SELECT * FROM {}").format(table)
+
+
+def reservoir_sample(
+    conn: psycopg.Connection,
+    query: str,
+    rows: int,
+    seed: int = 0,
+    batch_size: int = FETCH_BATCH_SIZE,
+    timeout_ms: Optional[int] = None,
+) -> pa.Table:
+    """Uniform sample of a query's rows, holding at most `rows` rows at a time.
+
+    Every row is streamed from the server once, so this is exact but costs a
+    full scan; TABLESAMPLE is the cheap alternative.
+    """
+    rng = np.random.default_rng(seed)
+    reservoir: List[Any] = []
+    seen = 0
+    with conn.transaction():
+        if timeout_ms:
+            conn.execute(SET_STATEMENT_TIMEOUT, [f"{timeout_ms}ms"])
+        enums = enum_types(conn)
+        with conn.cursor(name=f"nlq_{uuid.uuid4().hex}", binary=True) as cursor:
+            register_loaders(cursor, enums, numeric_as_float=True)
+            cursor.execute(query)
+            schema = description_schema(cursor, numeric_as_float=True)
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                fill = min(len(batch), rows - len(reservoir))
+                reservoir.extend(batch[:fill])
+                # Algorithm R: row i (0-based) replaces a random slot with
+                # probability rows / (i + 1).
+                positions = np.arange(seen + fill, seen + len(batch))
+                slots = rng.integers(0, positions + 1) if len(positions) else positions
+                for index in np.flatnonzero(slots < rows):
+                    reservoir[slots[index]] = batch[fill + index]
+                seen += len(batch)
+    return pa.Table.from_batches(
+        [format_as_arrow(reservoir, schema.names, schema)], schema=schema
+    )
+
+
+def decimals_to_float(table: pa.Table) -> pa.Table:
+    # Charts want floats; exact numeric values matter for results, not plots
+    for index, arrow_field in enumerate(table.schema):
+        if pa.types.is_decimal(arrow_field.type):
+            table = table.set_column(
+                index, arrow_field.name, table.column(index).cast(pa.float64())
+            )
+    return table
+
+
+def load_sample(
+    conn: psycopg.Connection,
+    spec: SampleSpec,
+    columns: Dict[str, str],
+    estimated_rows: Optional[int] = None,
+) -> pd.DataFrame:
+    with span("viz.load", table=spec.table, method=spec.method) as load_span:
+        query = build_sample_query(spec, columns, estimated_rows).as_string(conn)
+        if spec.method == "reservoir":
+            table = reservoir_sample(
+                conn, query, spec.rows, spec.seed, timeout_ms=statement_timeout_ms()
+            )
+        else:
+            page = fetch_page(
+                conn,
+                f"{query} LIMIT {spec.rows}",
+                limit=spec.rows,
+                estimate=False,
+                timeout_ms=statement_timeout_ms(),
+            )
+            table = decimals_to_float(page.table)
+        df = arrow_to_dataframe(table)
+        load_span.set(rows=len(df), bytes=int(df.memory_usage(deep=True).sum()))
+    return df
+
+
+@dataclass
+class CachedFrame:
+    value: Any
+    size: int
+
+
+class FrameCache:
+    """LRU cache of loaded visualization frames, bounded by their memory use."""
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes or int(
+            os.getenv("NLQ_VIZ_CACHE_BYTES", 512 * 2**20)
+        )
+        self.entries: "OrderedDict[Tuple[str, SampleSpec], CachedFrame]" = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: Tuple[str, SampleSpec]) -> Optional[Any]:
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry.value
+
+    def set(self, key: Tuple[str, SampleSpec], value: Any, size: int) -> None:
+        with self._lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous.size
+            self.entries[key] = CachedFrame(value, size)
+            self.bytes += size
+            # The newest entry is always kept, even when it alone is too big
+            while self.bytes > self.max_bytes and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,95 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+from utils import data_path
+
+
+@dataclass
+class WorkloadEntry:
+    target: str
+    sql: str
+    seconds: float
+    rows: int
+    plan: Optional[Dict[str, Any]]
+    executed_at: float
+
+
+class WorkloadLog:
+    """Executed generated queries with their runtime and EXPLAIN plan.
+
+    Kept in SQLite next to the translation cache so the index advisor can
+    look at the workload of earlier sessions too. Only the newest
+    max_entries queries are kept.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_entries: Optional[int] = None):
+        self.path = path or data_path("workload.sqlite3")
+        self.max_entries = max_entries or int(
+            os.getenv("NLQ_WORKLOAD_LOG_SIZE", 10_000)
+        )
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS workload ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT NOT NULL, "
+            "sql TEXT NOT NULL, seconds REAL NOT NULL, rows INTEGER NOT NULL, "
+            "plan TEXT, executed_at REAL NOT NULL)"
+        )
+        self._db.commit()
+
+    def record(
+        self,
+        target: str,
+        sql: str,
+        seconds: float,
+        rows: int,
+        plan: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO workload (target, sql, seconds, rows, plan, executed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    target,
+                    sql,
+                    seconds,
+                    rows,
+                    None if plan is None else json.dumps(plan),
+                    time.time(),
+                ),
+            )
+            self._db.execute(
+                "DELETE FROM workload WHERE id <= "
+                "(SELECT max(id) FROM workload) - ?",
+                (self.max_entries,),
+            )
+            self._db.commit()
+
+    def entries(self, target: str, limit: Optional[int] = None) -> List[WorkloadEntry]:
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT target, sql, seconds, rows, plan, executed_at FROM workload "
+                "WHERE target = ? ORDER BY id DESC LIMIT ?",
+                (target, limit or self.max_entries),
+            ).fetchall()
+        return [
+            WorkloadEntry(
+                target,
+                sql,
+                seconds,
+                count,
+                None if plan is None else json.loads(plan),
+                at,
+            )
+            for target, sql, seconds, count, plan, at in rows
+        ]
+
+    def clear(self, target: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM workload WHERE target = ?", (target,))
+            self._db.commit()